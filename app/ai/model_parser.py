@@ -1,4 +1,6 @@
+import logging
 import os
+import threading
 
 import numpy as np
 import torch
@@ -7,6 +9,9 @@ from transformers import AutoTokenizer, AutoImageProcessor, AutoFeatureExtractor
 
 from app.ai.pipeline_task import PipelineTask
 from app.ai.task_mapping import get_model_class_from_path
+from app.grid.layer_store import get_source_files
+
+logger = logging.getLogger(__name__)
 
 
 class ModuleMeta:
@@ -19,15 +24,29 @@ class ModuleMeta:
 
     def get_data(self):
         if isinstance(self.module, nn.Parameter):
-            return self.module.detach().numpy()
+            # float() is a no-op for float32, other dtypes (bfloat16) have no numpy equivalent
+            return self.module.detach().float().numpy()
         elif self.is_parameter:
             return np.ones([2, 2])
         else:
             return None
 
+    def get_shape(self):
+        if isinstance(self.module, nn.Parameter):
+            return tuple(self.module.shape)
+        return 2, 2
+
     def add_component(self, component):
         self.components.append(component)
 
+    def get_parameter_metas(self):
+        if self.is_parameter:
+            return [self]
+        result = []
+        for c in self.components:
+            result += c.get_parameter_metas()
+        return result
+
     def hook(self, module, input, output):
         self.flash(self.n_effects)
 
@@ -69,6 +88,13 @@ class ModelParser:
         self.hooked_model_name = None
         self.last_result = None
         self.pipeline_task = PipelineTask()
+        # Directory of a model shown from its safetensors files, the model is built on the first run
+        self.model_directory = None
+        # Checkpoint the model was loaded from, None for models passed in memory
+        self.model_path = None
+        # Guards is_loading, a run while the model is built on the loader thread is ignored
+        self.model_lock = threading.Lock()
+        self.is_loading = False
 
     def clear(self):
         self.model = None
@@ -78,6 +104,8 @@ class ModelParser:
         self.parsed_model = None
         self.current_model_name = None
         self.hooked_model_name = None
+        self.model_directory = None
+        self.model_path = None
         self.pipeline_task.clear()
 
     def _register_hooks(self):
@@ -89,7 +117,8 @@ class ModelParser:
         self.hooked_model_name = self.parsed_model.name
 
     def _parse_module(self, module, name):
-        print(type(module), module)
+        # The repr of a module holds all of its children, it is not built for every level
+        logger.debug("Parsing %s %s", name, type(module).__name__)
         module_meta = ModuleMeta(module, name)
         named_children = list(module.named_children())
         if len(named_children) > 0:
@@ -108,9 +137,32 @@ class ModelParser:
         return module_meta
 
     def run_model(self, task_input):
+        with self.model_lock:
+            if self.is_loading:
+                # self.model is set before the tokenizer and the parsed model are ready
+                print("Model is still loading, run ignored")
+                return
+            if self.model is None and self.model_directory is not None:
+                # Building the model takes a while, keep the render loop running
+                self.is_loading = True
+                threading.Thread(target=self._load_and_run_model, args=(task_input,)).start()
+                return
         self._register_hooks()
         self.pipeline_task.run_pipeline(task_input)
 
+    def _load_and_run_model(self, task_input):
+        try:
+            self.load_pending_model()
+            if self.model is None:
+                print("No model to run!")
+                return
+            # Hooks are registered before other runs are let through
+            self._register_hooks()
+            self.pipeline_task.run_pipeline(task_input)
+        finally:
+            with self.model_lock:
+                self.is_loading = False
+
     def get_run_result(self):
         return self.pipeline_task.pool_forward_pass_result()
 
@@ -122,6 +174,31 @@ class ModelParser:
 
     def set_model(self, model):
         self.model = model
+        # Weights can differ from any checkpoint (fine-tuned, modified)
+        self.model_path = None
+
+    def set_model_directory(self, path):
+        """
+        Weights are displayed straight from the safetensors files, torch model is built by load_pending_model
+        """
+        self.clear()
+        self.model_directory = path
+        self.current_model_name = os.path.basename(path)
+
+    def has_model(self):
+        return self.model is not None or self.model_directory is not None
+
+    def load_pending_model(self):
+        if self.model is not None or self.model_directory is None:
+            return
+        path = self.model_directory
+        self.load_model_from_path(path)
+        if self.model is None:
+            return
+        self.load_tokenizer_from_path(path)
+        self.load_image_processor_from_path(path)
+        self.load_feature_extractor_from_path(path)
+        self.parse_loaded_model()
 
     def set_tokenizer(self, tokenizer):
         self.tokenizer = tokenizer
@@ -140,6 +217,7 @@ class ModelParser:
             model = model_class.from_pretrained(path, local_files_only=True)
             print(f"Successfully loaded model from path", model_class)
         self.model = model
+        self.model_path = path if model is not None else None
 
     def load_tokenizer_from_path(self, path):
         try:
@@ -168,6 +246,23 @@ class ModelParser:
             print(f"Failed to load feature extractor with error: {e}")
             self.feature_extractor = None
 
+    def get_layer_store_source(self):
+        # Identifies the weights written to the layer store
+        return self.model.name_or_path if self.model is not None else None
+
+    def get_layer_store_source_files(self):
+        # None when the weights are not backed by files, such models are not cached in the layer store
+        return get_source_files(self.model_path) if self.model is not None else None
+
+    def get_parameters_shapes(self):
+        return {meta.name: meta.get_shape() for meta in self.parsed_model.get_parameter_metas()}
+
+    def write_layer_store(self, layer_store, dtype):
+        print("Writing layer store", layer_store.data_path)
+        named_arrays = ((meta.name, meta.get_data()) for meta in self.parsed_model.get_parameter_metas())
+        return layer_store.write(self.current_model_name, self.get_layer_store_source(), named_arrays, dtype,
+                                 self.get_layer_store_source_files())
+
     def parse_loaded_model(self):
         self.pipeline_task.load_from_model(self.model, self.tokenizer, self.image_processor, self.feature_extractor)
 
@@ -0,0 +1,139 @@
+import glob
+import json
+import os
+import struct
+
+import numpy as np
+
+SAFETENSORS_DTYPES = {
+    "F64": np.float64,
+    "F32": np.float32,
+    "F16": np.float16,
+    "I64": np.int64,
+    "I32": np.int32,
+    "I16": np.int16,
+    "I8": np.int8,
+    "U8": np.uint8,
+    "BOOL": np.bool_,
+}
+# bfloat16 has no numpy dtype, raw values are read as uint16 and widened to float32
+BF16 = "BF16"
+
+
+def find_safetensors_files(directory):
+    # Single file checkpoints and shards (model-00001-of-00002.safetensors) sort in the right order
+    return sorted(glob.glob(os.path.join(directory, "*.safetensors")))
+
+
+def has_safetensors(directory):
+    return directory is not None and os.path.isdir(directory) and len(find_safetensors_files(directory)) > 0
+
+
+def bf16_to_float32(raw):
+    return (raw.astype(np.uint32) << 16).view(np.float32)
+
+
+class SafetensorsEntry:
+    def __init__(self, name, dtype, shape, begin, end):
+        self.name = name
+        self.dtype = dtype
+        self.shape = tuple(shape)
+        self.begin = begin
+        self.end = end
+
+
+class SafetensorsFile:
+    """
+    Single .safetensors file read through np.memmap
+
+    The file is an 8 byte header length, a JSON header with dtype, shape and data offsets of every tensor
+    and the raw data. Only the header is parsed on open, tensors are views of the memory map,
+    so nothing is read from the disk until a tensor is displayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.metadata = {}
+        self.data = None
+
+    def open(self):
+        with open(self.path, 'rb') as file:
+            header_size = struct.unpack('<Q', file.read(8))[0]
+            header = json.loads(file.read(header_size))
+        data_start = 8 + header_size
+        self.metadata = header.pop('__metadata__', {}) or {}
+        self.entries = {}
+        for name, tensor in header.items():
+            begin, end = tensor['data_offsets']
+            self.entries[name] = SafetensorsEntry(name, tensor['dtype'], tensor['shape'],
+                                                  data_start + begin, data_start + end)
+        self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        return self
+
+    def close(self):
+        self.data = None
+        self.entries = {}
+
+    def names(self):
+        # Header keys are sorted alphabetically, data offsets keep the order of the model (layers.2 before layers.10)
+        return [e.name for e in sorted(self.entries.values(), key=lambda e: e.begin)]
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is None or self.data is None:
+            return None
+        raw = self.data[entry.begin:entry.end]
+        if entry.dtype == BF16:
+            return bf16_to_float32(raw.view(np.uint16)).reshape(entry.shape)
+        dtype = SAFETENSORS_DTYPES.get(entry.dtype)
+        if dtype is None:
+            print("Unsupported safetensors dtype", entry.dtype, name)
+            return None
+        return raw.view(dtype).reshape(entry.shape)
+
+
+class SafetensorsCheckpoint:
+    """
+    All safetensors shards of a model directory, tensors are looked up by name across the shards
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = []
+        self.tensor_files = {}
+
+    def open(self):
+        self.files = [SafetensorsFile(path).open() for path in find_safetensors_files(self.directory)]
+        self.tensor_files = {}
+        for file in self.files:
+            for name in file.entries:
+                self.tensor_files[name] = file
+        print("Opened safetensors", self.directory, "files", len(self.files), "tensors", len(self.tensor_files))
+        return self
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        self.files = []
+        self.tensor_files = {}
+
+    def names(self):
+        return [name for file in self.files for name in file.names()]
+
+    def get(self, name):
+        file = self.tensor_files.get(name)
+        if file is None:
+            return None
+        return file.get(name)
+
+    def get_shape(self, name):
+        file = self.tensor_files.get(name)
+        return file.entries[name].shape if file is not None else None
+
+    def is_supported(self, name):
+        file = self.tensor_files.get(name)
+        if file is None:
+            return False
+        dtype = file.entries[name].dtype
+        return dtype == BF16 or dtype in SAFETENSORS_DTYPES
@@ -0,0 +1,121 @@
+"""
+Render loop tick times while large frames are built, frames built by threads compared to frame processes
+The loop does a fixed amount of Python work per tick, like the GUI and the scene update in NWindow.start_main_loop.
+
+Frame times are the time from request to ready of the frames that were not replaced before they were ready,
+taken from the FrameData timestamps.
+
+Run from the repository root:
+    python -m app.benchmark.bench_frame_process
+"""
+import contextlib
+import io
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_arrays
+from app.gl.n_frame_process import FrameProcessPool
+from app.gl.n_frame_producer import NFrameProducer
+from app.gl.n_net import NNet
+from app.gl.n_viewport import VisibleGrid
+from app.grid.layer_store import LayerStore
+from app.grid.n_layout import SQUARE
+
+BUFFER_SIZE = 2560
+FACTOR = 8
+TICKS = 240
+TICK_INTERVAL = 1 / 60
+# New frame every few ticks, each one built from scratch
+FRAME_EVERY_TICKS = 4
+SHAPES = [(512, 512)] * 800 + [(2048,)] * 800
+
+
+def render_tick_work():
+    # Python side of a render loop tick, GUI widgets and uniform updates
+    total = 0
+    for index in range(200000):
+        total += index * index
+    return total
+
+
+def create_net(layer_store):
+    n_net = NNet(None, None)
+    n_net.set_layout(SQUARE)
+    n_net.set_reducer("point")
+    n_net.init_from_layer_store(layer_store)
+    return n_net
+
+
+def create_frames(n_net):
+    size = BUFFER_SIZE * FACTOR
+    columns = max(1, (n_net.total_width - size) // 256)
+    return [VisibleGrid(index % columns * 256, 0, index % columns * 256 + size, min(n_net.total_height, size), 0,
+                        FACTOR, 1, n_net)
+            for index in range(TICKS // FRAME_EVERY_TICKS)]
+
+
+def run_render_loop(producer, visible_grids):
+    tick_times = []
+    frames = []
+    next_tick = time.perf_counter()
+    for tick in range(TICKS):
+        if tick % FRAME_EVERY_TICKS == 0:
+            producer.invalidate()
+            producer.create_frame(visible_grids[tick // FRAME_EVERY_TICKS])
+            frames.append(producer.get_current_frame())
+        start_time = time.perf_counter()
+        render_tick_work()
+        tick_times.append((time.perf_counter() - start_time) * 1000)
+        next_tick += TICK_INTERVAL
+        time.sleep(max(0.0, next_tick - time.perf_counter()))
+    return np.array(tick_times), frames
+
+
+def bench(n_net, frame_process_pool):
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE)
+    producer = NFrameProducer(n_buffer)
+    if frame_process_pool is not None:
+        producer.set_frame_process_pool(frame_process_pool)
+    visible_grids = create_frames(n_net)
+    # Pyramids, tile caches and layer pages are warm in both runs
+    for visible_grid in visible_grids[:2]:
+        producer.invalidate()
+        producer.create_frame(visible_grid)
+        while not producer.get_current_frame().ready:
+            time.sleep(0.001)
+    tick_times, frames = run_render_loop(producer, visible_grids)
+    producer.shutdown()
+    ready_ms = [(frame.ready_time - frame.created_time) * 1000 for frame in frames
+                if frame is not None and frame.ready_time is not None]
+    return tick_times, ready_ms
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        arrays = create_synthetic_arrays(SHAPES)
+        names = [f"synthetic.layer_{index}" for index in range(len(arrays))]
+        layer_store = LayerStore(os.path.join(directory, "synthetic")).write("synthetic", "synthetic",
+                                                                            zip(names, arrays))
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_net = create_net(layer_store)
+        print(f"Synthetic net {n_net.total_width}x{n_net.total_height}, buffer {BUFFER_SIZE}x{BUFFER_SIZE}, "
+              f"frame every {FRAME_EVERY_TICKS} ticks, {os.cpu_count()} cpus")
+
+        for name in ("thread", "process"):
+            with contextlib.redirect_stdout(io.StringIO()):
+                # Tiles off, every frame reads the grid
+                frame_process_pool = FrameProcessPool(tile_cache_budget=0) if name == "process" else None
+                n_net.tile_cache.set_budget(0)
+                tick_times, ready_ms = bench(n_net, frame_process_pool)
+            frame_message = f"median frame {np.median(ready_ms):.1f} ms ({len(ready_ms)} ready)" \
+                if len(ready_ms) > 0 else "no frame ready"
+            print(f"{name:>7}: tick p50 {np.percentile(tick_times, 50):.2f} ms, "
+                  f"p95 {np.percentile(tick_times, 95):.2f} ms, max {tick_times.max():.2f} ms, {frame_message}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Simulated drag over a synthetic net, frame per viewport change like NViewport.update_viewport.
+Compares the thread and buffer per frame producer used before with the persistent worker pool,
+then the build time of panned frames rebuilt from scratch and shifted from the previous frame.
+
+Run from the repository root:
+    python -m app.benchmark.bench_frame_producer
+"""
+import contextlib
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net
+from app.gl.n_frame_producer import NFrameProducer, CancellationSignal
+from app.gl.n_viewport import VisibleGrid
+
+BUFFER_SIZE = 2560
+FACTOR = 2
+DRAG_EVENTS = 120
+# Viewport change every 8 ms, a fast drag with a 120 Hz mouse
+EVENT_INTERVAL = 0.008
+DRAG_STEP = 64
+SHAPES = [(2048, 2048)] * 16
+
+
+class LegacyFrameData:
+    # Frame as built before the worker pool, one thread and one buffer per frame
+    def __init__(self, buffer_width, buffer_height, visible_grid_part):
+        self.visible_grid_part = visible_grid_part
+        self.buffer_width = buffer_width
+        self.buffer_height = buffer_height
+        self.data = None
+        self.cancellation_signal = CancellationSignal()
+        self.ready = False
+        self._thread = threading.Thread(target=self._load)
+        self._thread.start()
+
+    def _load(self):
+        self.data = np.full((self.buffer_width, self.buffer_height), fill_value=-1, dtype=np.float32)
+        self.visible_grid_part.update_scene_buffer_directly(self.data, self.cancellation_signal)
+        self.ready = True
+
+    def cancel(self):
+        self.cancellation_signal.emit()
+
+
+def create_drag(n_net):
+    width = BUFFER_SIZE * FACTOR // 2
+    height = min(n_net.total_height, BUFFER_SIZE * FACTOR)
+    return [VisibleGrid(index * DRAG_STEP, 0, index * DRAG_STEP + width, height, 0, FACTOR, 1, n_net)
+            for index in range(DRAG_EVENTS)]
+
+
+def wait_ready(get_frame):
+    start_time = time.perf_counter()
+    while not get_frame().ready:
+        time.sleep(0.0005)
+    return (time.perf_counter() - start_time) * 1000
+
+
+def bench_legacy(visible_grids):
+    frames = []
+    start_time = time.perf_counter()
+    for visible_grid in visible_grids:
+        if len(frames) > 0:
+            frames[-1].cancel()
+        frames.append(LegacyFrameData(BUFFER_SIZE, BUFFER_SIZE, visible_grid))
+        time.sleep(EVENT_INTERVAL)
+    last_frame_ms = wait_ready(lambda: frames[-1])
+    total_ms = (time.perf_counter() - start_time) * 1000
+    for frame in frames:
+        frame._thread.join()
+    return len(frames), len(frames), last_frame_ms, total_ms
+
+
+def bench_pool(visible_grids):
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE)
+    producer = NFrameProducer(n_buffer)
+    start_time = time.perf_counter()
+    for visible_grid in visible_grids:
+        producer.create_frame(visible_grid)
+        time.sleep(EVENT_INTERVAL)
+    last_frame_ms = wait_ready(producer.get_current_frame)
+    total_ms = (time.perf_counter() - start_time) * 1000
+    threads_count = len(producer.worker_pool.threads)
+    producer.shutdown()
+    print(f"pool: {producer.worker_pool.dropped_count} stale frames dropped from the queue")
+    return threads_count, producer.buffer_pool.allocations_count, last_frame_ms, total_ms
+
+
+def bench_pan(visible_grids, shift):
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE)
+    producer = NFrameProducer(n_buffer)
+    timings = []
+    for visible_grid in visible_grids:
+        if not shift:
+            producer.invalidate()
+        start_time = time.perf_counter()
+        producer.create_frame(visible_grid)
+        wait_ready(producer.get_current_frame)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    producer.shutdown()
+    return float(np.median(timings)), producer.shifted_frames_count
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_net(SHAPES)
+    visible_grids = create_drag(n_net)
+    buffer_mb = BUFFER_SIZE * BUFFER_SIZE * 4 / 1024 / 1024
+    print(f"{DRAG_EVENTS} viewport changes, buffer {BUFFER_SIZE}x{BUFFER_SIZE} ({buffer_mb:.0f} MB)")
+
+    for name, bench in (("legacy", bench_legacy), ("pool", bench_pool)):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            threads_count, allocations_count, last_frame_ms, total_ms = bench(visible_grids)
+        for line in output.getvalue().splitlines():
+            if line.startswith(name):
+                print(line)
+        print(f"{name:>6}: threads started {threads_count:4}, buffers allocated {allocations_count:4} "
+              f"({allocations_count * buffer_mb:.0f} MB), last frame ready after {last_frame_ms:.1f} ms, "
+              f"drag {total_ms:.0f} ms")
+
+    for shift in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            frame_ms, shifted_count = bench_pan(visible_grids, shift)
+        print(f"pan by {DRAG_STEP} columns, {'shifted' if shift else 'rebuilt'}: median frame {frame_ms:.2f} ms, "
+              f"shifted frames {shifted_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Layout time of every layout strategy for a model with 50k parameter tensors
+
+Run from the repository root:
+    python -m app.benchmark.bench_layout
+"""
+import time
+
+import numpy as np
+
+from app.grid.n_layout import create_layout, STRIP, SQUARE, ROWS
+
+LAYERS_COUNT = 50000
+LAYERS_PER_GROUP = 12
+LAYOUTS = {"strip": STRIP, "square": SQUARE, "rows": ROWS}
+
+
+def main():
+    rng = np.random.default_rng(0)
+    rows_counts = rng.integers(1, 4096, LAYERS_COUNT)
+    columns_counts = rng.integers(1, 4096, LAYERS_COUNT)
+    groups = np.arange(LAYERS_COUNT) // LAYERS_PER_GROUP
+
+    for name, layout_type in LAYOUTS.items():
+        layout = create_layout(layout_type)
+        start_time = time.perf_counter()
+        _, _, total_width, total_height = layout.compute_offsets(rows_counts, columns_counts, groups)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        print(f"{name:>8}: {elapsed_ms:7.2f} ms, world {total_width}x{total_height}")
+
+
+if __name__ == "__main__":
+    main()
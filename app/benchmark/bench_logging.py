@@ -0,0 +1,107 @@
+"""
+Cost of logging and memory sampling on the render loop tick, headless, no window and no GL context
+
+Each tick feeds one viewport of the scripted trace to NViewport, frames are built by the frame workers,
+and reads the memory message like the GUI does. Two modes are compared:
+- verbose: DEBUG level without rate limit and the memory sampled on the tick, like the prints of the render
+  loop and of the frame workers did before
+- default: the level and rate limit of the default config, the memory sampled by the background MemoryMonitor
+
+Reported per mode: tick time p50 / p95 / mean in ms, the first pass is warmup, and the lines logged per pass.
+
+Run from the repository root:
+    python -m app.benchmark.bench_logging
+    python -m app.benchmark.bench_logging --model llm_1b --scale 4 --passes 3
+"""
+import argparse
+import contextlib
+import io
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import SYNTHETIC_MODELS, create_synthetic_model_net, create_scripted_trace
+from app.gl.n_frame_producer import NFrameProducer
+from app.gl.n_viewport import NViewport
+from app.logger import configure_logging, MemoryMonitor, DEFAULT_LOG_LEVEL, DEFAULT_RATE_LIMIT, \
+    DEFAULT_MEMORY_MONITOR_INTERVAL
+
+# Same as the default config
+BUFFER_SIZE = 1500
+REDUCER = "point"
+TICK_INTERVAL = 1 / 60
+MODE_VERBOSE = "verbose"
+MODE_DEFAULT = "default"
+MODES = [MODE_VERBOSE, MODE_DEFAULT]
+
+
+def run_mode(mode, n_net, trace, passes):
+    log_stream = io.StringIO()
+    memory_monitor = MemoryMonitor()
+    if mode == MODE_VERBOSE:
+        configure_logging("DEBUG", 0, log_stream)
+    else:
+        configure_logging(DEFAULT_LOG_LEVEL, DEFAULT_RATE_LIMIT, log_stream)
+        memory_monitor.start(DEFAULT_MEMORY_MONITOR_INTERVAL)
+
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE,
+                               viewport_width=BUFFER_SIZE / 2, viewport_height=BUFFER_SIZE / 2)
+    n_frame_producer = NFrameProducer(n_buffer)
+    n_viewport = NViewport(n_net, n_buffer, n_frame_producer)
+    n_viewport.set_grid_size(n_net.total_width, n_net.total_height)
+    ticks = []
+    lines_count = 0
+    for pass_index in range(passes):
+        n_viewport.invalidate()
+        for _, viewport in trace.events:
+            start_time = time.perf_counter()
+            n_viewport.update_viewport(viewport)
+            if mode == MODE_VERBOSE:
+                memory_monitor.sample()
+            memory_monitor.get_message()
+            ticks.append((time.perf_counter() - start_time) * 1000)
+            time.sleep(TICK_INTERVAL)
+        if pass_index == 0:
+            lines_count = log_stream.getvalue().count("\n")
+    n_frame_producer.shutdown()
+    memory_monitor.stop()
+
+    lines_per_pass = (log_stream.getvalue().count("\n") - lines_count) / max(passes - 1, 1)
+    ticks = np.array(ticks[len(trace.events):] if passes > 1 else ticks)
+    return {
+        "mode": mode,
+        "tick_p50_ms": float(np.percentile(ticks, 50)),
+        "tick_p95_ms": float(np.percentile(ticks, 95)),
+        "tick_mean_ms": float(np.mean(ticks)),
+        "lines_per_pass": lines_per_pass,
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Logging cost on the render loop tick")
+    parser.add_argument("--model", default="bert_base", choices=list(SYNTHETIC_MODELS))
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--passes", type=int, default=5, help="passes over the trace, the first one is warmup")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_model_net(arguments.model, arguments.scale)
+        n_net.set_reducer(REDUCER)
+    trace = create_scripted_trace(n_net, BUFFER_SIZE / 2, BUFFER_SIZE / 2)
+    print(f"Net {n_net.total_width}x{n_net.total_height}, trace {trace.name} with {len(trace.events)} viewports, "
+          f"{arguments.passes} passes", file=sys.stderr)
+    for mode in arguments.modes:
+        result = run_mode(mode, n_net, trace, arguments.passes)
+        print(f"{mode:>8}: tick p50 {result['tick_p50_ms']:.3f} ms, p95 {result['tick_p95_ms']:.3f} ms, "
+              f"mean {result['tick_mean_ms']:.3f} ms, {result['lines_per_pass']:.0f} lines per pass",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Parity of NumbaGrid with NumpyGrid, then frame times of both backends
+
+Every reducer is checked at aligned and unaligned bounds, factors that are and are not powers of two,
+float32 and float16 buffers, plus get_point_data at random points. Exits with status 1 on a mismatch,
+before the frame times.
+
+Run from the repository root:
+    python -m app.benchmark.bench_numba_grid
+"""
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net
+from app.gl.n_frame_producer import CancellationSignal
+from app.grid.lod_pyramid import REDUCERS
+from app.grid.n_layout import SQUARE
+from app.grid.numba_grid import NumbaGrid, NumbaLayer
+
+PARITY_BUFFER_SIZE = 384
+PARITY_FACTORS = [1, 2, 3, 4, 6, 8, 12, 32]
+# Frame origins relative to the first layers, inside and across their edges
+PARITY_ORIGIN_SHIFTS = [(13, 7), (-5, -3), (-37, 101)]
+PARITY_POINTS = 2000
+# Odd sizes, 1d layers and layers smaller than a block
+PARITY_SHAPES = [(517, 311), (64, 1031), (1999,), (3,), (1, 1), (257, 257), (1024, 768), (33,)] * 3
+BUFFER_SIZE = 2560
+FACTORS = [1, 4, 16]
+REPEAT = 5
+SHAPES = [(4096, 4096)] * 4 + [(4096, 1024)] * 16 + [(4096,)] * 16
+
+
+def create_grids(shapes):
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_net(shapes)
+        n_net.set_layout(SQUARE)
+        n_net.relayout()
+        numba_grid = NumbaGrid()
+    numba_layers = []
+    for layer in n_net.grid.layers:
+        numba_layer = NumbaLayer(layer.layer_grid, layer.name)
+        numba_layer.define_layer_offset(layer.column_offset, layer.row_offset)
+        numba_layers.append(numba_layer)
+    numba_grid.add_layers(numba_layers)
+    return n_net, n_net.grid, numba_grid
+
+
+def fill(grid, x1, y1, x2, y2, factor, buffer):
+    buffer.fill(-1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        grid.update_texture_buffer_with_visible_data_directly(x1, y1, x2, y2, factor, factor, buffer,
+                                                              CancellationSignal())
+    return buffer
+
+
+def get_parity_origins(grid):
+    origins = [(0, 0)]
+    for layer, (shift_x, shift_y) in zip(grid.layers, PARITY_ORIGIN_SHIFTS):
+        origins.append((max(0, layer.column_offset + shift_x), max(0, layer.row_offset + shift_y)))
+    return origins
+
+
+def check_parity():
+    n_net, numpy_grid, numba_grid = create_grids(PARITY_SHAPES)
+    cases_count = 0
+    filled_cells = 0
+    mismatches = []
+    for reducer in REDUCERS:
+        numpy_grid.set_reducer(reducer)
+        numba_grid.set_reducer(reducer)
+        for factor in PARITY_FACTORS:
+            for origin_x, origin_y in get_parity_origins(numpy_grid):
+                x2 = min(n_net.total_width, origin_x + PARITY_BUFFER_SIZE * factor)
+                y2 = min(n_net.total_height, origin_y + PARITY_BUFFER_SIZE * factor)
+                for dtype in (np.float32, np.float16):
+                    expected = fill(numpy_grid, origin_x, origin_y, x2, y2, factor,
+                                    np.empty((PARITY_BUFFER_SIZE, PARITY_BUFFER_SIZE), dtype=dtype))
+                    actual = fill(numba_grid, origin_x, origin_y, x2, y2, factor,
+                                  np.empty((PARITY_BUFFER_SIZE, PARITY_BUFFER_SIZE), dtype=dtype))
+                    cases_count += 1
+                    filled_cells += int(np.count_nonzero(expected != -1))
+                    if not np.array_equal(expected, actual):
+                        mismatches.append((reducer, factor, origin_x, origin_y, np.dtype(dtype).name,
+                                           int(np.count_nonzero(expected != actual))))
+
+    rng = np.random.default_rng(0)
+    for x, y in zip(rng.integers(0, n_net.total_width, PARITY_POINTS).tolist(),
+                    rng.integers(0, n_net.total_height, PARITY_POINTS).tolist()):
+        expected_value, expected_meta = numpy_grid.get_point_data(x, y)
+        actual_value, actual_meta = numba_grid.get_point_data(x, y)
+        cases_count += 1
+        if expected_value != actual_value or (expected_meta is None) != (actual_meta is None) \
+                or (expected_meta is not None and expected_meta.name != actual_meta.name):
+            mismatches.append(("point", x, y, expected_value, actual_value))
+    return cases_count, filled_cells, mismatches
+
+
+def measure(grid, factor, buffer):
+    timings = []
+    for _ in range(REPEAT):
+        start_time = time.perf_counter()
+        fill(grid, 0, 0, BUFFER_SIZE * factor, BUFFER_SIZE * factor, factor, buffer)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return float(np.median(timings))
+
+
+def main():
+    start_time = time.perf_counter()
+    cases_count, filled_cells, mismatches = check_parity()
+    print(f"Parity: {cases_count} cases, {filled_cells} cells with data, {len(mismatches)} mismatches "
+          f"({time.perf_counter() - start_time:.1f} s with kernel compilation)")
+    if len(mismatches) > 0:
+        for mismatch in mismatches[:20]:
+            print("  mismatch", mismatch, file=sys.stderr)
+        sys.exit(1)
+
+    n_net, numpy_grid, numba_grid = create_grids(SHAPES)
+    print(f"Synthetic net {n_net.total_width}x{n_net.total_height}, buffer {BUFFER_SIZE}x{BUFFER_SIZE}")
+    buffer = np.empty((BUFFER_SIZE, BUFFER_SIZE), dtype=np.float32)
+    for reducer in ("point", "mean"):
+        numpy_grid.set_reducer(reducer)
+        numba_grid.set_reducer(reducer)
+        # Pyramids and level arena are built once per reducer, keep them out of the measurement
+        fill(numpy_grid, 0, 0, BUFFER_SIZE * 2, BUFFER_SIZE * 2, 2, buffer)
+        fill(numba_grid, 0, 0, BUFFER_SIZE * 2, BUFFER_SIZE * 2, 2, buffer)
+        for factor in FACTORS:
+            numpy_ms = measure(numpy_grid, factor, buffer)
+            numba_ms = measure(numba_grid, factor, buffer)
+            print(f"[{reducer}] factor {factor:>2}: numpy {numpy_ms:.2f} ms, numba {numba_ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
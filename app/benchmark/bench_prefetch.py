@@ -0,0 +1,115 @@
+"""
+Scroll zoom into a synthetic net, one viewport change per frame of a 60 Hz display,
+frames assembled from the tile cache with and without the prefetcher warming it
+
+The run with the prefetcher fails when no prefetched tile is used by a frame.
+
+Run from the repository root:
+    python -m app.benchmark.bench_prefetch
+"""
+import contextlib
+import io
+import math
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net
+from app.gl.n_frame_producer import NFrameProducer
+from app.gl.n_prefetcher import NPrefetcher
+from app.gl.n_viewport import NViewport
+from app.grid.n_layout import SQUARE
+from app.grid.tile_cache import DEFAULT_TILE_CACHE_BUDGET
+
+BUFFER_SIZE = 1500
+EVENT_INTERVAL = 1 / 60
+# Log zoom step per scroll event, about NWindow.zoom_step at mid zoom
+ZOOM_STEP = 0.04
+ZOOM_EVENTS = 150
+SHAPES = [(4096, 4096)] * 4 + [(4096, 1024)] * 16 + [(4096,)] * 16
+
+
+def create_zoom(n_net):
+    # Zoom in towards a point off the center, the point stays at the same place on the screen
+    point_x = n_net.total_width * 0.3
+    point_y = n_net.total_height * 0.6
+    w = h = max(n_net.total_width, n_net.total_height) * 1.2
+    x = point_x - w * 0.3
+    y = point_y - h * 0.6
+    viewports = []
+    for _ in range(ZOOM_EVENTS):
+        viewports.append((x, y, w, h, 1 / w))
+        scale = math.exp(-ZOOM_STEP)
+        x = point_x - (point_x - x) * scale
+        y = point_y - (point_y - y) * scale
+        w *= scale
+        h *= scale
+    return viewports
+
+
+def bench(n_net, viewports, prefetch):
+    # Same budget as the default config, the prefetcher does nothing without the tile cache
+    n_net.set_tile_cache_budget(DEFAULT_TILE_CACHE_BUDGET)
+    n_net.tile_cache.clear()
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE,
+                               viewport_width=BUFFER_SIZE / 2, viewport_height=BUFFER_SIZE / 2)
+    producer = NFrameProducer(n_buffer)
+    n_viewport = NViewport(n_net, n_buffer, producer)
+    n_viewport.set_grid_size(n_net.total_width, n_net.total_height)
+    prefetcher = NPrefetcher(n_viewport, producer, SimpleNamespace(is_animating=False))
+    prefetcher.set_enabled(prefetch)
+
+    latencies = []
+    stale_events = 0
+    for viewport in viewports:
+        previous_frame = producer.get_current_frame()
+        n_viewport.update_viewport(viewport)
+        prefetcher.on_viewport_updated(viewport)
+        frame = producer.get_current_frame()
+        start_time = time.perf_counter()
+        deadline = start_time + EVENT_INTERVAL
+        while not frame.ready and time.perf_counter() < deadline:
+            time.sleep(0.0005)
+        if frame.ready:
+            if frame is not previous_frame:
+                latencies.append((time.perf_counter() - start_time) * 1000)
+        else:
+            # Next display frame still shows the previous texture
+            stale_events += 1
+        time.sleep(max(0.0, deadline - time.perf_counter()))
+
+    prefetcher.shutdown()
+    producer.shutdown()
+    return latencies, stale_events, prefetcher.built_bytes
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_net(SHAPES)
+        n_net.set_layout(SQUARE)
+        n_net.relayout()
+    n_net.set_reducer("point")
+    # Pyramids are built once per reducer, keep them out of both measurements
+    for layer in n_net.grid.layers:
+        layer.build_lod_pyramid("point")
+    viewports = create_zoom(n_net)
+    print(f"Synthetic net {n_net.total_width}x{n_net.total_height}, {ZOOM_EVENTS} scroll events, "
+          f"buffer {BUFFER_SIZE}x{BUFFER_SIZE}")
+    for prefetch in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, stale_events, built_bytes = bench(n_net, viewports, prefetch)
+        cache = n_net.tile_cache
+        print(f"prefetch {'on ' if prefetch else 'off'}: {len(latencies)} new frames, "
+              f"median {np.median(latencies):.1f} ms, max {max(latencies):.1f} ms, "
+              f"stale display frames {stale_events}, prefetched {built_bytes / 1024 / 1024:.0f} MB, "
+              f"prefetched tiles used {cache.prefetch_hits_count}")
+        if prefetch and (built_bytes == 0 or cache.prefetch_hits_count == 0):
+            print("No prefetched tile was used by a frame", file=sys.stderr)
+            sys.exit(1)
+        cache.prefetch_hits_count = 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares the per frame np.average path of NumpyAverageGrid with the cached reducer pyramids of NumpyGrid
+
+Run from the repository root:
+    python -m app.benchmark.bench_reducers
+"""
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net
+from app.gl.n_frame_producer import CancellationSignal
+from app.grid.lod_pyramid import REDUCERS
+from app.grid.numpy_average_grid import NumpyAverageGrid
+
+BUFFER_SIZE = 2560
+FACTORS = [2, 4, 8, 16, 32]
+REPEAT = 5
+SHAPES = [(2048, 2048)] * 8 + [(2048,)] * 8 + [(8192, 2048)] * 2
+
+
+def frame_bounds(n_net, factor):
+    x2 = min(n_net.total_width, BUFFER_SIZE * factor) // factor * factor
+    y2 = min(n_net.total_height, BUFFER_SIZE * factor) // factor * factor
+    return 0, 0, x2, y2
+
+
+def measure(func, repeat=REPEAT):
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return float(np.median(timings))
+
+
+def bench_average_grid(n_net, factor):
+    grid = NumpyAverageGrid()
+    grid.add_layers(n_net.grid.layers)
+    x1, y1, x2, y2 = frame_bounds(n_net, factor)
+
+    def frame():
+        # NumpyAverageGrid prints every chunk, keep the terminal out of the measurement
+        with contextlib.redirect_stdout(io.StringIO()):
+            grid.get_visible_layers(x1, y1, x2, y2)
+            grid.get_visible_data_chunks(x1, y1, x2, y2, factor, factor, True)
+
+    return measure(frame)
+
+
+def bench_reducer_grid(n_net, reducer, factor):
+    grid = n_net.grid
+    grid.set_reducer(reducer)
+    x1, y1, x2, y2 = frame_bounds(n_net, factor)
+    buffer = np.full((BUFFER_SIZE, BUFFER_SIZE), fill_value=-1, dtype=np.float32)
+
+    def frame():
+        grid.get_visible_layers(x1, y1, x2, y2)
+        grid.update_texture_buffer_with_visible_data_directly(x1, y1, x2, y2, factor, factor, buffer,
+                                                              CancellationSignal())
+
+    return measure(frame)
+
+
+def bench_pyramid_build(n_net, reducer):
+    # init_grid already built the pyramids of the default reducer, every reducer is timed from scratch
+    for layer in n_net.grid.layers:
+        layer.lod_levels.pop(reducer, None)
+    start_time = time.perf_counter()
+    for layer in n_net.grid.layers:
+        layer.build_lod_pyramid(reducer)
+    return (time.perf_counter() - start_time) * 1000
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_net(SHAPES)
+    print(f"Synthetic net: {len(SHAPES)} layers, {n_net.total_width}x{n_net.total_height}")
+
+    for reducer in REDUCERS:
+        print(f"Pyramid build [{reducer}]: {bench_pyramid_build(n_net, reducer):.1f} ms")
+
+    header = "factor".ljust(8) + "np.average".rjust(12) + "".join(r.rjust(12) for r in REDUCERS)
+    print(header)
+    for factor in FACTORS:
+        row = str(factor).ljust(8) + f"{bench_average_grid(n_net, factor):12.2f}"
+        for reducer in REDUCERS:
+            row += f"{bench_reducer_grid(n_net, reducer, factor):12.2f}"
+        print(row)
+    print("Frame times in ms, median of", REPEAT)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Visible layers and hover point lookup with LayerSpatialIndex compared to the linear scan over all layers
+
+Run from the repository root:
+    python -m app.benchmark.bench_spatial_index
+"""
+import time
+
+import numpy as np
+
+from app.grid.spatial_index import LayerSpatialIndex
+
+LAYERS_COUNT = 100000
+QUERIES_COUNT = 200
+VIEWPORT_WIDTHS = [1000, 100000, 10000000]
+POINT_LAYERS_COUNTS = [100, 10000, 100000]
+POINT_QUERIES_COUNT = 10000
+
+
+def rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
+    if x1 > grid_x2 or grid_x1 > x2:
+        return False
+    if y1 > grid_y2 or grid_y1 > y2:
+        return False
+    return True
+
+
+def linear_scan(bounds, x1, y1, x2, y2):
+    # The lookup used by the grids before the spatial index
+    visible = []
+    for index, (grid_x1, grid_y1, grid_x2, grid_y2) in enumerate(bounds):
+        if rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
+            visible.append(index)
+    return visible
+
+
+def create_strip_bounds(layers_count, seed=0):
+    # Left to right strip, same as NNet.init_grid
+    rng = np.random.default_rng(seed)
+    columns = rng.integers(1, 4096, layers_count)
+    rows = rng.integers(1, 4096, layers_count)
+    max_rows = rows.max()
+    x1 = np.concatenate(([0], np.cumsum(columns)[:-1])) + np.arange(layers_count) * layers_count
+    y1 = (max_rows - rows) // 2
+    return x1, y1, x1 + columns, y1 + rows
+
+
+def bench_point_lookup():
+    # Hover resolution should not depend on the number of layers
+    rng = np.random.default_rng(2)
+    for layers_count in POINT_LAYERS_COUNTS:
+        x1, y1, x2, y2 = create_strip_bounds(layers_count)
+        index = LayerSpatialIndex()
+        index.build_from_bounds(x1, y1, x2, y2)
+        xs = rng.integers(0, int(x2.max()), POINT_QUERIES_COUNT).tolist()
+        ys = rng.integers(0, int(y2.max()), POINT_QUERIES_COUNT).tolist()
+        start_time = time.perf_counter()
+        for x, y in zip(xs, ys):
+            index.find_point(x, y)
+        point_us = (time.perf_counter() - start_time) * 1000000 / POINT_QUERIES_COUNT
+        print(f"point lookup, {layers_count:>6} layers: {point_us:.2f} us")
+
+
+def main():
+    x1, y1, x2, y2 = create_strip_bounds(LAYERS_COUNT)
+    bounds = list(zip(x1.tolist(), y1.tolist(), x2.tolist(), y2.tolist()))
+    world_width = int(x2.max())
+    world_height = int(y2.max())
+
+    index = LayerSpatialIndex()
+    start_time = time.perf_counter()
+    index.build_from_bounds(x1, y1, x2, y2)
+    print(f"{LAYERS_COUNT} layers, world {world_width}x{world_height}, "
+          f"index built in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    rng = np.random.default_rng(1)
+    for viewport_width in VIEWPORT_WIDTHS:
+        starts = rng.integers(0, world_width, QUERIES_COUNT)
+        queries = [(int(s), 0, int(s) + viewport_width, world_height) for s in starts]
+
+        start_time = time.perf_counter()
+        linear_results = [linear_scan(bounds, *q) for q in queries[:10]]
+        linear_ms = (time.perf_counter() - start_time) * 1000 / 10
+
+        start_time = time.perf_counter()
+        index_results = [index.query(*q) for q in queries]
+        index_ms = (time.perf_counter() - start_time) * 1000 / QUERIES_COUNT
+
+        for linear, indexed in zip(linear_results, index_results):
+            assert linear == indexed.tolist(), "Spatial index result differs from the linear scan"
+        visible = np.mean([len(r) for r in index_results])
+        print(f"viewport width {viewport_width:>9}: linear {linear_ms:8.3f} ms, "
+              f"index {index_ms:8.4f} ms, visible layers {visible:.1f}")
+
+    bench_point_lookup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Grid backend benchmark suite, synthetic models replayed through NNet along viewport traces, results as JSON
+
+Each (model, backend) case runs in its own process, so the peak RSS is the peak of that case alone.
+Every viewport of the trace goes through NViewport like in the application, a frame is built synchronously
+whenever the viewport leaves the current one. The trace is the scripted session of create_scripted_trace
+unless recorded traces are given (ViewportTrace files).
+
+Reported per case:
+- frame build latency p50 / p95 / p99 / max in ms, the first pass over the trace loads layers, builds pyramids
+  and compiles kernels, it is reported separately as warmup
+- bytes touched per frame, layer cells copied into the frame times the layer item size plus the frame cells
+  written, an estimate of the memory traffic of a point sampled frame
+- peak RSS of the case process
+
+The native backends (eigen, xtensor) need the mylittlenet module, they are reported as unavailable without it.
+
+Run from the repository root:
+    python -m app.benchmark.bench_suite --output bench_suite.json
+    python -m app.benchmark.bench_suite --models llm_1b --scale 4 --backends numpy numba --trace trace.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import SYNTHETIC_MODELS, create_synthetic_model_net, create_scripted_trace, \
+    get_parameters_count
+from app.gl.n_frame_producer import FrameData
+from app.gl.n_texture_format import EMPTY_VALUE
+from app.gl.n_viewport import NViewport
+from app.gl.n_viewport_trace import ViewportTrace
+from app.grid import n_grid
+
+SUITE_VERSION = 1
+BACKENDS = {
+    "numpy": n_grid.NUMPY,
+    "numpy_average": n_grid.NUMPY_AVERAGE,
+    "numba": n_grid.NUMBA,
+    "eigen": n_grid.EIGEN,
+    "xtensor": n_grid.XTENSOR,
+}
+NATIVE_BACKENDS = ["eigen", "xtensor"]
+# Same as the default config
+BUFFER_SIZE = 1500
+REDUCER = "point"
+# Synthetic layers are float32
+LAYER_ITEM_SIZE = 4
+PERCENTILES = [50, 95, 99]
+
+
+class SynchronousFrameBuilder:
+    """
+    Frame producer for NViewport that builds each frame right away and records its build time
+    """
+
+    def __init__(self, n_buffer):
+        self.n_buffer = n_buffer
+        self.buffer = np.empty((n_buffer.buffer_width, n_buffer.buffer_height), dtype=np.float32)
+        self.timings = []
+        self.bytes_touched = []
+
+    def invalidate(self):
+        pass
+
+    def create_frame(self, visible_grid):
+        frame = FrameData(self.n_buffer.buffer_width, self.n_buffer.buffer_height, visible_grid)
+        start_time = time.perf_counter()
+        frame.load(self.buffer)
+        self.timings.append((time.perf_counter() - start_time) * 1000)
+        self.bytes_touched.append(get_bytes_touched(visible_grid, self.buffer))
+
+
+def get_bytes_touched(visible_grid, buffer):
+    rows = min(visible_grid.fy2 - visible_grid.fy1, buffer.shape[0])
+    cols = min(visible_grid.fx2 - visible_grid.fx1, buffer.shape[1])
+    frame_cells = buffer[:rows, :cols]
+    data_cells = int(np.count_nonzero(frame_cells != EMPTY_VALUE))
+    return data_cells * LAYER_ITEM_SIZE + frame_cells.size * buffer.itemsize
+
+
+def summarize_timings(timings):
+    if len(timings) == 0:
+        return None
+    summary = {f"p{percentile}": float(np.percentile(timings, percentile)) for percentile in PERCENTILES}
+    summary["max"] = float(np.max(timings))
+    summary["mean"] = float(np.mean(timings))
+    return summary
+
+
+def is_backend_available(backend):
+    if backend in NATIVE_BACKENDS:
+        return importlib.util.find_spec("mylittlenet") is not None
+    return True
+
+
+def replay(n_net, trace, passes):
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE,
+                               viewport_width=BUFFER_SIZE / 2, viewport_height=BUFFER_SIZE / 2)
+    frame_builder = SynchronousFrameBuilder(n_buffer)
+    n_viewport = NViewport(n_net, n_buffer, frame_builder)
+    n_viewport.set_grid_size(n_net.total_width, n_net.total_height)
+    pass_frames = []
+    for _ in range(passes):
+        # Each pass starts from an empty screen, like a new session
+        n_viewport.invalidate()
+        frames_count = len(frame_builder.timings)
+        for _, viewport in trace.events:
+            n_viewport.update_viewport(viewport)
+        pass_frames.append(len(frame_builder.timings) - frames_count)
+    return frame_builder, pass_frames
+
+
+def run_case(model_name, scale, backend, traces, passes, tile_cache_mb):
+    """
+    One model and one backend, runs in its own process
+    """
+    result = {"model": model_name, "scale": scale, "backend": backend}
+    if not is_backend_available(backend):
+        result["status"] = "unavailable"
+        result["error"] = "mylittlenet is not installed"
+        return result
+    n_grid.CURRENT_GRID = BACKENDS[backend]
+    try:
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_net = create_synthetic_model_net(model_name, scale)
+            n_net.set_reducer(REDUCER)
+            n_net.set_tile_cache_budget(tile_cache_mb * 1024 * 1024)
+        result["net_init_ms"] = (time.perf_counter() - start_time) * 1000
+        result["grid"] = type(n_net.grid).__name__
+        result["layers_count"] = len(n_net.grid.layers)
+        result["total_width"] = n_net.total_width
+        result["total_height"] = n_net.total_height
+        if not hasattr(n_net.grid, "update_texture_buffer_with_visible_data_directly"):
+            result["status"] = "unsupported"
+            result["error"] = f"{result['grid']} does not build frames into the texture buffer"
+            return result
+
+        result["traces"] = []
+        for trace in traces:
+            if trace is None:
+                trace = create_scripted_trace(n_net, BUFFER_SIZE / 2, BUFFER_SIZE / 2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                frame_builder, pass_frames = replay(n_net, trace, passes)
+            warmup_frames = pass_frames[0] if passes > 1 else 0
+            timings = frame_builder.timings[warmup_frames:]
+            bytes_touched = frame_builder.bytes_touched[warmup_frames:]
+            result["traces"].append({
+                "trace": trace.name,
+                "events": len(trace.events),
+                "passes": passes,
+                "frames": len(timings),
+                "warmup_frames": warmup_frames,
+                "warmup_ms": summarize_timings(frame_builder.timings[:warmup_frames]),
+                "frame_build_ms": summarize_timings(timings),
+                "bytes_touched_per_frame": float(np.mean(bytes_touched)) if len(bytes_touched) > 0 else 0.0,
+                "bytes_touched_total": int(np.sum(bytes_touched)),
+            })
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = repr(e)
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result
+
+
+def print_case(result):
+    if result["status"] != "ok":
+        print(f"{result['model']:>10} {result['backend']:>13}: {result['status']}, {result.get('error')}",
+              file=sys.stderr)
+        return
+    for trace_result in result["traces"]:
+        latency = trace_result["frame_build_ms"] or {}
+        print(f"{result['model']:>10} {result['backend']:>13} [{trace_result['trace']}]: "
+              f"{trace_result['frames']} frames, p50 {latency.get('p50', 0):.2f} ms, "
+              f"p95 {latency.get('p95', 0):.2f} ms, p99 {latency.get('p99', 0):.2f} ms, "
+              f"{trace_result['bytes_touched_per_frame'] / 1024 / 1024:.1f} MB per frame, "
+              f"peak RSS {result['peak_rss_bytes'] / 1024 / 1024:.0f} MB", file=sys.stderr)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Grid backend benchmark suite")
+    parser.add_argument("--models", nargs="+", default=list(SYNTHETIC_MODELS), choices=list(SYNTHETIC_MODELS))
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--scale", type=int, default=1,
+                        help="divides the hidden sizes of the models, llm_1b needs about 5 GB at scale 1")
+    parser.add_argument("--trace", nargs="+", default=None, help="recorded viewport trace files")
+    parser.add_argument("--passes", type=int, default=3, help="passes over each trace, the first one is warmup")
+    parser.add_argument("--tile-cache-mb", type=int, default=0, help="0 reads every frame from the grid")
+    parser.add_argument("--output", default=None, help="JSON file, printed to stdout when not set")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    traces = [None] if arguments.trace is None else [ViewportTrace.load(path) for path in arguments.trace]
+    report = {
+        "version": SUITE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "settings": {
+            "buffer_size": BUFFER_SIZE,
+            "reducer": REDUCER,
+            "scale": arguments.scale,
+            "passes": arguments.passes,
+            "tile_cache_mb": arguments.tile_cache_mb,
+        },
+        "models": {model_name: get_parameters_count(model_name, arguments.scale) for model_name in arguments.models},
+        "results": [],
+    }
+    for model_name in arguments.models:
+        for backend in arguments.backends:
+            # New process per case, nothing is shared between the cases and the peak RSS is their own
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(run_case, model_name, arguments.scale, backend, traces,
+                                         arguments.passes, arguments.tile_cache_mb).result()
+            print_case(result)
+            report["results"].append(result)
+
+    if arguments.output is None:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=4)
+        print("Results written to", arguments.output, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
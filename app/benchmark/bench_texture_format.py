@@ -0,0 +1,107 @@
+"""
+Frames built in each texture format over a synthetic net, texture size and build time,
+and the color map entries the shader picks compared to the float32 frames (visual diff)
+
+A pan at the same factor is included, shifted quantized frames keep the value range of the previous frame.
+Exits with status 1 when a format changes which cells are empty or picks a color more than
+MAX_COLOR_INDEX_DIFFERENCE entries away from the float32 frames.
+
+Run from the repository root:
+    python -m app.benchmark.bench_texture_format
+"""
+import contextlib
+import io
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net
+from app.gl.n_frame_producer import NFrameProducer
+from app.gl.n_texture_format import TEXTURE_FORMATS, COLOR_MULTIPLIER, EMPTY_VALUE, decode_values
+from app.gl.n_viewport import VisibleGrid
+from app.grid.n_layout import SQUARE
+
+BUFFER_SIZE = 2560
+# Colors of NColorTheme.color_array
+COLOR_MAP_SIZE = 255
+PAN_STEP = 256
+# One color map entry, rounding of float16 and 8 bit values
+MAX_COLOR_INDEX_DIFFERENCE = 1
+SHAPES = [(4096, 4096)] * 4 + [(4096, 1024)] * 16 + [(4096,)] * 16
+
+
+def create_views(n_net):
+    views = []
+    for factor in (1, 4, 16):
+        size = BUFFER_SIZE * factor
+        views.append(VisibleGrid(0, 0, size, size, 0, factor, 1, n_net))
+        # Pan, the frame is shifted from the previous one
+        views.append(VisibleGrid(PAN_STEP * factor, 0, size + PAN_STEP * factor, size, 0, factor, 1, n_net))
+    return views
+
+
+def get_color_indices(values):
+    # Color map entry of the color map shader, -1 for the empty cells
+    indices = np.rint(np.clip(values * COLOR_MULTIPLIER, 0, 1) * (COLOR_MAP_SIZE - 1)).astype(np.int32)
+    indices[values == EMPTY_VALUE] = -1
+    return indices
+
+
+def build_frames(texture_format, views):
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE)
+    producer = NFrameProducer(n_buffer)
+    producer.set_texture_format(texture_format.name)
+    frames = []
+    timings = []
+    for visible_grid in views:
+        start_time = time.perf_counter()
+        producer.create_frame(visible_grid)
+        frame = producer.get_current_frame()
+        while not frame.ready:
+            time.sleep(0.0005)
+        timings.append((time.perf_counter() - start_time) * 1000)
+        frames.append(get_color_indices(decode_values(frame.texture_data, frame.value_range)))
+    shifted_count = producer.shifted_frames_count
+    producer.shutdown()
+    return frames, float(np.median(timings)), shifted_count
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_net(SHAPES)
+        n_net.set_layout(SQUARE)
+        n_net.relayout()
+    n_net.set_reducer("point")
+    for layer in n_net.grid.layers:
+        layer.build_lod_pyramid("point")
+    views = create_views(n_net)
+    print(f"Synthetic net {n_net.total_width}x{n_net.total_height}, buffer {BUFFER_SIZE}x{BUFFER_SIZE}, "
+          f"{len(views)} frames")
+
+    reference = None
+    failures = []
+    for texture_format in TEXTURE_FORMATS.values():
+        with contextlib.redirect_stdout(io.StringIO()):
+            frames, frame_ms, shifted_count = build_frames(texture_format, views)
+        if reference is None:
+            reference = frames
+        texture_mb = texture_format.get_texture_bytes(BUFFER_SIZE, BUFFER_SIZE) / 1024 / 1024
+        differences = [np.abs(frame - expected) for frame, expected in zip(frames, reference)]
+        max_difference = max(int(difference.max()) for difference in differences)
+        changed = np.mean([np.count_nonzero(difference) / difference.size for difference in differences])
+        empty_mismatches = sum(int(np.count_nonzero((frame == -1) != (expected == -1)))
+                               for frame, expected in zip(frames, reference))
+        print(f"{texture_format.name:>7}: texture {texture_mb:.1f} MB x 2, median frame {frame_ms:.1f} ms, "
+              f"shifted {shifted_count}, color index max diff {max_difference}, "
+              f"changed pixels {changed * 100:.3f} %, empty mismatches {empty_mismatches}")
+        if max_difference > MAX_COLOR_INDEX_DIFFERENCE or empty_mismatches > 0:
+            failures.append(texture_format.name)
+    if len(failures) > 0:
+        print(f"Visual diff failed for {', '.join(failures)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
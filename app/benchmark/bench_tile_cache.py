@@ -0,0 +1,94 @@
+"""
+Zooming back and forth between two factors and panning between two regions,
+frames read from the grid directly compared to frames assembled from cached tiles
+
+Tiles are built either while the frame is built, or deferred: the frame is read from the grid directly and
+its missing tiles are built between the frames, like NPrefetcher does while no frame is being built.
+Two nets: a few large layers (the worst case for tiles, every frame is one copy per layer) and the
+layers of a synthetic BERT base.
+
+Run from the repository root:
+    python -m app.benchmark.bench_tile_cache
+"""
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net, create_synthetic_model_net
+from app.gl.n_frame_producer import CancellationSignal
+from app.grid.n_layout import SQUARE
+from app.grid.tile_cache import DEFAULT_TILE_CACHE_BUDGET
+
+BUFFER_SIZE = 2560
+ROUNDS = 6
+SHAPES = [(4096, 4096)] * 4 + [(4096, 1024)] * 16 + [(4096,)] * 16
+
+
+def create_views(n_net):
+    # (x1, y1, factor) pairs visited in turn
+    far_x = n_net.total_width // 2 // 8 * 8
+    return [(0, 0, 2), (0, 0, 8), (far_x, 0, 2), (far_x, 0, 8)]
+
+
+def build_frame(n_net, view, buffer):
+    x1, y1, factor = view
+    x2 = min(n_net.total_width, x1 + BUFFER_SIZE * factor) // factor * factor
+    y2 = min(n_net.total_height, y1 + BUFFER_SIZE * factor) // factor * factor
+    buffer.fill(-1)
+    start_time = time.perf_counter()
+    n_net.update_tex_buffer_directly(x1, y1, x2, y2, factor, buffer, CancellationSignal())
+    return (time.perf_counter() - start_time) * 1000
+
+
+def bench(n_net, budget_bytes, deferred=False):
+    n_net.set_tile_cache_budget(budget_bytes)
+    n_net.set_tile_build_deferred(deferred)
+    n_net.tile_cache.clear()
+    buffer = np.empty((BUFFER_SIZE, BUFFER_SIZE), dtype=np.float32)
+    views = create_views(n_net)
+    first_visit = []
+    revisits = []
+    for round_index in range(ROUNDS):
+        for view in views:
+            with contextlib.redirect_stdout(io.StringIO()):
+                frame_ms = build_frame(n_net, view, buffer)
+                # Idle time between the frames
+                n_net.build_pending_tiles(CancellationSignal())
+            (first_visit if round_index == 0 else revisits).append(frame_ms)
+    return float(np.median(first_visit)), float(np.median(revisits))
+
+
+def create_nets():
+    with contextlib.redirect_stdout(io.StringIO()):
+        large_layers_net = create_synthetic_net(SHAPES)
+        model_net = create_synthetic_model_net("bert_base")
+    for n_net in (large_layers_net, model_net):
+        n_net.set_layout(SQUARE)
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_net.relayout()
+    return [("large layers", large_layers_net), ("bert_base", model_net)]
+
+
+def main():
+    for net_name, n_net in create_nets():
+        print(f"{net_name}: {len(n_net.grid.layers)} layers, net {n_net.total_width}x{n_net.total_height}, "
+              f"buffer {BUFFER_SIZE}x{BUFFER_SIZE}")
+        for reducer in ["point", "mean"]:
+            n_net.set_reducer(reducer)
+            # Pyramids are built once per reducer, keep them out of all the measurements
+            for layer in n_net.grid.layers:
+                layer.build_lod_pyramid(reducer)
+            direct_first, direct_revisit = bench(n_net, 0)
+            print(f"[{reducer}]   direct: first visit {direct_first:.2f} ms, revisit {direct_revisit:.2f} ms")
+            for deferred in (False, True):
+                tiles_first, tiles_revisit = bench(n_net, DEFAULT_TILE_CACHE_BUDGET, deferred)
+                cache = n_net.tile_cache
+                print(f"[{reducer}] {'deferred' if deferred else '   tiles'}: first visit {tiles_first:.2f} ms, "
+                      f"revisit {tiles_revisit:.2f} ms, {len(cache.tiles)} tiles, "
+                      f"{cache.total_bytes / 1024 / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Frame build time of NumpyGrid on a full 2560x2560 buffer with 1 to 8 tile workers
+
+Run from the repository root:
+    python -m app.benchmark.bench_tiles
+"""
+import contextlib
+import io
+import os
+import time
+
+import numpy as np
+
+from app.benchmark.synthetic import create_synthetic_net
+from app.gl.n_frame_producer import CancellationSignal
+from app.grid.n_layout import SQUARE
+
+BUFFER_SIZE = 2560
+FACTORS = [1, 2, 4]
+WORKERS_COUNTS = [1, 2, 4, 8]
+REPEAT = 7
+SHAPES = [(4096, 4096)] * 4 + [(4096, 1024)] * 16 + [(4096,)] * 16
+
+
+def measure_frame(grid, x1, y1, x2, y2, factor, buffer):
+    timings = []
+    for _ in range(REPEAT):
+        start_time = time.perf_counter()
+        grid.update_texture_buffer_with_visible_data_directly(x1, y1, x2, y2, factor, factor, buffer,
+                                                              CancellationSignal())
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return float(np.median(timings))
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_synthetic_net(SHAPES)
+        n_net.set_layout(SQUARE)
+        n_net.relayout()
+    grid = n_net.grid
+    print(f"Synthetic net {n_net.total_width}x{n_net.total_height}, {os.cpu_count()} cpus")
+    buffer = np.full((BUFFER_SIZE, BUFFER_SIZE), fill_value=-1, dtype=np.float32)
+
+    print("factor".ljust(8) + "".join(f"{count} workers".rjust(12) for count in WORKERS_COUNTS) + "speedup".rjust(10))
+    for factor in FACTORS:
+        x2 = min(n_net.total_width, BUFFER_SIZE * factor) // factor * factor
+        y2 = min(n_net.total_height, BUFFER_SIZE * factor) // factor * factor
+        grid.get_visible_layers(0, 0, x2, y2)
+        # Pyramids are built on the first frame, keep them out of the measurement
+        measure_frame(grid, 0, 0, x2, y2, factor, buffer)
+        timings = []
+        for workers_count in WORKERS_COUNTS:
+            grid.set_tile_workers_count(workers_count)
+            timings.append(measure_frame(grid, 0, 0, x2, y2, factor, buffer))
+        print(str(factor).ljust(8) + "".join(f"{t:12.2f}" for t in timings) + f"{timings[0] / min(timings):10.2f}")
+    print("Frame times in ms, median of", REPEAT)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Headless replay of a viewport trace through NViewport and NFrameProducer, no window and no GL context
+
+Viewports are fed to NViewport at the times they were recorded, --speed 2 replays twice as fast and
+--speed 0 feeds them back to back. Frames are built by the frame workers like in the application,
+a frame still being built when the viewport moves on is canceled.
+
+Reported: frames requested, completed (ready before they were replaced), canceled, dropped from the queue
+without being built, shifted from the previous frame, and the time from request to ready.
+
+Traces are recorded in the application with the T key, the scripted trace of create_scripted_trace is replayed
+when no trace is given. The net is a synthetic model or a layer store written by the application.
+
+Run from the repository root:
+    python -m app.benchmark.replay_trace --model bert_base
+    python -m app.benchmark.replay_trace ~/.cache/mylittlenet/viewport_traces/viewport_trace_<time>.json \
+        --layer-store ~/.cache/mylittlenet/layer_store/<model> --frame-backend process
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.benchmark.synthetic import SYNTHETIC_MODELS, create_synthetic_model_net, create_scripted_trace
+from app.gl.n_frame_process import FrameProcessPool, FRAME_BACKEND_PROCESS, FRAME_BACKEND_THREAD
+from app.gl.n_frame_producer import NFrameProducer
+from app.gl.n_net import NNet
+from app.gl.n_texture_format import TEXTURE_FORMATS, TEXTURE_FORMAT_FLOAT32
+from app.gl.n_viewport import NViewport
+from app.gl.n_viewport_trace import ViewportTrace
+from app.grid.layer_store import LayerStore
+
+# Same as the default config
+BUFFER_SIZE = 1500
+REDUCER = "point"
+# Seconds to wait for the last frame of the trace
+LAST_FRAME_TIMEOUT = 60
+
+
+class TraceReplay:
+    """
+    Feeds the viewports of a trace to NViewport and follows every frame the producer creates
+    """
+
+    def __init__(self, n_net, n_frame_producer, n_buffer):
+        self.n_net = n_net
+        self.n_frame_producer = n_frame_producer
+        self.n_viewport = NViewport(n_net, n_buffer, n_frame_producer)
+        self.n_viewport.set_grid_size(n_net.total_width, n_net.total_height)
+        self.frames = []
+
+    def _follow_current_frame(self):
+        frame = self.n_frame_producer.get_current_frame()
+        if frame is not None and (len(self.frames) == 0 or self.frames[-1] is not frame):
+            self.frames.append(frame)
+
+    def run(self, trace, speed=1.0):
+        start_time = time.perf_counter()
+        trace_start = trace.events[0][0] if len(trace.events) > 0 else 0.0
+        for event_time, viewport in trace.events:
+            if speed > 0:
+                delay = (event_time - trace_start) / speed - (time.perf_counter() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+            self.n_viewport.update_viewport(viewport)
+            self._follow_current_frame()
+        replay_time = time.perf_counter() - start_time
+
+        timed_out = False
+        if len(self.frames) > 0:
+            last_frame = self.frames[-1]
+            wait_start = time.perf_counter()
+            while not last_frame.ready:
+                if time.perf_counter() - wait_start > LAST_FRAME_TIMEOUT:
+                    timed_out = True
+                    break
+                time.sleep(0.001)
+        return self.get_results(trace, replay_time, timed_out)
+
+    def get_results(self, trace, replay_time, timed_out):
+        ready_ms = [(frame.ready_time - frame.created_time) * 1000 for frame in self.frames
+                    if frame.ready_time is not None]
+        completed_count = len(ready_ms)
+        results = {
+            "trace": trace.name,
+            "events": len(trace.events),
+            "trace_duration_s": trace.get_duration(),
+            "replay_duration_s": replay_time,
+            "frames_requested": len(self.frames),
+            "frames_completed": completed_count,
+            "frames_canceled": len(self.frames) - completed_count,
+            "frames_dropped": self.n_frame_producer.worker_pool.dropped_count,
+            "frames_shifted": self.n_frame_producer.shifted_frames_count,
+            "last_frame_timed_out": timed_out,
+            "time_to_ready_ms": None,
+        }
+        if completed_count > 0:
+            results["time_to_ready_ms"] = {
+                "p50": float(np.percentile(ready_ms, 50)),
+                "p95": float(np.percentile(ready_ms, 95)),
+                "max": float(np.max(ready_ms)),
+                "mean": float(np.mean(ready_ms)),
+            }
+        return results
+
+
+def create_net(arguments):
+    if arguments.layer_store is not None:
+        n_net = NNet(None, None)
+        n_net.init_from_layer_store(LayerStore(arguments.layer_store).open())
+    else:
+        n_net = create_synthetic_model_net(arguments.model, arguments.scale)
+    n_net.set_reducer(REDUCER)
+    n_net.set_tile_cache_budget(arguments.tile_cache_mb * 1024 * 1024)
+    return n_net
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Headless viewport trace replay")
+    parser.add_argument("trace", nargs="?", default=None, help="recorded viewport trace, scripted trace when not set")
+    parser.add_argument("--model", default="bert_base", choices=list(SYNTHETIC_MODELS))
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--layer-store", default=None, help="layer store path without extension, replaces --model")
+    parser.add_argument("--speed", type=float, default=1.0, help="0 feeds the viewports back to back")
+    parser.add_argument("--texture-format", default=TEXTURE_FORMAT_FLOAT32, choices=list(TEXTURE_FORMATS))
+    parser.add_argument("--frame-backend", default=FRAME_BACKEND_THREAD,
+                        choices=[FRAME_BACKEND_THREAD, FRAME_BACKEND_PROCESS])
+    parser.add_argument("--tile-cache-mb", type=int, default=512, help="0 reads every frame from the grid")
+    parser.add_argument("--output", default=None, help="JSON file with the results")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_net = create_net(arguments)
+    if arguments.trace is not None:
+        trace = ViewportTrace.load(arguments.trace)
+    else:
+        trace = create_scripted_trace(n_net, BUFFER_SIZE / 2, BUFFER_SIZE / 2)
+
+    n_buffer = SimpleNamespace(buffer_width=BUFFER_SIZE, buffer_height=BUFFER_SIZE,
+                               viewport_width=BUFFER_SIZE / 2, viewport_height=BUFFER_SIZE / 2)
+    n_frame_producer = NFrameProducer(n_buffer)
+    n_frame_producer.set_texture_format(arguments.texture_format)
+    if arguments.frame_backend == FRAME_BACKEND_PROCESS:
+        # Only nets read from a layer store are built in the processes
+        n_frame_producer.set_frame_process_pool(
+            FrameProcessPool(tile_cache_budget=arguments.tile_cache_mb * 1024 * 1024))
+    print(f"Net {n_net.total_width}x{n_net.total_height}, {len(n_net.grid.layers)} layers, "
+          f"trace {trace.name} with {len(trace.events)} viewports over {trace.get_duration():.1f} s")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = TraceReplay(n_net, n_frame_producer, n_buffer).run(trace, arguments.speed)
+        n_frame_producer.shutdown()
+
+    time_to_ready = results["time_to_ready_ms"] or {}
+    print(f"Frames requested {results['frames_requested']}, completed {results['frames_completed']}, "
+          f"canceled {results['frames_canceled']} (dropped {results['frames_dropped']}), "
+          f"shifted {results['frames_shifted']}")
+    print(f"Time to ready p50 {time_to_ready.get('p50', 0):.1f} ms, p95 {time_to_ready.get('p95', 0):.1f} ms, "
+          f"max {time_to_ready.get('max', 0):.1f} ms, replay {results['replay_duration_s']:.1f} s")
+    if results["last_frame_timed_out"]:
+        print("Last frame was not ready after", LAST_FRAME_TIMEOUT, "s", file=sys.stderr)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=4)
+        print("Results written to", arguments.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+from functools import partial
+
+import numpy as np
+
+from app.gl.n_net import NNet
+from app.gl.n_viewport_trace import ViewportTrace
+
+# Seconds between the events of the scripted traces, one viewport per rendered frame
+TRACE_EVENT_INTERVAL = 1 / 60
+TRACE_ZOOM_STEPS = 24
+TRACE_PAN_STEPS = 24
+
+
+def create_synthetic_arrays(shapes, seed=0):
+    """
+    Random float32 layers with the given shapes, normal distribution similar to trained weights
+    """
+    rng = np.random.default_rng(seed)
+    return [rng.standard_normal(shape, dtype=np.float32) * 0.02 for shape in shapes]
+
+
+def create_synthetic_net(shapes, seed=0):
+    """
+    Headless NNet (no window, no color theme) initialized with synthetic layers
+    """
+    n_net = NNet(None, None)
+    arrays = create_synthetic_arrays(shapes, seed)
+    n_net.init_from_np_arrays(arrays, [f"synthetic_{index}" for index in range(len(arrays))])
+    return n_net
+
+
+def get_tiny_mlp_layers(scale=1):
+    # MNIST sized MLP, 784 -> 512 -> 256 -> 10
+    sizes = [784] + [max(1, size // scale) for size in (512, 256)] + [10]
+    layers = []
+    for index, (inputs, outputs) in enumerate(zip(sizes[:-1], sizes[1:])):
+        layers.append((f"layers.{index}.weight", (outputs, inputs)))
+        layers.append((f"layers.{index}.bias", (outputs,)))
+    return layers
+
+
+def get_bert_base_layers(scale=1):
+    # bert-base-uncased, 110M parameters
+    hidden = max(1, 768 // scale)
+    intermediate = max(1, 3072 // scale)
+    layers = [("embeddings.word_embeddings.weight", (max(1, 30522 // scale), hidden)),
+              ("embeddings.position_embeddings.weight", (512, hidden)),
+              ("embeddings.token_type_embeddings.weight", (2, hidden)),
+              ("embeddings.LayerNorm.weight", (hidden,))]
+    for index in range(12):
+        prefix = f"encoder.layer.{index}"
+        for name in ("attention.self.query", "attention.self.key", "attention.self.value", "attention.output.dense"):
+            layers.append((f"{prefix}.{name}.weight", (hidden, hidden)))
+            layers.append((f"{prefix}.{name}.bias", (hidden,)))
+        layers.append((f"{prefix}.attention.output.LayerNorm.weight", (hidden,)))
+        layers.append((f"{prefix}.intermediate.dense.weight", (intermediate, hidden)))
+        layers.append((f"{prefix}.intermediate.dense.bias", (intermediate,)))
+        layers.append((f"{prefix}.output.dense.weight", (hidden, intermediate)))
+        layers.append((f"{prefix}.output.dense.bias", (hidden,)))
+        layers.append((f"{prefix}.output.LayerNorm.weight", (hidden,)))
+    layers.append(("pooler.dense.weight", (hidden, hidden)))
+    return layers
+
+
+def get_llm_1b_layers(scale=1):
+    # TinyLlama-1.1B, grouped query attention with 4 key value heads, 1.1B parameters
+    hidden = max(1, 2048 // scale)
+    key_value = max(1, 256 // scale)
+    intermediate = max(1, 5632 // scale)
+    vocabulary = max(1, 32000 // scale)
+    layers = [("model.embed_tokens.weight", (vocabulary, hidden))]
+    for index in range(22):
+        prefix = f"model.layers.{index}"
+        layers.append((f"{prefix}.self_attn.q_proj.weight", (hidden, hidden)))
+        layers.append((f"{prefix}.self_attn.k_proj.weight", (key_value, hidden)))
+        layers.append((f"{prefix}.self_attn.v_proj.weight", (key_value, hidden)))
+        layers.append((f"{prefix}.self_attn.o_proj.weight", (hidden, hidden)))
+        layers.append((f"{prefix}.mlp.gate_proj.weight", (intermediate, hidden)))
+        layers.append((f"{prefix}.mlp.up_proj.weight", (intermediate, hidden)))
+        layers.append((f"{prefix}.mlp.down_proj.weight", (hidden, intermediate)))
+        layers.append((f"{prefix}.input_layernorm.weight", (hidden,)))
+        layers.append((f"{prefix}.post_attention_layernorm.weight", (hidden,)))
+    layers.append(("model.norm.weight", (hidden,)))
+    layers.append(("lm_head.weight", (vocabulary, hidden)))
+    return layers
+
+
+# Layer names and shapes of real architectures, scale divides the hidden sizes to fit smaller machines
+SYNTHETIC_MODELS = {
+    "tiny_mlp": get_tiny_mlp_layers,
+    "bert_base": get_bert_base_layers,
+    "llm_1b": get_llm_1b_layers,
+}
+
+
+def create_synthetic_layer(shape, seed, index):
+    # Same data for the same layer every time it is loaded
+    rng = np.random.default_rng((seed, index))
+    return rng.standard_normal(shape, dtype=np.float32) * 0.02
+
+
+def create_synthetic_model_net(model_name, scale=1, seed=0):
+    """
+    Headless NNet with the layers of a synthetic model
+    Layers are lazy like the layers of a loaded model, the data is generated when the grid reads a layer.
+    """
+    layers = SYNTHETIC_MODELS[model_name](scale)
+    named_layers = [(name, shape, partial(create_synthetic_layer, shape, seed, index))
+                    for index, (name, shape) in enumerate(layers)]
+    n_net = NNet(None, None)
+    n_net.init_from_named_layers(model_name, named_layers)
+    return n_net
+
+
+def get_parameters_count(model_name, scale=1):
+    return sum(int(np.prod(shape)) for _, shape in SYNTHETIC_MODELS[model_name](scale))
+
+
+def create_scripted_trace(n_net, viewport_width, viewport_height, name="scripted"):
+    """
+    Viewport trace of a typical session: whole model, zoom into the center down to factor 1,
+    pan to the right, then zoom out again. Viewports have the aspect ratio of the screen buffer.
+    """
+    trace = ViewportTrace(name)
+    aspect_ratio = viewport_width / viewport_height
+    overview_width = max(n_net.total_width, n_net.total_height * aspect_ratio) * 1.2
+    closest_width = min(viewport_width, overview_width)
+    center_x = n_net.total_width / 2
+    center_y = n_net.total_height / 2
+    widths = np.geomspace(overview_width, closest_width, TRACE_ZOOM_STEPS).tolist()
+    viewports = [(center_x, width) for width in widths]
+    pan_step = closest_width / 8
+    viewports += [(center_x + pan_step * (step + 1), closest_width) for step in range(TRACE_PAN_STEPS)]
+    viewports += [(viewports[-1][0], width) for width in reversed(widths)]
+    for index, (x, width) in enumerate(viewports):
+        height = width / aspect_ratio
+        trace.add(index * TRACE_EVENT_INTERVAL, (x - width / 2, center_y - height / 2, width, height,
+                                                 viewport_width / width))
+    return trace
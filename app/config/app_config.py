@@ -15,6 +15,23 @@ class LittleConfig:
         self.window_width = None
         self.window_height = None
         self.show_weights = True
+        self.lod_reducer = "point"
+        self.layout_type = 0
+        self.layer_store_enabled = True
+        self.layer_store_dtype = "float32"
+        self.lazy_model_loading = True
+        self.layer_memory_budget_mb = 2048
+        self.tile_cache_mb = 512
+        self.prefetch_enabled = True
+        self.prefetch_mb = 128
+        self.frame_backend = "thread"
+        self.max_fps = 60
+        self.idle_redraw_interval = 0.5
+        self.texture_format = "float32"
+        self.profiler_enabled = False
+        self.log_level = "INFO"
+        self.log_rate_limit = 1.0
+        self.memory_monitor_interval = 1.0
         self.filename = "config.json"
 
     def load_config(self):
@@ -36,6 +53,24 @@ class LittleConfig:
                 self.window_width = config_data.get('window_width')
                 self.window_height = config_data.get('window_height')
                 self.show_weights = config_data.get('show_weights')
+                self.lod_reducer = config_data.get('lod_reducer', self.lod_reducer)
+                self.layout_type = config_data.get('layout_type', self.layout_type)
+                self.layer_store_enabled = config_data.get('layer_store_enabled', self.layer_store_enabled)
+                self.layer_store_dtype = config_data.get('layer_store_dtype', self.layer_store_dtype)
+                self.lazy_model_loading = config_data.get('lazy_model_loading', self.lazy_model_loading)
+                self.layer_memory_budget_mb = config_data.get('layer_memory_budget_mb', self.layer_memory_budget_mb)
+                self.tile_cache_mb = config_data.get('tile_cache_mb', self.tile_cache_mb)
+                self.prefetch_enabled = config_data.get('prefetch_enabled', self.prefetch_enabled)
+                self.prefetch_mb = config_data.get('prefetch_mb', self.prefetch_mb)
+                self.frame_backend = config_data.get('frame_backend', self.frame_backend)
+                self.max_fps = config_data.get('max_fps', self.max_fps)
+                self.idle_redraw_interval = config_data.get('idle_redraw_interval', self.idle_redraw_interval)
+                self.texture_format = config_data.get('texture_format', self.texture_format)
+                self.profiler_enabled = config_data.get('profiler_enabled', self.profiler_enabled)
+                self.log_level = config_data.get('log_level', self.log_level)
+                self.log_rate_limit = config_data.get('log_rate_limit', self.log_rate_limit)
+                self.memory_monitor_interval = config_data.get('memory_monitor_interval',
+                                                               self.memory_monitor_interval)
 
         except FileNotFoundError:
             print(f"Error: {file_path} not found.")
@@ -54,7 +89,24 @@ class LittleConfig:
             'gui_state_config': self.gui_state_config,
             'window_width': self.window_width,
             'window_height': self.window_height,
-            'show_weights': self.show_weights
+            'show_weights': self.show_weights,
+            'lod_reducer': self.lod_reducer,
+            'layout_type': self.layout_type,
+            'layer_store_enabled': self.layer_store_enabled,
+            'layer_store_dtype': self.layer_store_dtype,
+            'lazy_model_loading': self.lazy_model_loading,
+            'layer_memory_budget_mb': self.layer_memory_budget_mb,
+            'tile_cache_mb': self.tile_cache_mb,
+            'prefetch_enabled': self.prefetch_enabled,
+            'prefetch_mb': self.prefetch_mb,
+            'frame_backend': self.frame_backend,
+            'max_fps': self.max_fps,
+            'idle_redraw_interval': self.idle_redraw_interval,
+            'texture_format': self.texture_format,
+            'profiler_enabled': self.profiler_enabled,
+            'log_level': self.log_level,
+            'log_rate_limit': self.log_rate_limit,
+            'memory_monitor_interval': self.memory_monitor_interval
 
         }
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -74,11 +126,13 @@ class LittleConfig:
         self.last_directory = last_directory
         self.save_config()
 
-    def set_graphics_settings(self, buffer_width, buffer_height, power_of_two, enable_blend):
+    def set_graphics_settings(self, buffer_width, buffer_height, power_of_two, enable_blend, lod_reducer, layout_type):
         self.buffer_width = buffer_width
         self.buffer_height = buffer_height
         self.power_of_two = power_of_two
         self.enable_blend = enable_blend
+        self.lod_reducer = lod_reducer
+        self.layout_type = layout_type
         self.save_config()
 
     def set_show_weights(self, show_weights):
@@ -1,5 +1,8 @@
+import logging
 import time
 
+logger = logging.getLogger(__name__)
+
 
 class CameraAnimation:
     def __init__(self, n_window, n_net):
@@ -38,7 +41,7 @@ class CameraAnimation:
         self.target_x, self.target_y = self.get_target_for_current_projection()
         self.target_zoom = self.n_window.calculate_zoom_for_bounds(world_w, world_h)
 
-        print("target", self.target_x, self.target_y, self.target_zoom)
+        logger.debug("Target %s %s %s", self.target_x, self.target_y, self.target_zoom)
         self.start_time = time.time()
         self.is_animating = True
 
@@ -53,7 +56,7 @@ class CameraAnimation:
         self.target_x, self.target_y = self.get_target_for_current_projection()
         self.target_zoom = 0.2
 
-        print("target", self.target_x, self.target_y, self.target_zoom)
+        logger.debug("Target %s %s %s", self.target_x, self.target_y, self.target_zoom)
         self.start_time = time.time()
         self.is_animating = True
 
@@ -74,7 +77,7 @@ class CameraAnimation:
         else:
             stage = None
         if t >= 1 and self.is_animating:
-            print("animation finished")
+            logger.debug("Animation finished")
             self.is_animating = False
         elif self.is_animating:
             if stage == 1:
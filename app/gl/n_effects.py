@@ -1,4 +1,5 @@
 from app.gl.n_quad import NQuad
+from app.gl.n_window import ACTIVE_FRAMES_AFTER_EVENT
 
 
 class LayerEffect:
@@ -106,6 +107,8 @@ class NEffects:
         layer_meta = self.n_net.layers_meta_dict.get(self.id, None)
         if layer_meta:
             self.layer_effect.show_quad(self.id, layer_meta.bounds)
+            # Called by the forward hooks on the pipeline thread, wakes up an idle main loop
+            self.n_window.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
 
     def clear(self):
         self.id = None
@@ -114,6 +117,7 @@ class NEffects:
     def hide(self, id):
         if self.layer_effect is not None and self.id == id:
             self.layer_effect.visible = False
+            self.n_window.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
 
     def draw(self, effects_shader):
         if self.layer_effect is not None:
@@ -0,0 +1,270 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from app.gl.n_frame_producer import FrameBufferPool, FRAME_WORKERS_COUNT
+from app.gl.n_net import NNet
+from app.grid.layer_cache import DEFAULT_MEMORY_BUDGET
+from app.grid.layer_store import LayerStore
+from app.grid.tile_cache import DEFAULT_TILE_CACHE_BUDGET
+
+logger = logging.getLogger(__name__)
+
+FRAME_BACKEND_THREAD = "thread"
+FRAME_BACKEND_PROCESS = "process"
+# Seconds to wait for a process to exit before it is terminated
+PROCESS_JOIN_TIMEOUT = 2.0
+
+
+class SharedFrameBufferPool(FrameBufferPool):
+    """
+    Frame buffers in shared memory, frame processes write into them and the main process uploads them
+
+    Shared buffers are always kept for the next frame, their count is bounded by the frames in progress.
+    Shared memory is released on shutdown, views of it may still be used by the scene until then.
+    """
+
+    def __init__(self, max_count=FRAME_WORKERS_COUNT + 3):
+        super().__init__(max_count)
+        # id(buffer) -> (buffer, shared memory)
+        self.shared_memories = {}
+        self.dropped_memories = []
+
+    def _allocate(self, width, height, dtype):
+        memory = shared_memory.SharedMemory(create=True, size=width * height * np.dtype(dtype).itemsize)
+        buffer = np.ndarray((width, height), dtype=dtype, buffer=memory.buf)
+        with self.lock:
+            self.shared_memories[id(buffer)] = (buffer, memory)
+        return buffer
+
+    def get_shared_name(self, buffer):
+        with self.lock:
+            entry = self.shared_memories.get(id(buffer))
+        if entry is None or entry[0] is not buffer:
+            return None
+        return entry[1].name
+
+    def release(self, buffer):
+        if self.get_shared_name(buffer) is None:
+            # Buffer of the pool used before the processes were started
+            return
+        with self.lock:
+            self.free_buffers.append(buffer)
+
+    def _drop(self, buffer):
+        # Buffer settings changed, nobody attaches to the old buffer anymore
+        _, memory = self.shared_memories.pop(id(buffer))
+        memory.unlink()
+        self.dropped_memories.append(memory)
+
+    def shutdown(self):
+        with self.lock:
+            for _, memory in self.shared_memories.values():
+                memory.unlink()
+            self.shared_memories = {}
+            self.free_buffers = []
+
+
+class FrameJob:
+    """
+    Frame sent to a frame process, regions are (x1, y1, x2, y2, row, column), world bounds and buffer position
+    Placed layers are only sent when the process has a different grid.
+    """
+
+    def __init__(self, frame_id, buffer_name, buffer_shape, buffer_dtype, factor, regions, frame_source, grid_key,
+                 placed_layers):
+        self.frame_id = frame_id
+        self.buffer_name = buffer_name
+        self.buffer_shape = buffer_shape
+        self.buffer_dtype = buffer_dtype
+        self.factor = factor
+        self.regions = regions
+        self.layer_store_path = frame_source.layer_store_path
+        self.loaded_data_id = frame_source.loaded_data_id
+        self.reducer = frame_source.reducer
+        self.grid_key = grid_key
+        self.placed_layers = placed_layers
+
+
+class LatestFrameCancellationSignal:
+    # Same interface as CancellationSignal, a frame is canceled as soon as a newer one is created
+    def __init__(self, frame_id, latest_frame_id):
+        self.frame_id = frame_id
+        self.latest_frame_id = latest_frame_id
+
+    def emit(self):
+        pass
+
+    def is_canceled(self):
+        return self.latest_frame_id.value != self.frame_id
+
+
+def run_frame_process(connection, latest_frame_id, tile_cache_budget, memory_budget):
+    """
+    Frame process main loop, one job at a time from the connection, True is sent back when the buffer is written
+    Layers are read from the layer store through np.memmap, pages are shared with the main process.
+    """
+    n_net = NNet(None, None)
+    n_net.set_tile_cache_budget(tile_cache_budget)
+    n_net.set_memory_budget(memory_budget)
+    grid_key = None
+    # Shared memory name -> (shared memory, buffer), attached once
+    buffers = {}
+    while True:
+        try:
+            job = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        try:
+            if job.grid_key != grid_key:
+                grid_key = None
+                if job.placed_layers is None:
+                    connection.send(False)
+                    continue
+                n_net.init_from_placed_layers(LayerStore(job.layer_store_path).open(), job.placed_layers,
+                                              job.loaded_data_id)
+                grid_key = job.grid_key
+            if n_net.reducer != job.reducer:
+                n_net.set_reducer(job.reducer)
+
+            if job.buffer_name not in buffers:
+                memory = shared_memory.SharedMemory(name=job.buffer_name)
+                buffers[job.buffer_name] = (memory, np.ndarray(job.buffer_shape, dtype=job.buffer_dtype,
+                                                               buffer=memory.buf))
+            buffer = buffers[job.buffer_name][1]
+
+            cancellation_signal = LatestFrameCancellationSignal(job.frame_id, latest_frame_id)
+            for x1, y1, x2, y2, row, col in job.regions:
+                if cancellation_signal.is_canceled():
+                    break
+                n_net.update_tex_buffer_directly(x1, y1, x2, y2, job.factor, buffer[row:, col:], cancellation_signal)
+            connection.send(True)
+        except Exception:
+            traceback.print_exc()
+            grid_key = None
+            connection.send(False)
+
+
+class FrameProcess:
+    def __init__(self, context, latest_frame_id, tile_cache_budget, memory_budget):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=run_frame_process,
+                                       args=(child_connection, latest_frame_id, tile_cache_budget, memory_budget),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        # Grid placed in the process, layers are sent again when it changes
+        self.grid_key = None
+
+    def build(self, frame, buffer_name, buffer_shape, buffer_dtype):
+        frame_source = frame.frame_source
+        grid_part = frame.visible_grid_part
+        factor = grid_part.factor
+        regions = [(x1, y1, x2, y2, (y1 - grid_part.y1) // factor, (x1 - grid_part.x1) // factor)
+                   for x1, y1, x2, y2 in frame.get_regions()]
+        grid_key = frame_source.get_grid_key()
+        placed_layers = frame_source.placed_layers if grid_key != self.grid_key else None
+        job = FrameJob(frame.frame_id, buffer_name, buffer_shape, buffer_dtype, factor, regions, frame_source,
+                       grid_key, placed_layers)
+        self.connection.send(job)
+        # Waiting for the result does not hold the GIL, the render loop keeps running
+        built = self.connection.recv()
+        self.grid_key = grid_key if built else None
+        return built
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def shutdown(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(PROCESS_JOIN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+class FrameProcessPool:
+    """
+    Frames built in worker processes instead of threads, grid reading does not compete with the render loop
+    for the GIL
+
+    Processes open the layer store of the net and place the layers the same way, frames are written into
+    shared memory buffers. The frame worker thread only sends the job and waits for the ready flag.
+    Frames of a net that is not read from a layer store are built by the thread as before.
+    """
+
+    def __init__(self, processes_count=FRAME_WORKERS_COUNT, tile_cache_budget=DEFAULT_TILE_CACHE_BUDGET,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
+        # Fork would copy the GL context and the threads of the main process
+        self.context = multiprocessing.get_context("spawn")
+        self.latest_frame_id = self.context.RawValue('q', 0)
+        self.tile_cache_budget = tile_cache_budget
+        self.memory_budget = memory_budget
+        self.buffer_pool = SharedFrameBufferPool()
+        self.idle_processes = queue.Queue()
+        self.processes = []
+        self.lock = threading.Lock()
+        self.built_frames_count = 0
+        self.failed_frames_count = 0
+        for _ in range(processes_count):
+            process = self._start_process()
+            self.processes.append(process)
+            self.idle_processes.put(process)
+
+    def _start_process(self):
+        return FrameProcess(self.context, self.latest_frame_id, self.tile_cache_budget, self.memory_budget)
+
+    def set_latest_frame(self, frame_id):
+        self.latest_frame_id.value = frame_id
+
+    def cancel_all(self):
+        self.latest_frame_id.value = -1
+
+    def build(self, frame, buffer):
+        """
+        Build the frame regions into the buffer in a frame process
+        Returns False when the frame can't be built there, it is then built by the calling thread.
+        """
+        buffer_name = self.buffer_pool.get_shared_name(buffer)
+        if frame.frame_source is None or buffer_name is None:
+            return False
+        process = self.idle_processes.get()
+        try:
+            if not process.is_alive():
+                logger.warning("Frame process exited, starting a new one")
+                process = self._replace_process(process)
+            built = process.build(frame, buffer_name, buffer.shape, buffer.dtype.str)
+        except (EOFError, BrokenPipeError, OSError):
+            traceback.print_exc()
+            process = self._replace_process(process)
+            built = False
+        finally:
+            self.idle_processes.put(process)
+        with self.lock:
+            if built:
+                self.built_frames_count += 1
+            else:
+                self.failed_frames_count += 1
+        return built
+
+    def _replace_process(self, process):
+        process.shutdown()
+        new_process = self._start_process()
+        with self.lock:
+            self.processes[self.processes.index(process)] = new_process
+        return new_process
+
+    def shutdown(self):
+        for process in self.processes:
+            process.shutdown()
+        self.buffer_pool.shutdown()
@@ -1,8 +1,22 @@
+import logging
 import threading
 import time
+import traceback
+from collections import deque
 
 import numpy as np
 
+from app.gl.n_profiler import profiler, SPAN_FRAME_BUILD
+from app.gl.n_texture_format import get_texture_format, calculate_value_range, quantize, NO_VALUE_RANGE, \
+    TEXTURE_FORMAT_FLOAT32
+
+logger = logging.getLogger(__name__)
+
+FRAME_WORKERS_COUNT = 2
+# Current frame, frame in progress and a spare one
+FRAME_BUFFERS_COUNT = 3
+FRAME_QUEUE_SIZE = 1
+
 
 class CancellationSignal:
     def __init__(self):
@@ -15,36 +29,377 @@ class CancellationSignal:
         return self._canceled
 
 
+class FrameShift:
+    """
+    Pan of the previous frame at the same factor
+
+    The overlapping part is copied from the previous buffer, only the exposed strips are read from the grid.
+    Buffer coordinates are (row, column), world bounds are (x1, y1, x2, y2).
+    """
+
+    def __init__(self, source_frame, src_row, src_col, dst_row, dst_col, rows, cols, strips, valid_rows, valid_cols):
+        self.source_grid_part = source_frame.visible_grid_part
+        # Owned by the shifted frame until the copy is done, then it goes back to the pool
+        self.source_data = source_frame.data
+        self.src_row = src_row
+        self.src_col = src_col
+        self.dst_row = dst_row
+        self.dst_col = dst_col
+        self.rows = rows
+        self.cols = cols
+        # World bounds of the exposed strips
+        self.strips = strips
+        # Rows and columns of the buffer covered by the frame, the rest stays empty (-1)
+        self.valid_rows = valid_rows
+        self.valid_cols = valid_cols
+        # Quantized frames keep the range of the source, so the shifted texture part stays valid
+        self.value_range = source_frame.value_range
+
+    def copy(self, buffer):
+        buffer[self.dst_row:self.dst_row + self.rows, self.dst_col:self.dst_col + self.cols] = \
+            self.source_data[self.src_row:self.src_row + self.rows, self.src_col:self.src_col + self.cols]
+
+    def get_changed_regions(self, visible_grid_part, buffer_rows, buffer_cols):
+        """
+        Buffer regions (row, col, rows, cols) that differ from the shifted previous frame,
+        the exposed strips plus the empty part of the buffer outside the frame
+        """
+        factor = visible_grid_part.factor
+        regions = []
+        for x1, y1, x2, y2 in self.strips:
+            row = (y1 - visible_grid_part.y1) // factor
+            col = (x1 - visible_grid_part.x1) // factor
+            regions.append((row, col, min((y2 - y1) // factor, buffer_rows - row), min((x2 - x1) // factor,
+                                                                                      buffer_cols - col)))
+        if self.valid_rows < buffer_rows:
+            regions.append((self.valid_rows, 0, buffer_rows - self.valid_rows, buffer_cols))
+        if self.valid_cols < buffer_cols:
+            regions.append((0, self.valid_cols, self.valid_rows, buffer_cols - self.valid_cols))
+        return [region for region in regions if region[2] > 0 and region[3] > 0]
+
+
 class FrameData:
-    def __init__(self, buffer_width, buffer_height, visible_grid_part):
+    def __init__(self, buffer_width, buffer_height, visible_grid_part, texture_format=None):
         self.buffer_width = buffer_width
         self.buffer_height = buffer_height
         self.visible_grid_part = visible_grid_part
+        self.texture_format = texture_format or get_texture_format(TEXTURE_FORMAT_FLOAT32)
         self.data = None
+        # Uploaded to the texture, the data itself or its quantized indices
+        self.texture_data = None
+        # (scale, offset) of the quantized indices
+        self.value_range = NO_VALUE_RANGE
         self.cancellation_signal = CancellationSignal()
-        self._thread = threading.Thread(target=self._load)
-        self._thread.start()
         self.ready = False
+        # perf_counter times, ready_time stays None when the frame was canceled before it was ready
+        self.created_time = time.perf_counter()
+        self.ready_time = None
+        # Frames of a different load are never shifted into each other
+        self.data_id = visible_grid_part.n_net.loaded_data_id
+        # Set by NFrameProducer, a retired frame gives its buffer back to the pool
+        self.running = False
+        self.retired = False
+        self.shift = None
+        # Set by NFrameProducer when frames are built by a FrameProcessPool
+        self.frame_id = None
+        self.frame_source = None
+
+    def get_regions(self):
+        # World bounds read from the grid, the whole frame or the strips exposed by a shift
+        if self.shift is None:
+            grid_part = self.visible_grid_part
+            return [(grid_part.x1, grid_part.y1, grid_part.x2, grid_part.y2)]
+        return self.shift.strips
+
+    def load(self, buffer, frame_process_pool=None):
+        buffer.fill(-1)
+        self.data = buffer
+        if self.shift is not None:
+            self.shift.copy(buffer)
+        if frame_process_pool is None or not frame_process_pool.build(self, buffer):
+            for x1, y1, x2, y2 in self.get_regions():
+                if self.cancellation_signal.is_canceled():
+                    break
+                self.visible_grid_part.update_scene_buffer_region(self.data, x1, y1, x2, y2, self.cancellation_signal)
+        if not self.texture_format.quantized:
+            self.texture_data = buffer
+            self._set_ready()
 
-    def _load(self):
-        self.data = np.full((self.buffer_width, self.buffer_height), fill_value=-1, dtype=np.float32)
-        self.visible_grid_part.update_scene_buffer_directly(self.data, self.cancellation_signal)
+    def encode(self, texture_buffer):
+        # Quantized frames only, called after load
+        self.texture_data = texture_buffer
+        if not self.cancellation_signal.is_canceled():
+            if self.shift is not None:
+                self.value_range = self.shift.value_range
+            else:
+                self.value_range = calculate_value_range(self.data)
+            quantize(self.data, texture_buffer, self.value_range)
+        self._set_ready()
+
+    def _set_ready(self):
+        if not self.cancellation_signal.is_canceled():
+            self.ready_time = time.perf_counter()
         self.ready = True
 
     def cancel(self):
         self.cancellation_signal.emit()
 
 
+class FrameBufferPool:
+    """
+    Frame buffers reused between frames instead of a new allocation for every viewport change
+    Buffers with a different size (buffer settings changed) are dropped.
+    """
+
+    def __init__(self, max_count=FRAME_BUFFERS_COUNT):
+        self.max_count = max_count
+        self.free_buffers = []
+        self.allocations_count = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, width, height, dtype=np.float32):
+        with self.lock:
+            while len(self.free_buffers) > 0:
+                buffer = self.free_buffers.pop()
+                if buffer.shape == (width, height) and buffer.dtype == dtype:
+                    return buffer
+                self._drop(buffer)
+            self.allocations_count += 1
+        return self._allocate(width, height, dtype)
+
+    def release(self, buffer):
+        with self.lock:
+            if len(self.free_buffers) < self.max_count:
+                self.free_buffers.append(buffer)
+            else:
+                self._drop(buffer)
+
+    def _allocate(self, width, height, dtype):
+        return np.empty((width, height), dtype=dtype)
+
+    def _drop(self, buffer):
+        pass
+
+
+class FrameWorkerPool:
+    """
+    Persistent threads running the frame jobs
+
+    The queue is bounded, a new job replaces the oldest queued ones. During a drag the queued frames
+    are stale before a worker gets to them, they are canceled without being built.
+    """
+
+    def __init__(self, run_func, workers_count=FRAME_WORKERS_COUNT, max_queued=FRAME_QUEUE_SIZE):
+        self.run_func = run_func
+        self.max_queued = max_queued
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.dropped_count = 0
+        self.threads = []
+        for index in range(workers_count):
+            thread = threading.Thread(target=self._work, name=f"frame_worker_{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job):
+        with self.condition:
+            while len(self.queue) >= self.max_queued:
+                self.queue.popleft().cancel()
+                self.dropped_count += 1
+            self.queue.append(job)
+            self.condition.notify()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                job = self.queue.popleft()
+            try:
+                self.run_func(job)
+            except Exception:
+                # Keep the worker alive, next frame may succeed
+                traceback.print_exc()
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            for job in self.queue:
+                job.cancel()
+            self.queue.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
 class NFrameProducer:
-    def __init__(self, n_buffer):
+    def __init__(self, n_buffer, workers_count=FRAME_WORKERS_COUNT):
         self._n_buffer = n_buffer
         self._current_frame = None
+        self._lock = threading.Lock()
+        # Set when the content of the grid changed, the next frame is built from scratch
+        self._invalidated = False
+        self.shifted_frames_count = 0
+        self.buffer_pool = FrameBufferPool()
+        # Quantized indices of the frames, see TextureFormat
+        self.texture_buffer_pool = FrameBufferPool()
+        self.texture_format = get_texture_format(TEXTURE_FORMAT_FLOAT32)
+        # Optional, frames are built by worker processes, see set_frame_process_pool
+        self.frame_process_pool = None
+        self._frames_count = 0
+        # Called from a worker thread when a frame is ready to be uploaded
+        self.frame_ready_func = None
+        self.worker_pool = FrameWorkerPool(self._build_frame, workers_count)
+
+    def set_frame_ready_func(self, frame_ready_func):
+        self.frame_ready_func = frame_ready_func
+
+    def set_texture_format(self, name):
+        # Next frame is built in the new format, buffers of the old one are dropped by the pools
+        with self._lock:
+            self.texture_format = get_texture_format(name)
+
+    def set_frame_process_pool(self, frame_process_pool):
+        # Buffers must be shared with the processes, buffers of the previous pool are not reused
+        with self._lock:
+            self.frame_process_pool = frame_process_pool
+            self.buffer_pool = frame_process_pool.buffer_pool
+
+    def uses_frame_processes(self, n_net):
+        return self.frame_process_pool is not None and n_net.layer_store_path is not None
 
     def create_frame(self, visible_grid_part):
-        print("Creating new frame", self._n_buffer.buffer_width, self._n_buffer.buffer_height)
-        if self._current_frame is not None:
-            self._current_frame.cancel()
-        self._current_frame = FrameData(self._n_buffer.buffer_width, self._n_buffer.buffer_height, visible_grid_part)
+        logger.debug("Creating new frame %sx%s", self._n_buffer.buffer_width, self._n_buffer.buffer_height)
+        frame = FrameData(self._n_buffer.buffer_width, self._n_buffer.buffer_height, visible_grid_part,
+                          self.texture_format)
+        with self._lock:
+            self._frames_count += 1
+            frame.frame_id = self._frames_count
+            if self.frame_process_pool is not None:
+                frame.frame_source = visible_grid_part.n_net.get_frame_source()
+                # Frames in progress in the processes are stale from now on
+                self.frame_process_pool.set_latest_frame(frame.frame_id)
+            previous_frame = self._current_frame
+            self._current_frame = frame
+            if previous_frame is not None:
+                frame.shift = self._plan_shift(previous_frame, frame)
+                if frame.shift is not None:
+                    # Buffer is handed over to the new frame
+                    previous_frame.data = None
+                    self.shifted_frames_count += 1
+                previous_frame.cancel()
+                self._retire(previous_frame)
+            self._invalidated = False
+        self.worker_pool.submit(frame)
 
     def get_current_frame(self):
         return self._current_frame
+
+    def is_busy(self):
+        # Current frame is queued or being built
+        frame = self._current_frame
+        return frame is not None and not frame.ready and not frame.cancellation_signal.is_canceled()
+
+    def invalidate(self):
+        with self._lock:
+            self._invalidated = True
+
+    def _plan_shift(self, previous_frame, frame):
+        previous = previous_frame.visible_grid_part
+        current = frame.visible_grid_part
+        if (self._invalidated
+                or not previous_frame.ready
+                or previous_frame.running
+                or previous_frame.data is None
+                or previous_frame.cancellation_signal.is_canceled()
+                or previous_frame.data_id != frame.data_id
+                or previous_frame.texture_format is not frame.texture_format
+                or previous.factor != current.factor
+                or previous_frame.data.shape != (frame.buffer_width, frame.buffer_height)):
+            return None
+
+        factor = current.factor
+        # Bounds are multiples of the factor, so both frames sample the same world rows and columns
+        overlap_x1 = max(current.x1, previous.x1)
+        overlap_y1 = max(current.y1, previous.y1)
+        overlap_x2 = min(current.x2, previous.x2)
+        overlap_y2 = min(current.y2, previous.y2)
+        if overlap_x1 >= overlap_x2 or overlap_y1 >= overlap_y2:
+            return None
+
+        buffer_rows, buffer_cols = previous_frame.data.shape
+        dst_row = (overlap_y1 - current.y1) // factor
+        dst_col = (overlap_x1 - current.x1) // factor
+        src_row = (overlap_y1 - previous.y1) // factor
+        src_col = (overlap_x1 - previous.x1) // factor
+        rows = min((overlap_y2 - overlap_y1) // factor, buffer_rows - dst_row, buffer_rows - src_row)
+        cols = min((overlap_x2 - overlap_x1) // factor, buffer_cols - dst_col, buffer_cols - src_col)
+        if rows <= 0 or cols <= 0:
+            return None
+
+        strips = []
+        if current.y1 < overlap_y1:
+            strips.append((current.x1, current.y1, current.x2, overlap_y1))
+        if overlap_y2 < current.y2:
+            strips.append((current.x1, overlap_y2, current.x2, current.y2))
+        if current.x1 < overlap_x1:
+            strips.append((current.x1, overlap_y1, overlap_x1, overlap_y2))
+        if overlap_x2 < current.x2:
+            strips.append((overlap_x2, overlap_y1, current.x2, overlap_y2))
+
+        valid_rows = min(current.h // factor, buffer_rows)
+        valid_cols = min(current.w // factor, buffer_cols)
+        return FrameShift(previous_frame, src_row, src_col, dst_row, dst_col, rows, cols, strips,
+                          valid_rows, valid_cols)
+
+    def shutdown(self):
+        if self.frame_process_pool is not None:
+            self.frame_process_pool.cancel_all()
+        self.worker_pool.shutdown()
+        if self.frame_process_pool is not None:
+            self.frame_process_pool.shutdown()
+
+    def _retire(self, frame):
+        # Buffer of a frame in progress goes back to the pool when the worker is done with it
+        frame.retired = True
+        if not frame.running:
+            if frame.data is not None:
+                self.buffer_pool.release(frame.data)
+                frame.data = None
+            if frame.texture_format.quantized and frame.texture_data is not None:
+                self.texture_buffer_pool.release(frame.texture_data)
+            frame.texture_data = None
+            self._release_shift_source(frame)
+
+    def _release_shift_source(self, frame):
+        if frame.shift is not None and frame.shift.source_data is not None:
+            self.buffer_pool.release(frame.shift.source_data)
+            frame.shift.source_data = None
+
+    def _build_frame(self, frame):
+        with self._lock:
+            if frame.retired:
+                return
+            frame.running = True
+        start_time = time.time()
+        texture_format = frame.texture_format
+        buffer = self.buffer_pool.acquire(frame.buffer_width, frame.buffer_height, texture_format.buffer_dtype)
+        try:
+            with profiler.span(SPAN_FRAME_BUILD):
+                frame.load(buffer, self.frame_process_pool)
+                if texture_format.quantized:
+                    frame.encode(self.texture_buffer_pool.acquire(frame.buffer_width, frame.buffer_height,
+                                                                  texture_format.texture_dtype))
+        finally:
+            with self._lock:
+                frame.running = False
+                self._release_shift_source(frame)
+                if frame.retired:
+                    self._retire(frame)
+        if not frame.cancellation_signal.is_canceled():
+            logger.debug("Frame built %.2f ms", (time.time() - start_time) * 1000)
+            if self.frame_ready_func is not None:
+                self.frame_ready_func()
@@ -1,9 +1,54 @@
+import logging
 import math
 import time
+from functools import partial
 
 import numpy as np
 
-from app.grid.n_grid import create_grid, create_layer
+from app.gl.n_profiler import profiler, SPAN_GRID_QUERY
+from app.grid.layer_cache import LayerMemoryBudget
+from app.grid.n_grid import create_grid, create_layer, create_lazy_layer
+from app.grid.n_layout import create_layout, get_layers_shapes, STRIP
+from app.grid.tile_cache import TileCache
+
+logger = logging.getLogger(__name__)
+
+# Module hierarchy is split until every layout group is smaller than 1/N of the model
+LAYOUT_GROUPS_SPLIT = 8
+
+
+def get_grid_shape(shape):
+    # Only 1D and 2D layers are drawn, other shapes get a placeholder
+    if len(shape) > 2:
+        return 2, 2
+    if len(shape) == 0:
+        return 1,
+    return tuple(shape)
+
+
+def as_grid_data(layer_grid):
+    if layer_grid.ndim > 2:
+        # print("skipped unknown size", component.name, layer_grid.shape)
+        return np.ones([2, 2])
+    if layer_grid.ndim == 0:
+        return layer_grid.reshape(1)
+    return layer_grid
+
+
+class FrameSource:
+    """
+    Layers of a net read from a layer store and their placement, enough to build the same frames in another process
+    """
+
+    def __init__(self, layer_store_path, grid_version, loaded_data_id, placed_layers, reducer):
+        self.layer_store_path = layer_store_path
+        self.grid_version = grid_version
+        self.loaded_data_id = loaded_data_id
+        self.placed_layers = placed_layers
+        self.reducer = reducer
+
+    def get_grid_key(self):
+        return self.layer_store_path, self.grid_version
 
 
 class NetLayerMeta:
@@ -40,6 +85,19 @@ class NetLayer:
             result += s.get_grid_layers()
         return result
 
+    def get_size(self):
+        return sum(l.size for l in self.get_grid_layers())
+
+    # Groups of grid layers used by the layout, for example one group per transformer block
+    def get_layout_groups(self, max_group_size):
+        if self.grid_layer is not None or len(self.sub_layers) == 0 or self.get_size() <= max_group_size:
+            grid_layers = self.get_grid_layers()
+            return [grid_layers] if len(grid_layers) > 0 else []
+        groups = []
+        for s in self.sub_layers:
+            groups += s.get_layout_groups(max_group_size)
+        return groups
+
     def calculate_bounds(self):
         all_bounds = []
         if self.grid_layer is None:
@@ -62,20 +120,63 @@ class NetLayer:
         return self.bounds
 
     @staticmethod
-    def from_module_meta(module_meta):
+    def from_module_meta(module_meta, layer_store=None, memory_budget=None):
         children = []
         for sub_module in module_meta.components:
-            children.append(NetLayer.from_module_meta(sub_module))
+            children.append(NetLayer.from_module_meta(sub_module, layer_store, memory_budget))
 
         net_layer = NetLayer()
         net_layer.sub_layers = children
         net_layer.name = module_meta.name
         if module_meta.is_parameter:
+            # Only the shape is read here, the data is converted when the layer is displayed
+            loader = partial(NetLayer._load_module_meta, module_meta, layer_store)
+            net_layer.grid_layer = create_lazy_layer(get_grid_shape(module_meta.get_shape()),
+                                                     loader,
+                                                     net_layer.name,
+                                                     memory_budget)
+        return net_layer
+
+    @staticmethod
+    def _load_module_meta(module_meta, layer_store):
+        # Memory mapped copy of the weights, falls back to the torch parameter
+        layer_grid = layer_store.get(module_meta.name) if layer_store is not None else None
+        if layer_grid is None:
             layer_grid = module_meta.get_data()
-            if layer_grid.ndim > 2:
-                # print("skipped unknown size", component.name, layer_grid.shape)
-                layer_grid = np.ones([2, 2])
-            net_layer.grid_layer = create_layer(layer_grid, net_layer.name)
+        return as_grid_data(layer_grid)
+
+    @staticmethod
+    def from_named_layers(root_name, named_layers, memory_budget=None):
+        """
+        Build the hierarchy from dotted names, model.layers.0.weight -> model / layers / 0 / weight
+        :param named_layers: list of (name relative to the root, shape, loader returning the layer_grid)
+        """
+        root = NetLayer()
+        root.name = root_name
+        nodes = {root_name: root}
+        for name, shape, loader in named_layers:
+            parent = root
+            path = root_name
+            for part in name.split(".")[:-1]:
+                path = f"{path}.{part}"
+                node = nodes.get(path)
+                if node is None:
+                    node = NetLayer()
+                    node.name = path
+                    parent.sub_layers.append(node)
+                    nodes[path] = node
+                parent = node
+            parent.sub_layers.append(NetLayer.from_loader(f"{root_name}.{name}", shape, loader, memory_budget))
+        return root
+
+    @staticmethod
+    def from_loader(name, shape, loader, memory_budget=None):
+        net_layer = NetLayer()
+        net_layer.name = name
+        net_layer.grid_layer = create_lazy_layer(get_grid_shape(shape),
+                                                 lambda: as_grid_data(loader()),
+                                                 net_layer.name,
+                                                 memory_budget)
         return net_layer
 
     @staticmethod
@@ -118,22 +219,44 @@ class NNet:
         self.total_width = 0
         self.total_height = 0
         self.grid = create_grid()
+        self.layout_type = STRIP
+        self.layout = create_layout(self.layout_type)
+        # Layers and groups of the last init_grid, used to apply a different layout
+        self.layout_layers = []
+        self.layout_groups = None
+        # Loaded data of the lazy layers, least recently displayed layers are released
+        self.memory_budget = LayerMemoryBudget()
+        # Frames are assembled from cached tiles, see update_tex_buffer_directly
+        self.tile_cache = TileCache()
+        self.reducer = None
 
         # Unique for each load
         self.loaded_data_id = None
+        # Set when the layers are read from a layer store, frame processes open the same file
+        self.layer_store_path = None
+        # Changes with every placement of the layers
+        self.grid_version = 0
+        self._placed_layers = None
 
     def clear(self):
         self.net_layers = []
-        self.grid.layers = []
+        self.grid.clear()
+        self.memory_budget.clear()
+        self.tile_cache.clear()
+        self.layout_layers = []
+        self.layout_groups = None
         self.layers_meta_dict = {}
         self.grid_columns_count = 0
         self.grid_rows_count = 0
         self.total_width = 0
         self.total_height = 0
         self.loaded_data_id = None
+        self.layer_store_path = None
+        self.grid_version += 1
+        self._placed_layers = None
 
     def init_from_size(self, all_layers_sizes):
-        print("Init net from sizes")
+        logger.info("Init net from sizes")
         self.net_layers = []
         for index, size in enumerate(all_layers_sizes):
             self.net_layers.append(NetLayer.from_size(f"basic_layer_{index}", size))
@@ -145,7 +268,7 @@ class NNet:
         self.finish_initialization(f"init_from_size_{time.time()}")
 
     def init_from_np_arrays(self, all_layers, names):
-        print("Generating layers data")
+        logger.info("Generating layers data")
         self.net_layers = []
         for index, layer_grid in enumerate(all_layers):
             self.net_layers.append(NetLayer.from_numpy_data(f"numpy_layer{index}", layer_grid))
@@ -155,17 +278,89 @@ class NNet:
         self.init_grid(grid_layers)
         self.finish_initialization(f"init_from_np_arrays_{time.time()}")
 
-    def init_from_model_parser(self, model_parser):
-        print("Init net from activations parser")
+    def init_from_model_parser(self, model_parser, layer_store=None):
+        logger.info("Init net from activations parser")
+        self.clear()
+        net_layer = NetLayer.from_module_meta(model_parser.parsed_model, layer_store, self.memory_budget)
+        self.init_from_net_layer(net_layer)
+        if layer_store is not None:
+            self.layer_store_path = layer_store.path
+
+    def init_from_layer_store(self, layer_store):
+        logger.info("Init net from layer store %s", layer_store.data_path)
+        prefix = f"{layer_store.model_name}."
+        named_layers = [(name[len(prefix):] if name.startswith(prefix) else name,
+                         layer_store.entries[name].shape,
+                         partial(layer_store.get, name))
+                        for name in layer_store.names()]
+        self.init_from_named_layers(layer_store.model_name, named_layers)
+        self.layer_store_path = layer_store.path
+
+    def init_from_placed_layers(self, layer_store, placed_layers, loaded_data_id):
+        """
+        Same placement as another net reading the same layer store, layout is not computed again
+        :param placed_layers: list of (layer store name, column offset, row offset), see get_placed_layers
+        """
+        self.clear()
+        grid_layers = []
+        for name, column_offset, row_offset in placed_layers:
+            grid_layer = create_lazy_layer(get_grid_shape(layer_store.entries[name].shape),
+                                           partial(NNet._load_store_layer, layer_store, name),
+                                           name,
+                                           self.memory_budget)
+            grid_layer.define_layer_offset(column_offset, row_offset)
+            grid_layers.append(grid_layer)
+        self.grid_columns_count = max((l.column_offset + l.columns_count for l in grid_layers), default=0)
+        self.grid_rows_count = max((l.row_offset + l.rows_count for l in grid_layers), default=0)
+        self.total_width = self.grid_columns_count
+        self.total_height = self.grid_rows_count
+        self.grid.add_layers(grid_layers)
+        self.loaded_data_id = loaded_data_id
+        self.layer_store_path = layer_store.path
+
+    @staticmethod
+    def _load_store_layer(layer_store, name):
+        return as_grid_data(layer_store.get(name))
+
+    def get_frame_source(self):
+        # None when the layers are not in a layer store, frames are built in this process
+        if self.layer_store_path is None or len(self.grid.layers) == 0:
+            return None
+        return FrameSource(self.layer_store_path, self.grid_version, self.loaded_data_id, self.get_placed_layers(),
+                           self.reducer)
+
+    def get_placed_layers(self):
+        # (name, column offset, row offset) of every grid layer, cached until the layers are placed again
+        if self._placed_layers is None:
+            self._placed_layers = [(layer.name, layer.column_offset, layer.row_offset) for layer in self.grid.layers]
+        return self._placed_layers
+
+    def init_from_safetensors(self, checkpoint, model_name):
+        logger.info("Init net from safetensors %s", checkpoint.directory)
+        named_layers = [(name, checkpoint.get_shape(name), partial(checkpoint.get, name))
+                        for name in checkpoint.names()
+                        if checkpoint.is_supported(name)]
+        self.init_from_named_layers(model_name, named_layers)
+
+    def set_memory_budget(self, budget_bytes):
+        self.memory_budget.set_budget(budget_bytes)
+
+    def init_from_named_layers(self, model_name, named_layers):
         self.clear()
-        net_layer = NetLayer.from_module_meta(model_parser.parsed_model)
+        net_layer = NetLayer.from_named_layers(model_name, named_layers, self.memory_budget)
+        self.init_from_net_layer(net_layer)
+
+    def init_from_net_layer(self, net_layer):
         self.net_layers.append(net_layer)
         #
         # if len(net_layer.sub_layers) > 0:
         #     for s in net_layer.sub_layers:
         #         self.add_layers(s.get_grid_layers())
         # else:
-        self.init_grid(net_layer.get_grid_layers())
+        groups = net_layer.get_layout_groups(net_layer.get_size() / LAYOUT_GROUPS_SPLIT)
+        grid_layers = [grid_layer for group in groups for grid_layer in group]
+        group_ids = np.repeat(np.arange(len(groups)), [len(group) for group in groups])
+        self.init_grid(grid_layers, group_ids)
         self.finish_initialization(net_layer.name)
 
     def finish_initialization(self, loaded_data_id):
@@ -179,66 +374,115 @@ class NNet:
         for m in meta_data:
             self.layers_meta_dict[m.name] = m
 
-    def init_grid(self, grid_layers):
+    def set_layout(self, layout_type):
+        self.layout_type = layout_type
+        self.layout = create_layout(layout_type)
+
+    def relayout(self):
+        # Place the loaded layers again with the current layout
+        if len(self.layout_layers) == 0:
+            return
+        self.grid.clear()
+        self.init_grid(self.layout_layers, self.layout_groups)
+        self.finish_initialization(self.loaded_data_id)
+
+    def init_grid(self, grid_layers, groups=None):
         start_time = time.time()
-        print(f"Init net, layers count:", len(grid_layers))
+        logger.info("Init net, layers count: %s", len(grid_layers))
         if len(grid_layers) == 0:
             return
-        max_row_count = max(l.rows_count for l in grid_layers)
-        gap_between_layers = len(grid_layers)
-        print("Loading offsets")
-        for index, grid_layer in enumerate(grid_layers):
-            column_offset = sum([l.columns_count for l in grid_layers[:index]])
-            layer_offset = index * gap_between_layers
-            current_row_count = grid_layer.rows_count
-            row_offset = 0
-            if current_row_count < max_row_count:
-                row_offset = int((max_row_count - current_row_count) / 2)
-            grid_layer.define_layer_offset(column_offset + layer_offset, row_offset)
-            print(f"\rLoading offsets: {int(100 * index / len(grid_layers))}%", end="")
-        print(f"\rLoading offsets: 100%", end="")
-        print("")
-        self.grid_columns_count = sum([l.columns_count for l in grid_layers]) + gap_between_layers * len(grid_layers)
-        self.grid_rows_count = max([l.rows_count for l in grid_layers])
+        # Tiles of the previous placement are stale
+        self.tile_cache.clear()
+        self.grid_version += 1
+        self._placed_layers = None
+        self.layout_layers = grid_layers
+        self.layout_groups = groups
+        rows_counts, columns_counts = get_layers_shapes(grid_layers)
+        column_offsets, row_offsets, total_width, total_height = self.layout.compute_offsets(rows_counts,
+                                                                                             columns_counts,
+                                                                                             groups)
+        for grid_layer, column_offset, row_offset in zip(grid_layers, column_offsets.tolist(), row_offsets.tolist()):
+            grid_layer.define_layer_offset(column_offset, row_offset)
+        logger.debug("Offsets loaded %.2f ms", (time.time() - start_time) * 1000)
+        self.grid_columns_count = total_width
+        self.grid_rows_count = total_height
         self.total_width = self.grid_columns_count
         self.total_height = self.grid_rows_count
-        print(f"Grid dimensions: {self.grid_rows_count}x{self.grid_columns_count}")
+        logger.debug("Grid dimensions: %sx%s", self.grid_rows_count, self.grid_columns_count)
         self.grid.add_layers(grid_layers)
-        print("Net initialized", time.time() - start_time, "s")
+        self.grid.build_lod_pyramids()
+        logger.info("Net initialized %.3f s", time.time() - start_time)
 
     # Add on top of previous layers
     def add_layers(self, grid_layers):
         current_row_offset = self.grid_rows_count
         current_gap = len(self.grid.layers)
         start_time = time.time()
-        print(f"Init net, layers count:", len(grid_layers))
+        logger.info("Init net, layers count: %s", len(grid_layers))
         if len(grid_layers) == 0:
             return
-        max_row_count = max(l.rows_count for l in grid_layers)
-        gap_between_layers = len(grid_layers) if current_gap == 0 else current_gap
-        print("Loading offsets")
-        for index, grid_layer in enumerate(grid_layers):
-            column_offset = sum([l.columns_count for l in grid_layers[:index]])
-            layer_offset = index * gap_between_layers
-            current_row_count = grid_layer.rows_count
-            row_offset = 0
-            if current_row_count < max_row_count:
-                row_offset = int((max_row_count - current_row_count) / 2)
-            grid_layer.define_layer_offset(column_offset + layer_offset, row_offset + current_row_offset + current_gap)
-            print(f"\rLoading offsets: {int(100 * index / len(grid_layers))}%", end="")
-        print(f"\rLoading offsets: 100%", end="")
-        print("")
-        new_grid_columns_count = sum([l.columns_count for l in grid_layers]) + gap_between_layers * len(grid_layers)
-        new_grid_rows_count = max([l.rows_count for l in grid_layers])
+        gap_between_layers = None if current_gap == 0 else current_gap
+        rows_counts, columns_counts = get_layers_shapes(grid_layers)
+        column_offsets, row_offsets, new_grid_columns_count, new_grid_rows_count = self.layout.compute_offsets(
+            rows_counts,
+            columns_counts,
+            gap=gap_between_layers)
+        row_offsets = row_offsets + current_row_offset + current_gap
+        for grid_layer, column_offset, row_offset in zip(grid_layers, column_offsets.tolist(), row_offsets.tolist()):
+            grid_layer.define_layer_offset(column_offset, row_offset)
+        logger.debug("Offsets loaded %.2f ms", (time.time() - start_time) * 1000)
 
         self.grid_columns_count = max(self.grid_columns_count, new_grid_columns_count)
         self.grid_rows_count = self.grid_rows_count + new_grid_rows_count + current_gap
+        self.grid_version += 1
+        self._placed_layers = None
         self.total_width = self.grid_columns_count
         self.total_height = self.grid_rows_count
 
-        print(f"Grid dimensions: {self.grid_rows_count}x{self.grid_columns_count}")
+        logger.debug("Grid dimensions: %sx%s", self.grid_rows_count, self.grid_columns_count)
         self.grid.add_layers(grid_layers)
-        print("Net initialized", time.time() - start_time, "s")
+        self.grid.build_lod_pyramids()
+        self._extend_layout_layers(grid_layers)
+        logger.info("Net initialized %.3f s", time.time() - start_time)
+
+    def _extend_layout_layers(self, grid_layers):
+        # Added layers are one more group after the previous ones, relayout places them with the rest of the net
+        if self.layout_groups is None:
+            # Without groups every layer is its own group
+            previous_groups = np.arange(len(self.layout_layers), dtype=np.int64)
+        else:
+            previous_groups = np.asarray(self.layout_groups, dtype=np.int64)
+        group_id = int(previous_groups[-1]) + 1 if len(previous_groups) > 0 else 0
+        self.layout_layers = self.layout_layers + list(grid_layers)
+        self.layout_groups = np.concatenate([previous_groups, np.full(len(grid_layers), group_id, dtype=np.int64)])
+
+    def set_reducer(self, reducer):
+        self.grid.set_reducer(reducer)
+        self.reducer = reducer
+
+    def set_tile_cache_budget(self, budget_bytes):
+        # 0 disables the tiles, frames are read from the grid directly
+        self.tile_cache.set_budget(budget_bytes)
+
+    def set_prefetch_budget(self, budget_bytes):
+        self.tile_cache.set_prefetch_budget(budget_bytes)
+
+    def set_tile_build_deferred(self, deferred):
+        # Missing tiles are built by build_pending_tiles in the background instead of while the frame is built
+        self.tile_cache.set_deferred(deferred)
+
+    def build_pending_tiles(self, cancellation_signal, wait_func=None):
+        if not self.tile_cache.is_enabled():
+            return 0
+        return self.tile_cache.build_pending(cancellation_signal, wait_func)
+
+    def prefetch_tiles(self, col_min, row_min, col_max, row_max, factor, cancellation_signal, max_bytes,
+                       wait_func=None):
+        # Warm the tile cache for a frame that is likely to be requested next
+        if not self.tile_cache.is_enabled() or self.loaded_data_id is None:
+            return 0
+        return self.tile_cache.prefetch(self.grid, col_min, row_min, col_max, row_max, factor, cancellation_signal,
+                                        (self.loaded_data_id, self.reducer), max_bytes, wait_func)
 
     def update_visible_layers(self, bounds):
         col_min = bounds.x1
@@ -253,19 +497,25 @@ class NNet:
                                                                 factor,
                                                                 factor,
                                                                 True)
-        print("Get grid chunks", (time.time() - start_time) * 1000, "ms", "factor:", factor, "count", len(chunks))
+        logger.debug("Get grid chunks %.2f ms, factor %s, count %s", (time.time() - start_time) * 1000, factor,
+                     len(chunks))
         return chunks, dimensions
 
     def update_tex_buffer_directly(self, col_min, row_min, col_max, row_max, factor, buffer, cancellation_signal):
         start_time = time.time()
-        self.grid.update_texture_buffer_with_visible_data_directly(col_min, row_min, col_max,
-                                                                   row_max,
-                                                                   factor,
-                                                                   factor,
-                                                                   buffer,
-                                                                   cancellation_signal)
+        with profiler.span(SPAN_GRID_QUERY):
+            if self.tile_cache.is_enabled():
+                self.tile_cache.fill_buffer(self.grid, col_min, row_min, col_max, row_max, factor, buffer,
+                                            cancellation_signal, (self.loaded_data_id, self.reducer))
+            else:
+                self.grid.update_texture_buffer_with_visible_data_directly(col_min, row_min, col_max,
+                                                                           row_max,
+                                                                           factor,
+                                                                           factor,
+                                                                           buffer,
+                                                                           cancellation_signal)
         if not cancellation_signal.is_canceled():
-            print("Updated tex buffer", (time.time() - start_time) * 1000, "ms", "factor:", factor, "layers count")
+            logger.debug("Updated tex buffer %.2f ms, factor %s", (time.time() - start_time) * 1000, factor)
 
     def get_point_data(self, x, y):
         return self.grid.get_point_data(x, y)
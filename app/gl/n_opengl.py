@@ -1,3 +1,4 @@
+import logging
 import os.path
 
 import OpenGL.GL as gl
@@ -5,21 +6,32 @@ import glfw
 from OpenGL.GL import *
 
 from app.ai.model_parser import ModelParser
+from app.ai.safetensors_reader import SafetensorsCheckpoint, has_safetensors
 from app.config.app_config import LittleConfig
 from app.gl.c_color_theme import NColorTheme
 from app.gl.n_camera import CameraAnimation
 from app.gl.n_effects import NEffects
+from app.gl.n_frame_process import FrameProcessPool, FRAME_BACKEND_PROCESS
 from app.gl.n_frame_producer import NFrameProducer
 from app.gl.n_net import  NNet
+from app.gl.n_prefetcher import NPrefetcher
 from app.gl.n_scene_v2 import NSceneV2
+from app.gl.n_pixel_buffer import upload_stall_counter
+from app.gl.n_profiler import profiler, SPAN_VIEWPORT_UPDATE, SPAN_GUI
+from app.gl.n_shader import gl_call_counter
 from app.gl.n_viewport import NViewport
+from app.gl.n_viewport_trace import ViewportTraceRecorder
 from app.gl.n_window import NWindow
+from app.grid.layer_store import LayerStore, get_layer_store_path
 from app.config.download_manager import DownloadManager
 from app.gui.gui_config import GuiConfig
 from app.gui.gui_pants import GuiPants
 from app.gui.managers.image_loader import ImageLoader
+from app.logger import configure_logging
 from app.utils import FancyUtilsClass
 
+logger = logging.getLogger(__name__)
+
 
 class ScreenBuffer:
     def __init__(self, width, height):
@@ -45,6 +57,7 @@ class OpenGLApplication:
 
         self.app_config = LittleConfig()
         self.app_config.load_config()
+        configure_logging(self.app_config.log_level, self.app_config.log_rate_limit)
 
         self.n_buffer = ScreenBuffer(self.app_config.buffer_width, self.app_config.buffer_height)
 
@@ -55,6 +68,12 @@ class OpenGLApplication:
         )
 
         self.n_frame_producer = NFrameProducer(self.n_buffer)
+        self.n_frame_producer.set_texture_format(self.app_config.texture_format)
+        if self.app_config.frame_backend == FRAME_BACKEND_PROCESS:
+            # Frames of nets read from a layer store are built outside of this process
+            self.n_frame_producer.set_frame_process_pool(
+                FrameProcessPool(tile_cache_budget=self.app_config.tile_cache_mb * 1024 * 1024,
+                                 memory_budget=self.app_config.layer_memory_budget_mb * 1024 * 1024))
         self.color_theme = NColorTheme()
         self.color_theme.load_by_name(self.app_config.color_name)
 
@@ -65,6 +84,7 @@ class OpenGLApplication:
 
         self.camera_animation = CameraAnimation(self.n_window, self.n_net)
         self.n_viewport = NViewport(self.n_net, self.n_buffer, self.n_frame_producer)
+        self.n_prefetcher = NPrefetcher(self.n_viewport, self.n_frame_producer, self.camera_animation)
         self.n_effects = NEffects(self.n_net, self.n_window)
         self.model_parser = ModelParser(self.n_effects)
 
@@ -73,7 +93,16 @@ class OpenGLApplication:
                                 self.n_window,
                                 self.n_buffer)
         self.n_scene.enable_blending = self.app_config.enable_blend
+        # Press T to start and stop, traces are replayed headless by app.benchmark.replay_trace
+        self.viewport_recorder = ViewportTraceRecorder()
         self.n_viewport.power_of_two = self.app_config.power_of_two
+        self.n_net.set_reducer(self.app_config.lod_reducer)
+        self.n_net.set_layout(self.app_config.layout_type)
+        self.n_net.set_memory_budget(self.app_config.layer_memory_budget_mb * 1024 * 1024)
+        self.n_net.set_tile_cache_budget(self.app_config.tile_cache_mb * 1024 * 1024)
+        self.n_net.set_prefetch_budget(self.app_config.prefetch_mb * 1024 * 1024)
+        self.n_prefetcher.set_enabled(self.app_config.prefetch_enabled)
+        profiler.set_enabled(self.app_config.profiler_enabled)
 
         self.image_loader = ImageLoader()
         self.gui_config = GuiConfig(
@@ -109,33 +138,35 @@ class OpenGLApplication:
             self.mouse_x_world = mouse_x_world
             self.mouse_y_world = mouse_y_world
             self.on_mouse_position_changed()
+        self.n_window.frame_state.update(self.n_window.get_projection_matrix(),
+                                         self.mouse_x_world,
+                                         self.mouse_y_world)
         self.n_window.n_color_map_v2_texture_shader.use()
-        self.n_window.n_color_map_v2_texture_shader.update_projection(self.n_window.get_projection_matrix())
-        self.n_window.n_color_map_v2_texture_shader.update_mouse_position(self.mouse_x_world,
-                                                                          self.mouse_y_world)
         self.n_window.n_color_map_v2_texture_shader.update_color_map(self.color_theme.name,
                                                                      self.color_theme.color_array)
 
         self.n_window.n_billboards_from_texture_shader.use()
-        self.n_window.n_billboards_from_texture_shader.update_projection(self.n_window.get_projection_matrix())
         self.n_window.n_billboards_from_texture_shader.update_cell_billboard()
-        self.n_window.n_billboards_from_texture_shader.update_mouse_position(self.mouse_x_world,
-                                                                             self.mouse_y_world)
         self.n_window.n_billboards_from_texture_shader.update_color_map(self.color_theme.name,
                                                                         self.color_theme.color_array)
 
-        self.n_window.n_effects_shader.use()
-        self.n_window.n_effects_shader.update_projection(self.n_window.get_projection_matrix())
-
         self.n_scene.draw_scene(
             self.n_window.n_color_map_v2_texture_shader,
             self.n_window.n_billboards_from_texture_shader
         )
         self.n_effects.draw(self.n_window.n_effects_shader)
-        self.gui.render_fancy_pants()
+        with profiler.span(SPAN_GUI):
+            self.gui.render_fancy_pants()
         self.camera_animation.update_animation()
         glfw.swap_buffers(self.n_window.window)
-        self.utils.print_memory_usage()
+        gl_call_counter.end_frame()
+        upload_stall_counter.end_frame()
+
+    def is_busy(self):
+        # Screen changes without any input, the main loop keeps rendering frames
+        return (self.camera_animation.is_animating
+                or self.n_scene.is_updating()
+                or self.gui.is_active())
 
     def on_mouse_clicked(self):
         x = int(self.mouse_x_world)
@@ -158,7 +189,7 @@ class OpenGLApplication:
             self.gui_config.publish_position_message(self.mouse_x_world, self.mouse_y_world)
 
     def on_key_pressed(self, key):
-        print("key pressed", key)
+        logger.debug("Key pressed %s", key)
         if key == glfw.KEY_UP:
             self.n_window.mouse_scroll_callback(None, None, -0.1)
         if key == glfw.KEY_DOWN:
@@ -166,22 +197,54 @@ class OpenGLApplication:
         if key == glfw.KEY_C:
             self.color_theme.next()
             self.app_config.color_name = self.color_theme.name
+        if key == glfw.KEY_T:
+            self.toggle_viewport_recording()
+
+    def on_key_repeated(self, key):
+        # Toggles react to the press only
+        if key != glfw.KEY_T:
+            self.on_key_pressed(key)
+
+    def toggle_viewport_recording(self):
+        if self.viewport_recorder.is_recording():
+            path = self.viewport_recorder.stop()
+            print("Viewport trace saved", path)
+        else:
+            self.viewport_recorder.start(self.n_net.loaded_data_id)
+            print("Viewport trace recording")
 
     def on_viewport_updated(self):
-        viewport = self.n_window.viewport_to_world_cords()
-        self.n_viewport.update_viewport(viewport)
-        self.n_effects.on_viewport_changed(viewport)
-        if self.n_viewport.visible_data is not None:
-            self.n_net.update_visible_layers(self.n_viewport.visible_data)
+        with profiler.span(SPAN_VIEWPORT_UPDATE):
+            viewport = self.n_window.viewport_to_world_cords()
+            self.viewport_recorder.record(viewport)
+            self.n_viewport.update_viewport(viewport)
+            self.n_prefetcher.on_viewport_updated(viewport)
+            self.n_effects.on_viewport_changed(viewport)
+            if self.n_viewport.visible_data is not None:
+                self.n_net.update_visible_layers(self.n_viewport.visible_data)
 
     def reload_graphics_settings(self):
         self.color_theme.load_by_name(self.app_config.color_name)
         self.n_buffer.update(self.app_config.buffer_width, self.app_config.buffer_height)
+        self.n_frame_producer.set_texture_format(self.app_config.texture_format)
         self.n_scene.enable_blending = self.app_config.enable_blend
         self.n_viewport.power_of_two = self.app_config.power_of_two
+        self.n_net.set_reducer(self.app_config.lod_reducer)
+        self.n_window.set_max_fps(self.app_config.max_fps)
+        self.n_prefetcher.set_enabled(self.app_config.prefetch_enabled)
+        # Frame content may have changed even if the viewport did not move
+        self.n_viewport.invalidate()
+        self.n_prefetcher.invalidate()
+        if self.n_net.layout_type != self.app_config.layout_type:
+            self.n_net.set_layout(self.app_config.layout_type)
+            self.n_net.relayout()
+            self.reload_view()
         self.on_viewport_updated()
 
     def reload_view(self):
+        # Frames of the previous data can't be reused
+        self.n_viewport.invalidate()
+        self.n_prefetcher.invalidate()
         # update tree size and depth using grid size
         self.n_viewport.set_grid_size(self.n_net.total_width, self.n_net.total_height)
         # calculate min zoom using grid size
@@ -196,18 +259,56 @@ class OpenGLApplication:
         self.n_net.clear()
         self.load_model()
 
+    def open_layer_store(self):
+        """
+        Memory mapped weights of the parsed model, written on the first load of the model
+        :return: LayerStore or None when the store is disabled, the model has no checkpoint files or the store
+        can't be written
+        """
+        if not self.app_config.layer_store_enabled:
+            return None
+        source_files = self.model_parser.get_layer_store_source_files()
+        if source_files is None:
+            # Model passed in memory, nothing tells if a store written earlier holds the same weights
+            return None
+        layer_store = LayerStore(get_layer_store_path(self.model_parser.current_model_name))
+        dtype = self.app_config.layer_store_dtype
+        if layer_store.matches(self.model_parser.get_layer_store_source(),
+                               self.model_parser.get_parameters_shapes(),
+                               dtype,
+                               source_files):
+            print("Layer store loaded", layer_store.data_path)
+            return layer_store
+        try:
+            return self.model_parser.write_layer_store(layer_store, dtype)
+        except OSError as e:
+            print(f"Failed to write layer store with error: {e}")
+            return None
+
     def load_model(self,
                    model=None,
-                   model_directory=None):
-        print("Load model", "Model=", model, "Model directory=", model_directory)
+                   model_directory=None,
+                   layer_store_path=None):
+        print("Load model", "Model=", model, "Model directory=", model_directory, "Layer store=", layer_store_path)
         if model is None and model_directory is None and self.app_config.model_directory is not None and os.path.exists(
                 self.app_config.model_directory):
             model_directory = self.app_config.model_directory
 
-        if model is not None:
+        if layer_store_path is not None:
+            # Weights only, no torch model to run pipelines with
+            layer_store = LayerStore(layer_store_path).open()
+            self.n_net.init_from_layer_store(layer_store)
+        elif model is not None:
             self.model_parser.set_model(model)
             self.model_parser.parse_loaded_model()
-            self.n_net.init_from_model_parser(self.model_parser)
+            self.n_net.init_from_model_parser(self.model_parser, self.open_layer_store())
+        elif (model_directory is not None and self.app_config.lazy_model_loading
+              and has_safetensors(model_directory)):
+            # Weights straight from the checkpoint, the model is built when a pipeline runs
+            self.model_parser.set_model_directory(model_directory)
+            self.app_config.model_directory = model_directory
+            checkpoint = SafetensorsCheckpoint(model_directory).open()
+            self.n_net.init_from_safetensors(checkpoint, self.model_parser.current_model_name)
         elif model_directory is not None and os.path.exists(model_directory):
             self.model_parser.load_model_from_path(model_directory)
             self.model_parser.load_tokenizer_from_path(model_directory)
@@ -215,11 +316,11 @@ class OpenGLApplication:
             self.model_parser.load_feature_extractor_from_path(model_directory)
             self.app_config.model_directory = model_directory
             self.model_parser.parse_loaded_model()
-            self.n_net.init_from_model_parser(self.model_parser)
+            self.n_net.init_from_model_parser(self.model_parser, self.open_layer_store())
             #
             # self.n_net.weights_net.init_from_tensors(self.model_parser.named_parameters(),
             #                                          save_to_memfile=save_mem_file)
-        if self.model_parser.model is None:
+        if not self.model_parser.has_model() and layer_store_path is None:
             print("No model to load!", "Showing welcome message")
             welcome_message = self.utils.create_logo_message()
             self.n_net.init_from_np_arrays([welcome_message], ["welcome_layer"])
@@ -234,7 +335,8 @@ class OpenGLApplication:
 
     def start(self,
               model=None,
-              model_directory=None):
+              model_directory=None,
+              layer_store_path=None):
         # self.reload_config()
         self.n_window.create_window()
         # self.n_window.set_callbacks()
@@ -242,10 +344,14 @@ class OpenGLApplication:
         self.gui.attach_fancy_gui()
         self.gui.set_callbacks()
         self.n_window.set_render_func(self.render)
-        self.n_window.set_key_repeat_func(self.on_key_pressed)
+        self.n_window.set_key_repeat_func(self.on_key_repeated)
         self.n_window.set_key_pressed_func(self.on_key_pressed)
         self.n_window.set_on_click_func(self.on_mouse_clicked)
         self.n_window.set_viewport_updated_func(self.on_viewport_updated)
+        self.n_window.set_busy_func(self.is_busy)
+        self.n_window.set_max_fps(self.app_config.max_fps)
+        self.n_window.idle_redraw_interval = self.app_config.idle_redraw_interval
+        self.n_frame_producer.set_frame_ready_func(self.n_window.request_redraw)
         glEnable(GL_DEPTH_TEST)
         glDepthMask(GL_FALSE)
         gl.glEnable(gl.GL_BLEND)
@@ -255,21 +361,29 @@ class OpenGLApplication:
 
         print(f"OpenGL version: {version.decode('utf-8')}")
 
+        self.utils.memory_monitor.start(self.app_config.memory_monitor_interval)
+        self.n_window.frame_state.create()
         self.n_window.n_color_map_v2_texture_shader.compile_color_map_v2_texture_program()
         self.n_window.n_billboards_from_texture_shader.compile_billboards_v2_program()
         self.n_window.n_effects_shader.compile_effects_program()
 
         self.utils.print_memory_usage()
 
-        self.load_model(model, model_directory)
+        self.load_model(model, model_directory, layer_store_path)
         # self.n_effects.init()
         print("Main loop")
         self.n_window.start_main_loop()
+        if self.viewport_recorder.is_recording():
+            self.toggle_viewport_recording()
+        self.n_prefetcher.shutdown()
+        self.n_frame_producer.shutdown()
+        self.utils.memory_monitor.stop()
 
         glfw.terminate()
         gl.glDeleteProgram(self.n_window.n_color_map_v2_texture_shader.shader_program)
         gl.glDeleteProgram(self.n_window.n_billboards_from_texture_shader.shader_program)
         gl.glDeleteProgram(self.n_window.n_effects_shader.shader_program)
+        self.n_window.frame_state.destroy()
 
         self.app_config.window_width = self.n_window.width
         self.app_config.window_height = self.n_window.height
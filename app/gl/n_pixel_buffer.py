@@ -0,0 +1,174 @@
+import ctypes
+import logging
+import time
+
+import OpenGL.GL as gl
+import numpy as np
+
+# Frame being copied, frame in the DMA queue and one for the GPU to finish with
+PIXEL_BUFFERS_COUNT = 3
+# Nanoseconds per fence poll while waiting for a buffer still read by the GPU
+FENCE_WAIT_TIMEOUT = 1000000
+# glBufferStorage is core since GL 4.4, older contexts may provide the extension
+BUFFER_STORAGE_VERSION = (4, 4)
+BUFFER_STORAGE_EXTENSION = b"GL_ARB_buffer_storage"
+
+logger = logging.getLogger(__name__)
+
+
+class UploadStallCounter:
+    """
+    Time the render loop waited for a pixel buffer still read by the GPU, per frame and in total
+    """
+
+    def __init__(self):
+        self.uploads_count = 0
+        self.stalls_count = 0
+        self.total_stall_ms = 0.0
+        self.max_stall_ms = 0.0
+        self.stall_ms = 0.0
+        self.frame_stall_ms = 0.0
+
+    def add_upload(self, stall_ms):
+        self.uploads_count += 1
+        if stall_ms > 0:
+            self.stalls_count += 1
+            self.total_stall_ms += stall_ms
+            self.max_stall_ms = max(self.max_stall_ms, stall_ms)
+            self.stall_ms += stall_ms
+
+    def end_frame(self):
+        self.frame_stall_ms = self.stall_ms
+        self.stall_ms = 0.0
+
+
+upload_stall_counter = UploadStallCounter()
+
+
+def has_buffer_storage():
+    """
+    True when the current context supports glBufferStorage
+    PyOpenGL resolves the function pointer from the driver, it can be set on contexts that don't support the call.
+    """
+    if not gl.glBufferStorage:
+        return False
+    version = (int(gl.glGetIntegerv(gl.GL_MAJOR_VERSION)), int(gl.glGetIntegerv(gl.GL_MINOR_VERSION)))
+    if version >= BUFFER_STORAGE_VERSION:
+        return True
+    extensions_count = int(gl.glGetIntegerv(gl.GL_NUM_EXTENSIONS))
+    return any(gl.glGetStringi(gl.GL_EXTENSIONS, index) == BUFFER_STORAGE_EXTENSION
+               for index in range(extensions_count))
+
+
+class PixelBuffer:
+    def __init__(self, buffer_id):
+        self.buffer_id = buffer_id
+        # Bytes of the persistent mapping, None when the buffer is mapped for each upload
+        self.mapped_data = None
+        # Signaled when the GPU is done reading the last upload
+        self.fence = None
+
+
+class PixelUploadRing:
+    """
+    Texture uploads through a ring of pixel buffer objects
+
+    Frame data is copied into the next buffer of the ring and glTexSubImage2D reads it from there,
+    the call only queues the transfer instead of waiting for the driver to copy the frame.
+    Buffers are mapped once with glBufferStorage (GL 4.4 or GL_ARB_buffer_storage, also provided by
+    Mesa llvmpipe), other contexts map the buffer for each upload and invalidate its previous content.
+    A buffer is reused when the fence of its last upload is signaled, the wait is counted by upload_stall_counter.
+    """
+
+    def __init__(self, count=PIXEL_BUFFERS_COUNT):
+        self.count = count
+        self.buffers = []
+        self.size = 0
+        self.next_index = 0
+        self.persistent = False
+
+    def create(self, size):
+        self.destroy()
+        self.size = size
+        self.persistent = has_buffer_storage()
+        flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT
+        for buffer_id in np.atleast_1d(gl.glGenBuffers(self.count)):
+            pixel_buffer = PixelBuffer(int(buffer_id))
+            gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, pixel_buffer.buffer_id)
+            if self.persistent:
+                gl.glBufferStorage(gl.GL_PIXEL_UNPACK_BUFFER, size, None, flags)
+                pixel_buffer.mapped_data = self._map(size, flags)
+            else:
+                gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, size, None, gl.GL_STREAM_DRAW)
+            self.buffers.append(pixel_buffer)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        logger.info("Pixel buffers created %s x %s MB %s", self.count, size // 1024 // 1024,
+                    "persistent" if self.persistent else "mapped per upload")
+
+    def _map(self, size, flags):
+        address = gl.glMapBufferRange(gl.GL_PIXEL_UNPACK_BUFFER, 0, size, flags)
+        address = ctypes.cast(address, ctypes.c_void_p).value
+        return np.ctypeslib.as_array((ctypes.c_ubyte * size).from_address(address))
+
+    def upload(self, frame_data, regions, pixel_type=gl.GL_FLOAT):
+        """
+        Upload (row, col, rows, cols) regions of frame_data into the texture bound to GL_TEXTURE_2D
+        Regions are packed one after the other into the pixel buffer, pixel_type matches the dtype of frame_data.
+        """
+        pixel_buffer = self.buffers[self.next_index]
+        self.next_index = (self.next_index + 1) % self.count
+        stall_ms = self._wait(pixel_buffer)
+
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, pixel_buffer.buffer_id)
+        mapped_data = pixel_buffer.mapped_data
+        if mapped_data is None:
+            mapped_data = self._map(self.size, gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_BUFFER_BIT)
+        offset = 0
+        offsets = []
+        for row, col, rows, cols in regions:
+            size = rows * cols * frame_data.itemsize
+            mapped_data[offset:offset + size].view(frame_data.dtype).reshape(rows, cols)[:] = \
+                frame_data[row:row + rows, col:col + cols]
+            offsets.append(offset)
+            offset += size
+        if pixel_buffer.mapped_data is None:
+            gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+
+        # Rows of half float and 8 bit regions are not padded to 4 bytes
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        for (row, col, rows, cols), offset in zip(regions, offsets):
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, col, row, cols, rows, gl.GL_RED, pixel_type,
+                               ctypes.c_void_p(offset))
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        pixel_buffer.fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        upload_stall_counter.add_upload(stall_ms)
+        return stall_ms
+
+    def _wait(self, pixel_buffer):
+        if pixel_buffer.fence is None:
+            return 0.0
+        stall_ms = 0.0
+        status = gl.glClientWaitSync(pixel_buffer.fence, 0, 0)
+        if status == gl.GL_TIMEOUT_EXPIRED:
+            start_time = time.perf_counter()
+            while status == gl.GL_TIMEOUT_EXPIRED:
+                status = gl.glClientWaitSync(pixel_buffer.fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, FENCE_WAIT_TIMEOUT)
+            stall_ms = (time.perf_counter() - start_time) * 1000
+        gl.glDeleteSync(pixel_buffer.fence)
+        pixel_buffer.fence = None
+        return stall_ms
+
+    def destroy(self):
+        if len(self.buffers) == 0:
+            return
+        for pixel_buffer in self.buffers:
+            if pixel_buffer.fence is not None:
+                gl.glDeleteSync(pixel_buffer.fence)
+            if pixel_buffer.mapped_data is not None:
+                gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, pixel_buffer.buffer_id)
+                gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+            gl.glDeleteBuffers(1, [pixel_buffer.buffer_id])
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        self.buffers = []
+        self.size = 0
+        self.next_index = 0
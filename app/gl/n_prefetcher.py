@@ -0,0 +1,254 @@
+import logging
+import math
+import threading
+import time
+import traceback
+from collections import deque
+
+from app.gl.n_frame_producer import CancellationSignal
+
+# Viewport changes older than this are not used for the velocity
+MOTION_WINDOW = 0.25
+# Seconds after the last viewport change, the frames the user will most likely see next
+PREDICTION_HORIZONS = [0.1, 0.25, 0.5]
+# Zoom levels predicted along the path of a camera animation
+MAX_ANIMATION_LEVELS = 8
+IDLE_POLL_INTERVAL = 0.005
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchJob:
+    def __init__(self, visible_grids, max_bytes):
+        self.visible_grids = visible_grids
+        self.max_bytes = max_bytes
+        self.cancellation_signal = CancellationSignal()
+
+    def cancel(self):
+        self.cancellation_signal.emit()
+
+
+class NPrefetcher:
+    """
+    Tiles of the frames likely to be requested next, built in the background while the frame workers are idle
+
+    Frames are predicted from the pan velocity and the zoom direction of the last viewport changes
+    and from the target of the camera animation. Every viewport change cancels the previous prediction.
+    Tiles go to the tile cache of the net, so the next frame is assembled from cached tiles instead of
+    being read from the grid while the old frame is on screen.
+
+    Tiles built per prediction are capped by the prefetch budget of the tile cache, unused predictions
+    are dropped first when the budget is reached.
+
+    Enabled, it also builds the tiles missing from the frames that were read from the grid directly,
+    before the predictions, see TileCache.build_pending.
+    """
+
+    def __init__(self, n_viewport, n_frame_producer, camera_animation):
+        self.n_viewport = n_viewport
+        self.n_net = n_viewport.n_net
+        self.n_frame_producer = n_frame_producer
+        self.camera_animation = camera_animation
+        self.enabled = True
+        self.n_net.set_tile_build_deferred(True)
+        # (time, center x, center y, width, height) of the last viewport changes
+        self.history = deque(maxlen=16)
+        # 1 zooming out, -1 zooming in, 0 unknown
+        self.zoom_direction = 0
+        self.pending_job = None
+        self.active_job = None
+        self.built_bytes = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._work, name="frame_prefetcher", daemon=True)
+        self.thread.start()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        # Frames don't wait for missing tiles while the prefetcher builds them
+        self.n_net.set_tile_build_deferred(enabled)
+        if enabled and not self.n_net.tile_cache.is_enabled():
+            logger.warning("Prefetch is enabled but the tile cache is off, nothing is prefetched")
+        if not enabled:
+            self.cancel()
+
+    def on_viewport_updated(self, viewport):
+        now = time.time()
+        x, y, w, h, zoom = viewport
+        if len(self.history) > 0:
+            previous_w = self.history[-1][3]
+            if abs(w - previous_w) > previous_w * 1e-6:
+                self.zoom_direction = 1 if w > previous_w else -1
+        self.history.append((now, x + w / 2, y + h / 2, w, h))
+
+        if (not self.enabled
+                or not self.n_net.tile_cache.is_enabled()
+                # Frame processes have their own tile caches
+                or self.n_frame_producer.uses_frame_processes(self.n_net)):
+            return
+        self.submit(self.predict_visible_grids(self.predict_viewports(viewport, now)))
+
+    def get_velocity(self, now):
+        """
+        Pan velocity in world units per second and zoom rate (log of the size change per second)
+        None when the viewport did not move recently
+        """
+        samples = [sample for sample in self.history if now - sample[0] <= MOTION_WINDOW]
+        if len(samples) < 2:
+            return None
+        t1, cx1, cy1, w1, _ = samples[0]
+        t2, cx2, cy2, w2, _ = samples[-1]
+        dt = t2 - t1
+        if dt < 0.001 or w1 <= 0 or w2 <= 0:
+            return None
+        return (cx2 - cx1) / dt, (cy2 - cy1) / dt, math.log(w2 / w1) / dt
+
+    def predict_viewports(self, viewport, now):
+        # Most urgent first, tiles are built in this order until the budget is used up
+        viewports = []
+        if self.camera_animation.is_animating:
+            viewports.extend(self.get_animation_viewports(viewport))
+
+        velocity = self.get_velocity(now)
+        if velocity is not None:
+            vx, vy, zoom_rate = velocity
+            x, y, w, h, zoom = viewport
+            for horizon in PREDICTION_HORIZONS:
+                scale = math.exp(zoom_rate * horizon)
+                viewports.append(self.scale_viewport(viewport, scale, x + w / 2 + vx * horizon,
+                                                     y + h / 2 + vy * horizon))
+
+        if self.zoom_direction != 0:
+            # Next detail level in the last zoom direction
+            x, y, w, h, zoom = viewport
+            viewports.append(self.scale_viewport(viewport, 2.0 ** self.zoom_direction, x + w / 2, y + h / 2))
+        return viewports
+
+    def get_animation_viewports(self, viewport):
+        """
+        Viewports along the camera animation: pan to the target at the current zoom,
+        then one viewport per detail level until the target zoom
+        """
+        animation = self.camera_animation
+        n_window = animation.n_window
+        x, y, w, h, zoom = viewport
+        viewports = [self.scale_viewport(viewport, 1.0, animation.left, animation.bottom)]
+        target_zoom = min(max(animation.target_zoom, n_window.min_zoom), n_window.max_zoom)
+        if zoom <= 0 or target_zoom <= 0:
+            return viewports
+        # World size is inversely proportional to the zoom
+        final_scale = zoom / target_zoom
+        levels = min(MAX_ANIMATION_LEVELS, int(abs(math.log2(final_scale))))
+        step = 2.0 if final_scale > 1 else 0.5
+        for level in range(1, levels + 1):
+            viewports.append(self.scale_viewport(viewport, step ** level, animation.left, animation.bottom))
+        viewports.append(self.scale_viewport(viewport, final_scale, animation.left, animation.bottom))
+        return viewports
+
+    def scale_viewport(self, viewport, scale, center_x, center_y):
+        x, y, w, h, zoom = viewport
+        w = w * scale
+        h = h * scale
+        return center_x - w / 2, center_y - h / 2, w, h, zoom / scale
+
+    def predict_visible_grids(self, viewports):
+        n_viewport = self.n_viewport
+        current = n_viewport.visible_data
+        visible_grids = []
+        keys = set()
+        for viewport in viewports:
+            x, y, w, h, zoom = viewport
+            if w <= 0 or h <= 0:
+                continue
+            factor, _, _ = n_viewport.calculate_details_factor(viewport)
+            x1 = max(x, n_viewport.world_x1)
+            y1 = max(y, n_viewport.world_y1)
+            x2 = min(x + w, n_viewport.world_x2)
+            y2 = min(y + h, n_viewport.world_y2)
+            if x1 >= x2 or y1 >= y2:
+                continue
+            if current is not None and current.contains(x1, y1, x2, y2, factor):
+                # Current frame is kept for this viewport
+                continue
+            visible_grid = n_viewport.create_visible_grid(viewport, factor)
+            key = (visible_grid.x1, visible_grid.y1, visible_grid.x2, visible_grid.y2, factor)
+            if visible_grid.w <= 0 or visible_grid.h <= 0 or key in keys:
+                continue
+            keys.add(key)
+            visible_grids.append(visible_grid)
+        return visible_grids
+
+    def submit(self, visible_grids):
+        with self.condition:
+            self._cancel_jobs()
+            # Without predictions the job still builds the tiles missing from the last frames
+            self.pending_job = PrefetchJob(visible_grids, self.n_net.tile_cache.get_prefetch_limit())
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self._cancel_jobs()
+
+    def invalidate(self):
+        # Content of the grid changed, the motion history is still valid
+        self.cancel()
+
+    def _cancel_jobs(self):
+        if self.pending_job is not None:
+            self.pending_job.cancel()
+            self.pending_job = None
+        if self.active_job is not None:
+            self.active_job.cancel()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending_job is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                job = self.pending_job
+                self.pending_job = None
+                self.active_job = job
+            try:
+                self._run(job)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    if self.active_job is job:
+                        self.active_job = None
+
+    def _run(self, job):
+        # Tiles of the frames on screen first, they are not counted as predictions
+        self.n_net.build_pending_tiles(job.cancellation_signal, self._wait_idle)
+        remaining_bytes = job.max_bytes
+        # Frame buffer shape is (buffer_width, buffer_height), tiles past it are never copied
+        buffer_rows = self.n_viewport.n_buffer.buffer_width
+        buffer_cols = self.n_viewport.n_buffer.buffer_height
+        for visible_grid in job.visible_grids:
+            if job.cancellation_signal.is_canceled() or remaining_bytes <= 0:
+                return
+            factor = visible_grid.factor
+            built_bytes = self.n_net.prefetch_tiles(visible_grid.x1,
+                                                    visible_grid.y1,
+                                                    min(visible_grid.x2, visible_grid.x1 + buffer_cols * factor),
+                                                    min(visible_grid.y2, visible_grid.y1 + buffer_rows * factor),
+                                                    factor,
+                                                    job.cancellation_signal,
+                                                    remaining_bytes,
+                                                    self._wait_idle)
+            remaining_bytes -= built_bytes
+            self.built_bytes += built_bytes
+
+    def _wait_idle(self):
+        # Frames on screen come first, a tile is only built while no frame is in progress
+        while self.running and self.n_frame_producer.is_busy():
+            time.sleep(IDLE_POLL_INTERVAL)
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self._cancel_jobs()
+            self.condition.notify_all()
+        self.thread.join()
@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import time
+from array import array
+from collections import deque
+
+import numpy as np
+
+SPAN_VIEWPORT_UPDATE = "viewport update"
+SPAN_GRID_QUERY = "grid query"
+SPAN_FRAME_BUILD = "frame build"
+SPAN_TEXTURE_UPLOAD = "texture upload"
+SPAN_DRAW = "draw calls"
+SPAN_GUI = "imgui render"
+# Order of the overlay
+SPANS = [SPAN_VIEWPORT_UPDATE, SPAN_GRID_QUERY, SPAN_FRAME_BUILD, SPAN_TEXTURE_UPLOAD, SPAN_DRAW, SPAN_GUI]
+# Durations kept per span for the overlay histograms
+SPAN_HISTORY = 240
+# Last spans kept for the Chrome trace, about 10 seconds of the render loop with all the spans
+MAX_TRACE_EVENTS = 100000
+
+
+def get_profile_directory():
+    return os.path.join(os.path.expanduser("~"), ".cache", "mylittlenet", "profiles")
+
+
+class SpanTimings:
+    """
+    Rolling durations of one span in ms
+    """
+
+    def __init__(self, history=SPAN_HISTORY):
+        self.durations = deque(maxlen=history)
+        self.count = 0
+
+    def add(self, duration_ms):
+        self.durations.append(duration_ms)
+        self.count += 1
+
+    def get_values(self):
+        # Format of imgui.plot_lines
+        return array('f', self.durations)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    __slots__ = ("profiler", "name", "start_time")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, self.start_time, time.perf_counter())
+        return False
+
+
+class Profiler:
+    """
+    Named spans of the render loop and of the frame workers
+
+        with profiler.span(SPAN_GRID_QUERY):
+            ...
+
+    Disabled, span() returns a shared empty context manager and nothing is timed or stored.
+    Enabled, every span goes to the rolling durations shown by the GUI overlay and to the Chrome trace,
+    save_chrome_trace writes the last spans in the format of chrome://tracing and Perfetto.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = {name: SpanTimings() for name in SPANS}
+        self.trace_events = deque(maxlen=MAX_TRACE_EVENTS)
+        self.origin_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def set_enabled(self, enabled):
+        if enabled and not self.enabled:
+            # Histograms and trace start empty, they don't mix with an earlier session
+            self.clear()
+        self.enabled = enabled
+
+    def clear(self):
+        with self.lock:
+            self.spans = {name: SpanTimings() for name in SPANS}
+            self.trace_events.clear()
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def get_summary(self, percentiles):
+        """
+        Copy of the rolling durations, the frame workers keep adding spans while the GUI reads them
+        :return: list of (name, spans count, percentiles of the durations, durations)
+        """
+        summary = []
+        with self.lock:
+            for name, timings in self.spans.items():
+                summary.append((name, timings.count, timings.get_values()))
+        return [(name, count, np.percentile(values, percentiles).tolist() if len(values) > 0
+                 else [0.0] * len(percentiles), values)
+                for name, count, values in summary]
+
+    def add(self, name, start_time, end_time):
+        with self.lock:
+            timings = self.spans.get(name)
+            if timings is None:
+                timings = self.spans[name] = SpanTimings()
+            timings.add((end_time - start_time) * 1000)
+            self.trace_events.append((name, start_time, end_time, threading.get_ident()))
+
+    def save_chrome_trace(self, path=None):
+        """
+        Spans as complete events ("ph": "X") with one row per thread
+        :return: path of the saved trace
+        """
+        if path is None:
+            directory = get_profile_directory()
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"profile_{time.strftime('%Y%m%d_%H%M%S')}.json")
+        with self.lock:
+            trace_events = list(self.trace_events)
+        process_id = os.getpid()
+        events = []
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id in {event[3] for event in trace_events}:
+            events.append({"name": "thread_name", "ph": "M", "pid": process_id, "tid": thread_id,
+                           "args": {"name": thread_names.get(thread_id, str(thread_id))}})
+        for name, start_time, end_time, thread_id in trace_events:
+            events.append({"name": name, "cat": "frame", "ph": "X", "pid": process_id, "tid": thread_id,
+                           "ts": (start_time - self.origin_time) * 1000000,
+                           "dur": (end_time - start_time) * 1000000})
+        with open(path, 'w') as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        return path
+
+
+profiler = Profiler()
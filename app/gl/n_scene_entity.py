@@ -1,10 +1,23 @@
+import logging
 import math
 import time
 
 import OpenGL.GL as gl
 import numpy as np
 
+from app.gl.n_pixel_buffer import PixelUploadRing
 from app.gl.n_quad import NQuad
+from app.gl.n_texture_format import get_texture_format, TEXTURE_FORMAT_FLOAT32, TEXTURE_FORMAT_FLOAT16, \
+    TEXTURE_FORMAT_UINT8, NO_VALUE_RANGE
+
+logger = logging.getLogger(__name__)
+
+# Texture format name -> (internal format, pixel type)
+GL_TEXTURE_FORMATS = {
+    TEXTURE_FORMAT_FLOAT32: (gl.GL_R32F, gl.GL_FLOAT),
+    TEXTURE_FORMAT_FLOAT16: (gl.GL_R16F, gl.GL_HALF_FLOAT),
+    TEXTURE_FORMAT_UINT8: (gl.GL_R8, gl.GL_UNSIGNED_BYTE),
+}
 
 
 class EntityV2:
@@ -16,7 +29,8 @@ class EntityV2:
 
         self.node_quad_vbo = None
         self.vao = None
-        self.pbo = None
+        # Frames go to the textures through pixel buffer objects
+        self.pixel_upload = PixelUploadRing()
 
         self.frame_data = None
         self.created = False
@@ -45,7 +59,13 @@ class EntityV2:
         self.second_texture_factor = None
         self.current_texture_factor = None
 
-        self.pbo_id = None
+        # Read framebuffer used to copy between the two textures
+        self.copy_fbo = None
+        # Visible grid part uploaded to each texture
+        self.texture_grid_parts = {}
+        self.texture_format = get_texture_format(TEXTURE_FORMAT_FLOAT32)
+        # (scale, offset) of the quantized values of each texture
+        self.texture_value_ranges = {}
 
         self.scheduled = False
 
@@ -73,17 +93,22 @@ class EntityV2:
         ], dtype=np.float32)
         return tex_coords
 
-    def create_data_container_texture(self, width, height):
+    def create_data_container_texture(self, width, height, texture_format):
         self.width = width
         self.height = height
+        self.texture_grid_parts = {}
+        self.texture_format = texture_format
+        self.texture_value_ranges = {}
+        internal_format, pixel_type = GL_TEXTURE_FORMATS[texture_format.name]
         self.frame_data = np.full((self.width, self.height), fill_value=-1, dtype=np.float32)
         self.num_instances = self.width * self.height
+        self.pixel_upload.create(texture_format.get_texture_bytes(self.width, self.height))
 
         # base texture
         self.base_texture = gl.glGenTextures(1)
         gl.glActiveTexture(self.gl_base_texture_unit)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.base_texture)
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_R32F, width, height, 0, gl.GL_RED, gl.GL_FLOAT, None)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, internal_format, width, height, 0, gl.GL_RED, pixel_type, None)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_BORDER)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_BORDER)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
@@ -97,7 +122,7 @@ class EntityV2:
         self.prev_texture = gl.glGenTextures(1)
         gl.glActiveTexture(self.gl_prev_texture_unit)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.prev_texture)
-        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_R32F, width, height, 0, gl.GL_RED, gl.GL_FLOAT, None)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, internal_format, width, height, 0, gl.GL_RED, pixel_type, None)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_BORDER)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_BORDER)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
@@ -160,21 +185,30 @@ class EntityV2:
             gl.glDeleteBuffers(1, [self.ebo])
             gl.glDeleteVertexArrays(1, [self.vao])
             gl.glDeleteTextures(1, [self.base_texture])
+            self.pixel_upload.destroy()
+            if self.copy_fbo is not None:
+                gl.glDeleteFramebuffers(1, [self.copy_fbo])
+                self.copy_fbo = None
             self.created = False
 
     def update_entity(self, current_frame, buffer_w, buffer_h):
         start_time = time.time()
-        frame_data = current_frame.data
+        frame_data = current_frame.texture_data
 
         if buffer_w != self.width or buffer_h != self.height:
-            print("Buffer mismatch!")
+            logger.warning("Buffer mismatch!")
+            return
+        if current_frame.texture_format is not self.texture_format:
+            logger.warning("Texture format mismatch!")
             return
+        _, pixel_type = GL_TEXTURE_FORMATS[self.texture_format.name]
 
         prev_quad = self.visible_grid_part
 
         self.visible_grid_part = current_frame.visible_grid_part
         self.current_texture_factor = self.visible_grid_part.factor
 
+        source_texture = self.active_texture
         if self.active_texture_index == 0:
             self.active_texture_index = 1
             self.gl_active_texture_unit = self.gl_prev_texture_unit
@@ -185,9 +219,22 @@ class EntityV2:
             self.active_texture = self.base_texture
 
         gl.glActiveTexture(self.gl_active_texture_unit)
-        gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, self.width, self.height, gl.GL_RED, gl.GL_FLOAT,
-                           frame_data)
-        print("Updated entity", (time.time() - start_time) * 1000, "ms")
+        shift = current_frame.shift
+        if (shift is not None
+                and self.texture_grid_parts.get(source_texture) is shift.source_grid_part
+                and self.copy_texture_region(source_texture, shift)):
+            # Pan at the same factor, the previous texture is shifted on the GPU and only the changed strips are sent
+            regions = shift.get_changed_regions(self.visible_grid_part, self.height, self.width)
+            stall_ms = self.pixel_upload.upload(frame_data, regions, pixel_type)
+            logger.debug("Updated entity %.2f ms, shifted, regions %s, stall %.2f ms",
+                         (time.time() - start_time) * 1000, len(regions), stall_ms)
+        else:
+            # Same bytes as a glTexSubImage2D of the whole buffer
+            stall_ms = self.pixel_upload.upload(frame_data.reshape(self.height, self.width),
+                                                [(0, 0, self.height, self.width)], pixel_type)
+            logger.debug("Updated entity %.2f ms, stall %.2f ms", (time.time() - start_time) * 1000, stall_ms)
+        self.texture_grid_parts[self.active_texture] = self.visible_grid_part
+        self.texture_value_ranges[self.active_texture] = current_frame.value_range
 
         x1, y1, x2, y2 = self.visible_grid_part.get_quad_position(buffer_w, buffer_h)
         self.quad.update_quad_position(x1, y1, x2, y2)
@@ -207,6 +254,33 @@ class EntityV2:
                 if self.visible_grid_part.zoom > prev_quad.zoom:
                     self.locked = True
 
+    def copy_texture_region(self, source_texture, shift):
+        """
+        Copy the overlap of the shifted frame from source_texture to the active texture
+        The source is attached to a read framebuffer, glCopyTexSubImage2D writes into the bound texture.
+        """
+        if self.copy_fbo is None:
+            self.copy_fbo = gl.glGenFramebuffers(1)
+        previous_fbo = gl.glGetIntegerv(gl.GL_READ_FRAMEBUFFER_BINDING)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.copy_fbo)
+        gl.glFramebufferTexture2D(gl.GL_READ_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D,
+                                  source_texture, 0)
+        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
+        copied = gl.glCheckFramebufferStatus(gl.GL_READ_FRAMEBUFFER) == gl.GL_FRAMEBUFFER_COMPLETE
+        if copied:
+            gl.glCopyTexSubImage2D(gl.GL_TEXTURE_2D, 0, shift.dst_col, shift.dst_row,
+                                   shift.src_col, shift.src_row, shift.cols, shift.rows)
+        else:
+            # Every panned frame on drivers without a complete R8 or R16F attachment, rate limited per call site
+            logger.warning("Texture copy framebuffer incomplete, uploading the whole frame")
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, previous_fbo)
+        return copied
+
+    def get_value_ranges(self):
+        # Value ranges of tex1 and tex2 of the shaders
+        return (self.texture_value_ranges.get(self.base_texture, NO_VALUE_RANGE),
+                self.texture_value_ranges.get(self.prev_texture, NO_VALUE_RANGE))
+
     def get_fade_progress(self):
         if self.start_time is None:
             return 0
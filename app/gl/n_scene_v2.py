@@ -1,5 +1,10 @@
+import logging
+
+from app.gl.n_profiler import profiler, SPAN_TEXTURE_UPLOAD, SPAN_DRAW
 from app.gl.n_scene_entity import EntityV2
 
+logger = logging.getLogger(__name__)
+
 
 class NSceneV2:
     def __init__(self, n_net, n_viewport, n_window, n_buffer):
@@ -26,7 +31,7 @@ class NSceneV2:
     def update_scene(self):
         current_frame = self.n_viewport.frame_producer.get_current_frame()
         if current_frame is None:
-            print("current frame none")
+            logger.debug("Current frame none")
             return
 
         current_quad = current_frame.visible_grid_part
@@ -42,15 +47,25 @@ class NSceneV2:
             if not current_frame.ready:
                 return
             self.force_update = False
-            self.entity.update_entity(current_frame, self.current_width, self.current_height)
+            with profiler.span(SPAN_TEXTURE_UPLOAD):
+                self.entity.update_entity(current_frame, self.current_width, self.current_height)
 
-            print("update entity",
-                  "current factor", self.entity.current_texture_factor)
+            logger.debug("Update entity, current factor %s", self.entity.current_texture_factor)
+
+    def is_updating(self):
+        # Fading between textures or a ready frame that is not uploaded yet
+        if self.entity.is_fading or self.entity.locked or self.force_update:
+            return True
+        current_frame = self.n_viewport.frame_producer.get_current_frame()
+        return (current_frame is not None
+                and current_frame.ready
+                and self.entity.visible_grid_part != current_frame.visible_grid_part)
 
     def draw_textures(self, n_color_map_v2_texture_shader, alpha_factor):
         n_color_map_v2_texture_shader.use()
         n_color_map_v2_texture_shader.select_texture(self.entity.active_texture_index)
         n_color_map_v2_texture_shader.mix_textures(self.entity.get_fade_progress())
+        n_color_map_v2_texture_shader.update_value_ranges(*self.entity.get_value_ranges())
         n_color_map_v2_texture_shader.update_fading_factor(alpha_factor)
         self.entity.draw_texture()
 
@@ -76,11 +91,14 @@ class NSceneV2:
         n_billboards_from_texture_shader.update_details_factor(self.entity.visible_grid_part.factor)
         n_billboards_from_texture_shader.update_position_offset(self.entity.visible_grid_part.offset_x,
                                                                 self.entity.visible_grid_part.offset_y)
+        n_billboards_from_texture_shader.update_value_ranges(*self.entity.get_value_ranges())
         n_billboards_from_texture_shader.select_texture(self.entity.active_texture_index)
         self.entity.draw_billboards(size, 1)
 
     def was_buffer_updated(self):
-        return self.current_width != self.n_buffer.buffer_width or self.current_height != self.n_buffer.buffer_height
+        return (self.current_width != self.n_buffer.buffer_width
+                or self.current_height != self.n_buffer.buffer_height
+                or self.entity.texture_format is not self.n_viewport.frame_producer.texture_format)
 
     def draw_scene(self,
                    n_color_map_v2_texture_shader,
@@ -92,7 +110,8 @@ class NSceneV2:
             self.current_height = self.n_buffer.buffer_height
             self.entity.create_data_container_texture(
                 self.current_width,
-                self.current_height
+                self.current_height,
+                self.n_viewport.frame_producer.texture_format
             )
             self.entity.quad.create_quad()
 
@@ -107,7 +126,8 @@ class NSceneV2:
 
         size = self.entity.visible_grid_part.w * self.entity.visible_grid_part.h
 
-        if self.n_viewport.current_factor_half_delta < 1:
-            self.draw_billboards(n_billboards_from_texture_shader, size)
+        with profiler.span(SPAN_DRAW):
+            if self.n_viewport.current_factor_half_delta < 1:
+                self.draw_billboards(n_billboards_from_texture_shader, size)
 
-        self.draw_textures(n_color_map_v2_texture_shader, self.n_viewport.current_factor_half_delta)
+            self.draw_textures(n_color_map_v2_texture_shader, self.n_viewport.current_factor_half_delta)
@@ -3,6 +3,33 @@ import numpy as np
 
 # manage shaders
 
+# Per frame state shared by all programs, a std140 uniform block backed by FrameStateBuffer
+FRAME_STATE_BLOCK = "FrameState"
+FRAME_STATE_BINDING = 0
+frame_state_block_source = """
+layout(std140) uniform FrameState {
+    mat4 projection_matrix;
+    vec2 mouse_position;
+};
+"""
+# Values of the data container textures, see n_texture_format
+value_decoding_source = """
+uniform vec2 tex1_value_range = vec2(0.0, 0.0);
+uniform vec2 tex2_value_range = vec2(0.0, 0.0);
+
+float decode_value(float raw_value, vec2 value_range) {
+    // (scale, offset) of 8 bit quantized indices, (0, 0) for float textures
+    if (value_range.x == 0.0) {
+        return raw_value;
+    }
+    float index = floor(raw_value * 255.0 + 0.5);
+    if (index == 0.0) {
+        return -1.0;
+    }
+    return (index - 1.0) * value_range.x + value_range.y;
+}
+"""
+
 
 ### V2 SHADERS, for n_scene_v2
 
@@ -13,8 +40,7 @@ cmap_v2_texture_vertex_shader_source = """
 layout(location = 0) in vec2 position;
 layout(location = 1) in vec2 tex_coord;
 layout(location = 2) in vec2 prev_tex_coord;
-
-uniform mat4 projection_matrix;
+""" + frame_state_block_source + """
 uniform int tex_unit = 0; // 0 or 1 
 
 
@@ -42,7 +68,7 @@ uniform sampler2D tex2;
 uniform float fading_factor = 0;
 uniform int tex_unit = 0; // 0 or 1 
 uniform float tex_mix_factor = 0; // from 0 to 1 
- 
+""" + value_decoding_source + """
 in vec2 frag_tex_coord_one;
 in vec2 frag_tex_coord_two;
 
@@ -59,12 +85,12 @@ void main() {
     
     if(tex_unit==0){
          // current quad using tex1
-         base_value = texture(tex1, frag_tex_coord_one).r; 
-         prev_value = texture(tex2, frag_tex_coord_two).r; 
+         base_value = decode_value(texture(tex1, frag_tex_coord_one).r, tex1_value_range); 
+         prev_value = decode_value(texture(tex2, frag_tex_coord_two).r, tex2_value_range); 
     }else{
          // current quad using tex2
-         base_value = texture(tex2, frag_tex_coord_one).r; 
-         prev_value = texture(tex1, frag_tex_coord_two).r; 
+         base_value = decode_value(texture(tex2, frag_tex_coord_one).r, tex2_value_range); 
+         prev_value = decode_value(texture(tex1, frag_tex_coord_two).r, tex1_value_range); 
     }
 
     float intensified_color_value;
@@ -103,11 +129,10 @@ uniform int target_width;
 uniform int target_height;
 
 uniform vec2 position_offset = vec2(0.0, 0.0); 
-uniform vec2 mouse_position = vec2(0.0, 0.0); 
-uniform mat4 projection_matrix;
+""" + frame_state_block_source + """
 uniform int factor =1;
 uniform float node_gap = 1;
-
+""" + value_decoding_source + """
 float color_multiplier = 50;
 
 out vec2 frag_tex_coord;
@@ -127,8 +152,8 @@ void main()
     float x = gl_InstanceID % selected_width;
     float y = gl_InstanceID / selected_width;
     
-    float value_one = texelFetch(tex1, ivec2(x, y), 0).r;
-    float value_two = texelFetch(tex2, ivec2(x, y), 0).r;
+    float value_one = decode_value(texelFetch(tex1, ivec2(x, y), 0).r, tex1_value_range);
+    float value_two = decode_value(texelFetch(tex2, ivec2(x, y), 0).r, tex2_value_range);
     float value = (tex_unit > 0.5) ? value_two : value_one;
     float scaled_x = x * factor;
     float scaled_y = y * factor;
@@ -207,9 +232,7 @@ layer_effects_vertex_shader_source = """
 
 layout(location = 0) in vec2 position;
 layout(location = 1) in vec2 tex_coord;
-
-uniform mat4 projection_matrix;
-
+""" + frame_state_block_source + """
 out vec2 frag_tex_coord;
 
 void main()
@@ -268,6 +291,85 @@ void main() {
 """
 
 
+# Texture units of the samplers, bound once after the program is linked
+SAMPLER_UNITS = {
+    "color_map": 0,
+    "billboard": 1,
+    "tex1": 2,
+    "tex2": 3
+}
+
+
+class GLCallCounter:
+    """
+    Python to GL calls made by the shaders, counted per frame
+    Skipped calls are uniform uploads with the same value as the last upload.
+    """
+
+    def __init__(self):
+        self.calls_count = 0
+        self.skipped_count = 0
+        self.frame_calls_count = 0
+        self.frame_skipped_count = 0
+
+    def add(self, count=1):
+        self.calls_count += count
+
+    def skip(self, count=1):
+        self.skipped_count += count
+
+    def end_frame(self):
+        self.frame_calls_count = self.calls_count
+        self.frame_skipped_count = self.skipped_count
+        self.calls_count = 0
+        self.skipped_count = 0
+
+
+gl_call_counter = GLCallCounter()
+
+
+class FrameStateBuffer:
+    """
+    Uniform buffer with the per frame state of all programs, see frame_state_block_source
+    std140 layout: projection_matrix at offset 0 (4 columns of vec4), mouse_position at offset 64.
+    The whole block is written with one glBufferSubData when the state changed.
+    """
+
+    SIZE = 80
+
+    def __init__(self):
+        self.buffer_id = None
+        self.data = np.zeros(self.SIZE // 4, dtype=np.float32)
+        self.uploaded_data = None
+
+    def create(self):
+        self.buffer_id = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.buffer_id)
+        gl.glBufferData(gl.GL_UNIFORM_BUFFER, self.SIZE, None, gl.GL_DYNAMIC_DRAW)
+        gl.glBindBufferBase(gl.GL_UNIFORM_BUFFER, FRAME_STATE_BINDING, self.buffer_id)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+        self.uploaded_data = None
+
+    def update(self, projection_matrix, mouse_x, mouse_y):
+        # Rows of the numpy matrix are the columns of the GLSL mat4, same as glUniformMatrix4fv without transpose
+        self.data[0:16] = np.asarray(projection_matrix, dtype=np.float32).reshape(16)
+        self.data[16] = mouse_x
+        self.data[17] = mouse_y
+        if self.uploaded_data is not None and np.array_equal(self.data, self.uploaded_data):
+            gl_call_counter.skip()
+            return
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.buffer_id)
+        gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, 0, self.SIZE, self.data)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+        gl_call_counter.add(3)
+        self.uploaded_data = self.data.copy()
+
+    def destroy(self):
+        if self.buffer_id is not None:
+            gl.glDeleteBuffers(1, [self.buffer_id])
+            self.buffer_id = None
+
+
 class NShader:
     def __init__(self):
         self.shader_program = None
@@ -275,19 +377,14 @@ class NShader:
         self.current_cmap_name = None
         self.colorMapTextureID = None
         self.billboardID = None
+        # Uniform name -> location, resolved once when the program is linked
+        self.uniform_locations = {}
+        # Uniform name -> last uploaded value, uniforms keep their value in the program between frames
+        self.uniform_values = {}
 
     def use(self):
         gl.glUseProgram(self.shader_program)
-
-        # assign shader tex1 and tex2 to openGl texture. gl.GL_TEXTURE1 and gl.GL_TEXTURE2
-        text_uniform = gl.glGetUniformLocation(self.shader_program, "color_map")
-        gl.glUniform1i(text_uniform, 0)
-        text_uniform = gl.glGetUniformLocation(self.shader_program, "billboard")
-        gl.glUniform1i(text_uniform, 1)
-        text_uniform1 = gl.glGetUniformLocation(self.shader_program, "tex1")
-        gl.glUniform1i(text_uniform1, 2)
-        text_uniform2 = gl.glGetUniformLocation(self.shader_program, "tex2")
-        gl.glUniform1i(text_uniform2, 3)
+        gl_call_counter.add()
 
     def update_color_map(self, cmap_name, color_values):
         if self.current_cmap_name == cmap_name:
@@ -306,6 +403,7 @@ class NShader:
         gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl_call_counter.add(6)
         self.current_cmap_name = cmap_name
 
     def update_cell_billboard(self):
@@ -326,90 +424,121 @@ class NShader:
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl_call_counter.add(6)
+
+    def _upload(self, name, upload_func, *values):
+        """
+        Upload a uniform of the current program, skipped if the value did not change
+        Unknown names (not in the program or optimized out by the compiler) are ignored.
+        """
+        location = self.uniform_locations.get(name, -1)
+        if location == -1:
+            return
+        if self.uniform_values.get(name) == values:
+            gl_call_counter.skip()
+            return
+        upload_func(location, *values)
+        self.uniform_values[name] = values
+        gl_call_counter.add()
 
-    def update_projection(self, projection_matrix):
-        projection_matrix_uniform = gl.glGetUniformLocation(self.shader_program, "projection_matrix")
-        gl.glUniformMatrix4fv(projection_matrix_uniform, 1, gl.GL_FALSE, projection_matrix)
+    def _upload_matrix(self, name, matrix):
+        location = self.uniform_locations.get(name, -1)
+        if location == -1:
+            return
+        value = np.asarray(matrix, dtype=np.float32).tobytes()
+        if self.uniform_values.get(name) == value:
+            gl_call_counter.skip()
+            return
+        gl.glUniformMatrix4fv(location, 1, gl.GL_FALSE, matrix)
+        self.uniform_values[name] = value
+        gl_call_counter.add()
 
     def update_quad_matrix(self, quad_matrix):
-        quad_matrix_uniform = gl.glGetUniformLocation(self.shader_program, "quad_matrix")
-        gl.glUniformMatrix4fv(quad_matrix_uniform, 1, gl.GL_FALSE, quad_matrix)
+        self._upload_matrix("quad_matrix", quad_matrix)
 
     def update_fading_factor(self, factor):
-        fading_factor = gl.glGetUniformLocation(self.shader_program, "fading_factor")
-        gl.glUniform1f(fading_factor, factor)
+        self._upload("fading_factor", gl.glUniform1f, factor)
 
     def select_texture(self, index):
-        tex_unit = gl.glGetUniformLocation(self.shader_program, "tex_unit")
-        gl.glUniform1i(tex_unit, index)
+        self._upload("tex_unit", gl.glUniform1i, index)
 
     def mix_textures(self, factor):
-        tex_mix_factor = gl.glGetUniformLocation(self.shader_program, "tex_mix_factor")
-        gl.glUniform1f(tex_mix_factor, factor)
+        self._upload("tex_mix_factor", gl.glUniform1f, factor)
 
     def update_texture_width(self, width):
-        texture_width = gl.glGetUniformLocation(self.shader_program, "texture_width")
-        gl.glUniform1i(texture_width, width)
+        self._upload("texture_width", gl.glUniform1i, width)
 
     def update_texture_height(self, height):
-        texture_height = gl.glGetUniformLocation(self.shader_program, "texture_height")
-        gl.glUniform1i(texture_height, height)
+        self._upload("texture_height", gl.glUniform1i, height)
 
     def update_target_width(self, width):
-        target_width = gl.glGetUniformLocation(self.shader_program, "target_width")
-        gl.glUniform1i(target_width, width)
+        self._upload("target_width", gl.glUniform1i, width)
 
     def update_target_height(self, height):
-        target_height = gl.glGetUniformLocation(self.shader_program, "target_height")
-        gl.glUniform1i(target_height, height)
+        self._upload("target_height", gl.glUniform1i, height)
 
     def update_details_factor(self, details_factor):
-        factor = gl.glGetUniformLocation(self.shader_program, "factor")
-        gl.glUniform1i(factor, details_factor)
+        self._upload("factor", gl.glUniform1i, details_factor)
 
     def update_position_offset(self, x1, y1):
-        position_offset = gl.glGetUniformLocation(self.shader_program, "position_offset")
-        gl.glUniform2f(position_offset, x1, y1)
+        self._upload("position_offset", gl.glUniform2f, x1, y1)
 
     def update_details_factor_one(self, details_factor):
-        factor = gl.glGetUniformLocation(self.shader_program, "factor_one")
-        gl.glUniform1i(factor, details_factor)
+        self._upload("factor_one", gl.glUniform1i, details_factor)
 
     def update_details_factor_two(self, details_factor):
-        factor = gl.glGetUniformLocation(self.shader_program, "factor_two")
-        gl.glUniform1i(factor, details_factor)
+        self._upload("factor_two", gl.glUniform1i, details_factor)
 
     def update_size_one(self, x1, y1):
-        size_one = gl.glGetUniformLocation(self.shader_program, "size_one")
-        gl.glUniform2f(size_one, x1, y1)
+        self._upload("size_one", gl.glUniform2f, x1, y1)
 
     def update_size_two(self, x1, y1):
-        size_two = gl.glGetUniformLocation(self.shader_program, "size_two")
-        gl.glUniform2f(size_two, x1, y1)
+        self._upload("size_two", gl.glUniform2f, x1, y1)
 
     def update_position_offset_one(self, x1, y1):
-        position_offset = gl.glGetUniformLocation(self.shader_program, "position_offset_one")
-        gl.glUniform2f(position_offset, x1, y1)
+        self._upload("position_offset_one", gl.glUniform2f, x1, y1)
 
     def update_position_offset_two(self, x1, y1):
-        position_offset = gl.glGetUniformLocation(self.shader_program, "position_offset_two")
-        gl.glUniform2f(position_offset, x1, y1)
+        self._upload("position_offset_two", gl.glUniform2f, x1, y1)
 
-    def update_mouse_position(self, x1, y1):
-        mouse_position = gl.glGetUniformLocation(self.shader_program, "mouse_position")
-        gl.glUniform2f(mouse_position, x1, y1)
+    def update_value_ranges(self, tex1_value_range, tex2_value_range):
+        self._upload("tex1_value_range", gl.glUniform2f, *tex1_value_range)
+        self._upload("tex2_value_range", gl.glUniform2f, *tex2_value_range)
 
     def update_quad_size(self, w, h):
-        update_quad_size = gl.glGetUniformLocation(self.shader_program, "quad_size")
-        gl.glUniform2f(update_quad_size, w, h)
+        self._upload("quad_size", gl.glUniform2f, w, h)
 
     def update_node_gap(self, gap):
-        node_gap = gl.glGetUniformLocation(self.shader_program, "node_gap")
-        gl.glUniform1f(node_gap, gap)
+        self._upload("node_gap", gl.glUniform1f, gap)
 
     def update_radius(self, radius):
-        node_gap = gl.glGetUniformLocation(self.shader_program, "radius")
-        gl.glUniform1f(node_gap, radius)
+        self._upload("radius", gl.glUniform1f, radius)
+
+    def resolve_uniforms(self):
+        """
+        Locations of all active uniforms of the linked program, samplers are bound to their texture units
+        Values uploaded to a previous program are forgotten.
+        """
+        self.uniform_locations = {}
+        self.uniform_values = {}
+        uniforms_count = gl.glGetProgramiv(self.shader_program, gl.GL_ACTIVE_UNIFORMS)
+        for index in range(uniforms_count):
+            name, _, _ = gl.glGetActiveUniform(self.shader_program, index)
+            if isinstance(name, bytes):
+                name = name.decode()
+            # Arrays are reported as name[0]
+            name = name.split("[")[0]
+            self.uniform_locations[name] = gl.glGetUniformLocation(self.shader_program, name)
+        gl_call_counter.add(1 + 2 * uniforms_count)
+
+        block_index = gl.glGetUniformBlockIndex(self.shader_program, FRAME_STATE_BLOCK)
+        if block_index != gl.GL_INVALID_INDEX:
+            gl.glUniformBlockBinding(self.shader_program, block_index, FRAME_STATE_BINDING)
+
+        gl.glUseProgram(self.shader_program)
+        for name, unit in SAMPLER_UNITS.items():
+            self._upload(name, gl.glUniform1i, unit)
+        gl.glUseProgram(0)
 
     def compile_color_map_v2_texture_program(self):
         self.compile(cmap_v2_texture_vertex_shader_source, cmap_v2_texture_fragment_shader_source)
@@ -461,3 +590,5 @@ class NShader:
             # Linking failed, retrieve the error message
             error_message = gl.glGetProgramInfoLog(self.shader_program)
             print("Shader program linking failed:\n", error_message)
+            return
+        self.resolve_uniforms()
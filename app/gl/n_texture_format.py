@@ -0,0 +1,91 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TEXTURE_FORMAT_FLOAT32 = "float32"
+TEXTURE_FORMAT_FLOAT16 = "float16"
+TEXTURE_FORMAT_UINT8 = "uint8"
+
+# Value of the cells outside of the layers
+EMPTY_VALUE = -1
+# color_multiplier of the color map shader, values above 1 / COLOR_MULTIPLIER all get the last color
+COLOR_MULTIPLIER = 40
+# Quantized index 0 is an empty cell, 1..255 are the values of the frame range
+QUANTIZED_LEVELS = 255
+# (scale, offset) of a float texture, values are uploaded as they are
+NO_VALUE_RANGE = (0.0, 0.0)
+QUANTIZE_BAND_ROWS = 256
+
+
+class TextureFormat:
+    """
+    Data type of the frame buffers and of the data container textures
+
+    Frames are read from the grid into buffers of buffer_dtype. Quantized frames are then converted to
+    8 bit indices of the color map range of the frame, see quantize.
+    """
+
+    def __init__(self, name, buffer_dtype, texture_dtype, quantized):
+        self.name = name
+        self.buffer_dtype = np.dtype(buffer_dtype)
+        self.texture_dtype = np.dtype(texture_dtype)
+        self.quantized = quantized
+
+    def get_texture_bytes(self, width, height):
+        return width * height * self.texture_dtype.itemsize
+
+
+TEXTURE_FORMATS = {
+    TEXTURE_FORMAT_FLOAT32: TextureFormat(TEXTURE_FORMAT_FLOAT32, np.float32, np.float32, False),
+    # Grid backends write into float16 buffers directly, numpy converts on assignment
+    TEXTURE_FORMAT_FLOAT16: TextureFormat(TEXTURE_FORMAT_FLOAT16, np.float16, np.float16, False),
+    TEXTURE_FORMAT_UINT8: TextureFormat(TEXTURE_FORMAT_UINT8, np.float32, np.uint8, True),
+}
+
+
+def get_texture_format(name):
+    if name not in TEXTURE_FORMATS:
+        logger.warning("Unknown texture format %s, using %s", name, TEXTURE_FORMAT_FLOAT32)
+        return TEXTURE_FORMATS[TEXTURE_FORMAT_FLOAT32]
+    return TEXTURE_FORMATS[name]
+
+
+def calculate_value_range(data):
+    """
+    (scale, offset) of the quantized indices of a frame
+    Only the part of the color map the frame uses is quantized, the shader clamps everything else anyway.
+    """
+    max_value = 1 / COLOR_MULTIPLIER
+    low = min(max(float(data.min()), 0.0), max_value)
+    high = min(max(float(data.max()), low), max_value)
+    if high <= low:
+        # Flat frame, any scale decodes it
+        high = max_value
+    return (high - low) / (QUANTIZED_LEVELS - 1), low
+
+
+def quantize(source, target, value_range):
+    # Banded, so the temporary float array stays small
+    scale, offset = value_range
+    for row in range(0, source.shape[0], QUANTIZE_BAND_ROWS):
+        band = source[row:row + QUANTIZE_BAND_ROWS]
+        values = band - offset
+        values *= 1 / scale
+        np.clip(values, 0, QUANTIZED_LEVELS - 1, out=values)
+        # Rounded, 0 stays free for the empty cells
+        values += 1.5
+        target_band = target[row:row + QUANTIZE_BAND_ROWS]
+        target_band[:] = values
+        target_band[band == EMPTY_VALUE] = 0
+
+
+def decode_values(texture_data, value_range):
+    # Same as decode_value of the shaders
+    scale, offset = value_range
+    if scale == 0:
+        return texture_data.astype(np.float32)
+    values = (texture_data.astype(np.float32) - 1) * scale + offset
+    values[texture_data == 0] = EMPTY_VALUE
+    return values
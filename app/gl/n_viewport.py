@@ -1,8 +1,10 @@
+import logging
 import math
-import time
 
 from app.gl.n_frame_producer import NFrameProducer
 
+logger = logging.getLogger(__name__)
+
 
 class VisibleGrid:
     """
@@ -70,6 +72,19 @@ class VisibleGrid:
             buffer,
             cancellation_signal)
 
+    def update_scene_buffer_region(self, buffer, x1, y1, x2, y2, cancellation_signal):
+        # Part of the frame, bounds are multiples of the factor within the frame bounds
+        row = (y1 - self.y1) // self.factor
+        col = (x1 - self.x1) // self.factor
+        self.n_net.update_tex_buffer_directly(
+            x1,
+            y1,
+            x2,
+            y2,
+            self.factor,
+            buffer[row:, col:],
+            cancellation_signal)
+
     def get_quad_position(self, width, height):
         # The quad x1,y1,x2,y2 is always 0,0,width,height
         # The position of the quad in the world is offset + size * factor
@@ -118,12 +133,18 @@ class NViewport:
         self.world_x2 = width
         self.world_y2 = height
 
-    def get_details_factor(self, viewport):
+    def invalidate(self):
+        # Next viewport update always creates a new frame, built from scratch
+        self.visible_data = None
+        self.frame_producer.invalidate()
+
+    def calculate_details_factor(self, viewport):
         """
         Calculate the down sample factor
         Factor is used to reduce the vertices count or texture quality
 
         Compare screen space bounds with world grid bounds
+        Returns factor, delta and half delta without changing the current values
         """
         x, y, w, h, zoom = viewport
         col_min = x
@@ -141,61 +162,67 @@ class NViewport:
         height_factor = max(subgrid_height / target_height, 0.1)
         factor = max(width_factor, height_factor)
 
+        half_delta = self.current_factor_half_delta
         if self.power_of_two:
             lower_power = 2 ** math.floor(math.log2(factor))
             higher_power = lower_power * 2
             if higher_power <= 0.5:
                 higher_power = 0.5
-                self.current_factor_half_delta = (factor - lower_power) / (higher_power - lower_power)
+                half_delta = (factor - lower_power) / (higher_power - lower_power)
             else:
-                self.current_factor_half_delta = 1
+                half_delta = 1
 
             if higher_power <= 1:
                 higher_power = 1
                 lower_power = 0.1
-            self.current_factor = math.ceil(higher_power)
-            self.current_factor_delta = (factor - lower_power) / (higher_power - lower_power)
+            return math.ceil(higher_power), (factor - lower_power) / (higher_power - lower_power), half_delta
 
-        else:
-            self.current_factor = math.ceil(factor)
-            self.current_factor_delta = factor - math.ceil(factor)
+        return math.ceil(factor), factor - math.ceil(factor), half_delta
 
+    def get_details_factor(self, viewport):
+        self.current_factor, self.current_factor_delta, self.current_factor_half_delta = \
+            self.calculate_details_factor(viewport)
         return self.current_factor, self.current_factor_delta
 
-    def update_viewport(self, viewport):
+    def create_visible_grid(self, viewport, factor):
+        # Frame bounds for the viewport, same as update_viewport but nothing is built
+        x, y, w, h, zoom = viewport
+        x1 = max(x, self.world_x1)
+        y1 = max(y, self.world_y1)
+        width = min(x + w, self.world_x2) - x1
+        height = min(y + h, self.world_y2) - y1
+        # We make visible window a little bit larger by adding padding around it
+        # set padding to 0 for easier debugging
+        padding = int(w / 6)
+        return VisibleGrid(
+            max(0, x1 - padding),
+            max(0, y1 - padding),
+            min(x1 - padding + width + (2 * padding), self.world_x2),
+            min(y1 - padding + height + (2 * padding), self.world_y2),
+            padding,
+            factor,
+            zoom,
+            self.n_net)
 
-        start_time = time.time()
+    def update_viewport(self, viewport):
         x, y, w, h, zoom = viewport
 
         x1 = max(x, self.world_x1)
         y1 = max(y, self.world_y1)
         x2 = min(x + w, self.world_x2)
         y2 = min(y + h, self.world_y2)
-        width = x2 - x1
-        height = y2 - y1
         factor, fraction = self.get_details_factor(viewport)
-        # We make visible window a little bit larger by adding padding around it
-        # set padding to 0 for easier debugging
-        padding = int(w / 6)
         updated = False
 
         if self.visible_data is None or not self.visible_data.contains(x1, y1, x2, y2, factor):
-            self.visible_data = VisibleGrid(
-                max(0, x1 - padding),
-                max(0, y1 - padding),
-                min(x1 - padding + width + (2 * padding), self.world_x2),
-                min(y1 - padding + height + (2 * padding), self.world_y2),
-                padding,
-                factor,
-                zoom,
-                self.n_net)
+            self.visible_data = self.create_visible_grid(viewport, factor)
             self.frame_producer.create_frame(self.visible_data)
             updated = True
 
         if updated:
-            print("Visible grid updated",
-                  "x1", self.visible_data.x1,
-                  "y1", self.visible_data.y1,
-                  "w", self.visible_data.w,
-                  "h", self.visible_data.h,
-                  "factor", factor)
+            logger.debug("Visible grid updated x1 %s y1 %s w %s h %s factor %s",
+                         self.visible_data.x1,
+                         self.visible_data.y1,
+                         self.visible_data.w,
+                         self.visible_data.h,
+                         factor)
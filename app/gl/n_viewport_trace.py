@@ -0,0 +1,85 @@
+import json
+import os
+import time
+
+VIEWPORT_TRACE_VERSION = 1
+
+
+def get_viewport_trace_directory():
+    return os.path.join(os.path.expanduser("~"), ".cache", "mylittlenet", "viewport_traces")
+
+
+class ViewportTrace:
+    """
+    Timestamped viewports (x, y, w, h, zoom) in world coordinates, as returned by NWindow.viewport_to_world_cords
+
+    Times are seconds from the first event. The file is JSON, {"version", "name", "events": [[time, x, y, w, h, zoom]]}.
+    """
+
+    def __init__(self, name, events=None):
+        self.name = name
+        # list of (time, (x, y, w, h, zoom))
+        self.events = events if events is not None else []
+
+    def add(self, time, viewport):
+        # Projection values can be numpy scalars
+        self.events.append((float(time), tuple(float(value) for value in viewport)))
+
+    def get_duration(self):
+        if len(self.events) == 0:
+            return 0.0
+        return self.events[-1][0] - self.events[0][0]
+
+    def save(self, path):
+        data = {
+            'version': VIEWPORT_TRACE_VERSION,
+            'name': self.name,
+            'events': [[time, *viewport] for time, viewport in self.events],
+        }
+        with open(path, 'w') as file:
+            json.dump(data, file)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as file:
+            data = json.load(file)
+        if data.get('version') != VIEWPORT_TRACE_VERSION:
+            raise ValueError(f"Unsupported viewport trace version: {data.get('version')}")
+        events = [(event[0], tuple(event[1:6])) for event in data['events']]
+        return ViewportTrace(data.get('name', path), events)
+
+
+class ViewportTraceRecorder:
+    """
+    Records the viewports of the window while recording is on, see OpenGLApplication.on_viewport_updated
+    """
+
+    def __init__(self):
+        self.trace = None
+        self.start_time = None
+
+    def is_recording(self):
+        return self.trace is not None
+
+    def start(self, name):
+        self.trace = ViewportTrace(name)
+        self.start_time = time.perf_counter()
+
+    def record(self, viewport):
+        if self.trace is None:
+            return
+        self.trace.add(time.perf_counter() - self.start_time, viewport)
+
+    def stop(self, path=None):
+        """
+        Save the recorded trace, to the viewport trace directory when path is not set
+        :return: path of the saved trace
+        """
+        trace = self.trace
+        self.trace = None
+        if path is None:
+            directory = get_viewport_trace_directory()
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"viewport_trace_{time.strftime('%Y%m%d_%H%M%S')}.json")
+        trace.save(path)
+        return path
@@ -1,3 +1,4 @@
+import logging
 import time
 
 import OpenGL.GL as gl
@@ -6,7 +7,14 @@ import imgui
 import numpy as np
 
 from app.gl.n_projection import Projection
-from app.gl.n_shader import NShader
+from app.gl.n_shader import NShader, FrameStateBuffer
+
+logger = logging.getLogger(__name__)
+
+# Frames rendered after an input event, ImGui needs a few frames to settle hover and click states
+ACTIVE_FRAMES_AFTER_EVENT = 3
+# Seconds between frames when nothing happens, GUI messages from other threads are shown at least this often
+IDLE_REDRAW_INTERVAL = 0.5
 
 
 class NWindow:
@@ -31,10 +39,17 @@ class NWindow:
         self.key_repeat_func = None
         self.zoom_percent = 0
         self.formatted_zoom = None
+        # Frame pacing, see start_main_loop
+        self.max_fps = 0
+        self.idle_redraw_interval = IDLE_REDRAW_INTERVAL
+        self.busy_func = None
+        self.redraw_frames_count = ACTIVE_FRAMES_AFTER_EVENT
 
         self.n_billboards_from_texture_shader = NShader()
         self.n_color_map_v2_texture_shader = NShader()
         self.n_effects_shader = NShader()
+        # Projection and mouse position, read by all three programs
+        self.frame_state = FrameStateBuffer()
 
     def calculate_min_zoom(self, n_net):
         content_width, content_height = n_net.total_width, n_net.total_height
@@ -86,13 +101,55 @@ class NWindow:
         glfw.set_key_callback(self.window, self.window_key_callback)
 
     def start_main_loop(self):
+        """
+        Frames are rendered only while something changes on the screen
+        When idle the loop sleeps in glfw.wait_events_timeout until an input event, request_redraw
+        or the idle redraw interval wakes it up. Busy frames are limited to max_fps, 0 means no limit.
+        """
         while not glfw.window_should_close(self.window):
             if glfw.get_key(self.window, glfw.KEY_ESCAPE) == glfw.PRESS:
                 glfw.set_window_should_close(self.window, True)
 
+            frame_start_time = time.perf_counter()
             if self.render_func:
                 self.render_func()
-            glfw.poll_events()
+            self.redraw_frames_count = max(0, self.redraw_frames_count - 1)
+            self.wait_for_next_frame(frame_start_time)
+
+    def wait_for_next_frame(self, frame_start_time):
+        if self.max_fps > 0:
+            # Events are still handled while waiting, they are drawn by the next frame
+            frame_end_time = frame_start_time + 1.0 / self.max_fps
+            remaining_time = frame_end_time - time.perf_counter()
+            while remaining_time > 0:
+                glfw.wait_events_timeout(remaining_time)
+                remaining_time = frame_end_time - time.perf_counter()
+        glfw.poll_events()
+        if self.is_busy():
+            return
+
+        wait_start_time = time.perf_counter()
+        glfw.wait_events_timeout(self.idle_redraw_interval)
+        if time.perf_counter() - wait_start_time < self.idle_redraw_interval:
+            # Woken up by an event, not by the timeout
+            self.redraw_frames_count = ACTIVE_FRAMES_AFTER_EVENT
+
+    def is_busy(self):
+        return (self.redraw_frames_count > 0
+                or self.dragging
+                or (self.busy_func is not None and self.busy_func()))
+
+    def request_redraw(self, frames_count=1):
+        # Safe to call from any thread, wakes up an idle main loop
+        self.redraw_frames_count = max(self.redraw_frames_count, frames_count)
+        if self.window is not None:
+            glfw.post_empty_event()
+
+    def set_busy_func(self, busy_func):
+        self.busy_func = busy_func
+
+    def set_max_fps(self, max_fps):
+        self.max_fps = max_fps
 
     def close_window(self):
         glfw.set_window_should_close(self.window, True)
@@ -201,6 +258,8 @@ class NWindow:
             self.viewport_updated_func()
 
     def window_key_callback(self, window, key, scancode, action, mods):
+        # Input events handled while a busy frame waits or polls are drawn by the next frames too
+        self.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
         io = imgui.get_io()
         if io.want_capture_keyboard:
             return
@@ -217,6 +276,7 @@ class NWindow:
             self.render_func()
 
     def frame_buffer_size_callback(self, window, w, h):
+        self.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
         self.update_size(w,h)
         self.on_viewport_updated()
 
@@ -242,9 +302,10 @@ class NWindow:
         formatted = "{:.0%}".format(self.zoom_percent)
         if self.formatted_zoom != formatted:
             self.formatted_zoom = formatted
-            print("zoom: ", formatted)
+            logger.debug("Zoom %s", formatted)
 
     def mouse_scroll_callback(self, window, x_offset, y_offset):
+        self.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
         io = imgui.get_io()
         if io.want_capture_mouse:
             return
@@ -257,6 +318,7 @@ class NWindow:
         self.zoom_to_point(zoom_x, zoom_y, new_zoom)
 
     def mouse_button_callback(self, window, button, action, mods):
+        self.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
         io = imgui.get_io()
         if io.want_capture_mouse:
             return
@@ -275,6 +337,8 @@ class NWindow:
                 self.dragging = False
 
     def mouse_position_callback(self, window, xpos, ypos):
+        # ImGui hover states change even when the mouse is over the GUI
+        self.request_redraw(ACTIVE_FRAMES_AFTER_EVENT)
         io = imgui.get_io()
         if io.want_capture_mouse:
             return
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+
+
+class LayerMemoryBudget:
+    """
+    Least recently used list of the materialized lazy layers
+
+    Layers report their size (data plus level of detail pyramids) when they are loaded or grow,
+    the least recently used layers are released once the total is over the budget.
+    Released layers are loaded again by their loader the next time the grid reads them.
+    """
+
+    def __init__(self, budget_bytes=DEFAULT_MEMORY_BUDGET):
+        self.budget_bytes = budget_bytes
+        self.layers = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+
+    def clear(self):
+        with self.lock:
+            self.layers = OrderedDict()
+            self.total_bytes = 0
+
+    def set_budget(self, budget_bytes):
+        with self.lock:
+            self.budget_bytes = budget_bytes
+            self._evict(None)
+
+    def update(self, layer):
+        # Called after a layer was loaded or its pyramid grew
+        with self.lock:
+            self.total_bytes -= self.layers.pop(layer, 0)
+            size = layer.get_memory_size()
+            self.layers[layer] = size
+            self.total_bytes += size
+            self._evict(layer)
+
+    def touch(self, layer):
+        with self.lock:
+            if layer in self.layers:
+                self.layers.move_to_end(layer)
+
+    def remove(self, layer):
+        with self.lock:
+            self.total_bytes -= self.layers.pop(layer, 0)
+
+    def _evict(self, keep_layer):
+        while self.total_bytes > self.budget_bytes and len(self.layers) > 0:
+            layer = next(iter(self.layers))
+            if layer is keep_layer:
+                # Only the layer in use is left, a single layer may be larger than the budget
+                break
+            self.total_bytes -= self.layers.pop(layer)
+            layer.release()
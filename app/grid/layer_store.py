@@ -0,0 +1,168 @@
+import json
+import os
+
+import numpy as np
+
+# Offsets of the layers in the data file are aligned to 64 bytes
+STORE_ALIGNMENT = 64
+STORE_VERSION = 1
+STORE_DTYPES = ["float32", "float16"]
+# Files of a checkpoint directory that hold weights
+CHECKPOINT_EXTENSIONS = (".safetensors", ".bin", ".pt", ".pth", ".ckpt", ".msgpack", ".h5")
+
+
+def get_layer_store_directory():
+    return os.path.join(os.path.expanduser("~"), ".cache", "mylittlenet", "layer_store")
+
+
+def get_layer_store_path(model_name):
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)
+    return os.path.join(get_layer_store_directory(), safe_name)
+
+
+def get_source_files(path):
+    """
+    Name, size and modification time of the weight files of a checkpoint, a checkpoint rewritten in place
+    with the same layers doesn't match the store written from it anymore
+    :return: sorted list of [name, size, mtime_ns], None when there are no files behind the path
+    """
+    if path is None:
+        return None
+    if os.path.isfile(path):
+        paths = [path]
+    elif os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(CHECKPOINT_EXTENSIONS)]
+        paths = [file_path for file_path in paths if os.path.isfile(file_path)]
+    else:
+        return None
+    if len(paths) == 0:
+        return None
+    source_files = []
+    for file_path in sorted(paths):
+        stat = os.stat(file_path)
+        source_files.append([os.path.basename(file_path), stat.st_size, stat.st_mtime_ns])
+    return source_files
+
+
+class LayerStoreEntry:
+    def __init__(self, name, shape, offset):
+        self.name = name
+        self.shape = tuple(shape)
+        self.offset = offset
+        self.size = int(np.prod(self.shape)) if len(self.shape) > 0 else 1
+
+
+class LayerStore:
+    """
+    All layers of a model in a single file, read through np.memmap
+
+    <path>.bin holds the data of every layer (float32 or float16), <path>.json holds the index
+    with name, shape and offset of every layer. Arrays returned by get() are views of one memory map,
+    pages are loaded by the OS on access and can be dropped again, so weights are not duplicated in RAM.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data_path = path + ".bin"
+        self.index_path = path + ".json"
+        self.model_name = None
+        self.source = None
+        self.source_files = None
+        self.dtype = None
+        self.entries = {}
+        self.data = None
+
+    def exists(self):
+        return os.path.exists(self.data_path) and os.path.exists(self.index_path)
+
+    def open(self):
+        with open(self.index_path, 'r') as file:
+            index = json.load(file)
+        if index.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported layer store version: {index.get('version')}")
+        self.model_name = index['model_name']
+        self.source = index['source']
+        # Stores written without it never match a checkpoint, they are written again
+        self.source_files = index.get('source_files')
+        self.dtype = np.dtype(index['dtype'])
+        self.entries = {}
+        for layer in index['layers']:
+            entry = LayerStoreEntry(layer['name'], layer['shape'], layer['offset'])
+            self.entries[entry.name] = entry
+        if os.path.getsize(self.data_path) > 0:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        return self
+
+    def close(self):
+        self.data = None
+        self.entries = {}
+
+    def matches(self, source, shapes, dtype="float32", source_files=None):
+        """
+        Check if the store was written from the same source files with the same layers and dtype
+        :param shapes: dict {name: shape}
+        :param source_files: result of get_source_files for the checkpoint, None never matches
+        """
+        if source_files is None or not self.exists():
+            return False
+        try:
+            if self.data is None:
+                self.open()
+        except (ValueError, KeyError, json.JSONDecodeError) as e:
+            print("Layer store can't be opened", e)
+            return False
+        if self.source != source or self.dtype != np.dtype(dtype) or len(self.entries) != len(shapes):
+            return False
+        if self.source_files != source_files:
+            return False
+        for name, shape in shapes.items():
+            entry = self.entries.get(name)
+            if entry is None or entry.shape != tuple(shape):
+                return False
+        return True
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry is None or self.data is None:
+            return None
+        size_in_bytes = entry.size * self.dtype.itemsize
+        return self.data[entry.offset:entry.offset + size_in_bytes].view(self.dtype).reshape(entry.shape)
+
+    def write(self, model_name, source, named_arrays, dtype="float32", source_files=None):
+        """
+        Write all layers to the store, arrays are converted and written one by one
+
+        :param named_arrays: iterable of (name, np_array)
+        :param source_files: result of get_source_files for the checkpoint, checked by matches
+        """
+        dtype = np.dtype(dtype)
+        os.makedirs(os.path.dirname(self.data_path), exist_ok=True)
+        layers = []
+        offset = 0
+        # Index is written last, a store without index is never opened
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        with open(self.data_path, 'wb') as file:
+            for name, np_array in named_arrays:
+                padding = (-offset) % STORE_ALIGNMENT
+                if padding > 0:
+                    file.write(b'\0' * padding)
+                    offset += padding
+                np_array = np.ascontiguousarray(np_array, dtype=dtype)
+                np_array.tofile(file)
+                layers.append({'name': name, 'shape': list(np_array.shape), 'offset': offset})
+                offset += np_array.nbytes
+        index = {
+            'version': STORE_VERSION,
+            'model_name': model_name,
+            'source': source,
+            'source_files': source_files,
+            'dtype': dtype.name,
+            'layers': layers
+        }
+        with open(self.index_path, 'w') as file:
+            json.dump(index, file)
+        return self.open()
@@ -0,0 +1,180 @@
+import numpy as np
+
+# Downsampling reducers, one value represents a block of factor x factor weights
+REDUCER_POINT = "point"
+REDUCER_MEAN = "mean"
+REDUCER_MAX_ABS = "max_abs"
+REDUCER_MIN = "min"
+REDUCER_STD = "std"
+REDUCER_SIGNED_MAX = "signed_max"
+
+REDUCERS = [
+    REDUCER_POINT,
+    REDUCER_MEAN,
+    REDUCER_MAX_ABS,
+    REDUCER_MIN,
+    REDUCER_STD,
+    REDUCER_SIGNED_MAX
+]
+
+# Layers are reduced in chunks of rows to keep temporary arrays small
+REDUCE_CHUNK_ROWS = 2048
+
+
+def lowest_power_of_two(value):
+    # Largest power of two that divides value, 12 -> 4, 8 -> 8, 7 -> 1
+    value = int(value)
+    if value <= 0:
+        return 1
+    return value & -value
+
+
+def _pad_to_even(array, mode):
+    pad_width = [(0, dim % 2) for dim in array.shape]
+    if any(after for _, after in pad_width):
+        return np.pad(array, pad_width, mode=mode)
+    return array
+
+
+def _as_blocks(array):
+    # View the array as 2x2 blocks (2 blocks for 1d arrays), returns blocks and the axes to reduce
+    if array.ndim == 1:
+        return array.reshape(-1, 2), (1,)
+    h, w = array.shape
+    return array.reshape(h // 2, 2, w // 2, 2), (1, 3)
+
+
+def _reduce_sum(blocks, axes):
+    return np.sum(blocks, axis=axes, dtype=np.float64)
+
+
+def _reduce_sum_of_squares(blocks, axes):
+    return np.sum(np.square(blocks, dtype=np.float64), axis=axes)
+
+
+def _reduce_min(blocks, axes):
+    return np.min(blocks, axis=axes)
+
+
+def _reduce_max_abs(blocks, axes):
+    return np.max(np.abs(blocks), axis=axes)
+
+
+def _reduce_signed_max(blocks, axes):
+    # Value with the largest magnitude, sign preserved
+    if blocks.ndim == 2:
+        flat = blocks
+    else:
+        h, _, w, _ = blocks.shape
+        flat = blocks.transpose(0, 2, 1, 3).reshape(h, w, 4)
+    index = np.argmax(np.abs(flat), axis=-1)
+    return np.take_along_axis(flat, index[..., np.newaxis], axis=-1)[..., 0]
+
+
+def _reduce_level(array, reduce_block, pad_mode):
+    chunks = []
+    for start in range(0, array.shape[0], REDUCE_CHUNK_ROWS):
+        chunk = _pad_to_even(array[start:start + REDUCE_CHUNK_ROWS], pad_mode)
+        blocks, axes = _as_blocks(chunk)
+        chunks.append(reduce_block(blocks, axes))
+    return np.ascontiguousarray(np.concatenate(chunks))
+
+
+def _block_counts(layer_grid, factor):
+    # Number of original weights covered by every block at the given factor
+    rows = layer_grid.shape[0]
+    row_counts = np.minimum(factor, rows - np.arange(0, rows, factor))
+    if layer_grid.ndim == 1:
+        return row_counts
+    columns = layer_grid.shape[1]
+    column_counts = np.minimum(factor, columns - np.arange(0, columns, factor))
+    return np.outer(row_counts, column_counts)
+
+
+def _pyramid_factors(layer_grid):
+    rows = layer_grid.shape[0]
+    columns = 1 if layer_grid.ndim == 1 else layer_grid.shape[1]
+    factor = 2
+    while factor // 2 < max(rows, columns):
+        yield factor
+        factor *= 2
+
+
+def build_lod_levels(layer_grid, reducer=REDUCER_POINT):
+    """
+    Build the level of detail pyramid for a single layer
+
+    Level N holds one value for every N x N block of the layer, stored as a contiguous array,
+    so a frame at factor N reads a small array instead of striding over the original one.
+    Every level is reduced from the previous one, only the first level touches the full layer.
+    The pyramid ends when a level is reduced to a single row and column.
+
+    REDUCER_POINT keeps the first weight of every block, the other reducers summarize the whole block.
+
+    :return: dict {factor: level_array} for factors 2, 4, 8 ...
+    """
+    levels = {}
+    if layer_grid is None or layer_grid.size == 0:
+        return levels
+
+    if reducer == REDUCER_POINT:
+        previous_level = layer_grid
+        for factor in _pyramid_factors(layer_grid):
+            if previous_level.ndim == 1:
+                level = np.ascontiguousarray(previous_level[::2])
+            else:
+                level = np.ascontiguousarray(previous_level[::2, ::2])
+            levels[factor] = level
+            previous_level = level
+
+    elif reducer in (REDUCER_MEAN, REDUCER_STD):
+        # Sums are exact across levels, zero padding plus the block counts handle the ragged edges
+        sums = layer_grid
+        squares = None
+        for factor in _pyramid_factors(layer_grid):
+            if reducer == REDUCER_STD:
+                if squares is None:
+                    squares = _reduce_level(layer_grid, _reduce_sum_of_squares, "constant")
+                else:
+                    squares = _reduce_level(squares, _reduce_sum, "constant")
+            sums = _reduce_level(sums, _reduce_sum, "constant")
+            counts = _block_counts(layer_grid, factor)
+            mean = sums / counts
+            if reducer == REDUCER_MEAN:
+                levels[factor] = mean.astype(np.float32)
+            else:
+                variance = np.maximum(squares / counts - np.square(mean), 0)
+                levels[factor] = np.sqrt(variance).astype(np.float32)
+
+    elif reducer in (REDUCER_MIN, REDUCER_MAX_ABS, REDUCER_SIGNED_MAX):
+        reduce_block = {
+            REDUCER_MIN: _reduce_min,
+            REDUCER_MAX_ABS: _reduce_max_abs,
+            REDUCER_SIGNED_MAX: _reduce_signed_max
+        }[reducer]
+        previous_level = layer_grid
+        for factor in _pyramid_factors(layer_grid):
+            # Edge padding repeats existing values, so it never changes the block result
+            level = _reduce_level(previous_level, reduce_block, "edge")
+            levels[factor] = level.astype(np.float32, copy=False)
+            previous_level = level
+    else:
+        raise ValueError(f"Unknown reducer: {reducer}")
+    return levels
+
+
+def select_lod_level(layer_grid, levels, width_factor, height_factor):
+    """
+    Pick the pyramid level used to sample the layer at the given factors
+
+    The selected level factor always divides both factors, remaining sampling is done by striding over the level.
+    Layer local index i maps to level index i // level_factor.
+
+    :return: level_array, level_factor
+    """
+    level_factor = lowest_power_of_two(np.gcd(int(width_factor), int(height_factor)))
+    while level_factor > 1 and level_factor not in levels:
+        level_factor //= 2
+    if level_factor <= 1:
+        return layer_grid, 1
+    return levels[level_factor], level_factor
@@ -11,12 +11,6 @@ XTENSOR = 3
 CURRENT_GRID = 0
 
 
-# self.grid = mylittlenet.EigenGrid()
-# self.grid = mylittlenet.XTensorGrid()
-
-# grid_layer = mylittlenet.EigenLayer(layer_data)
-# grid_layer = mylittlenet.XTensorLayer(layer_data)
-
 def create_grid():
     if CURRENT_GRID == NUMPY:
         return NumpyGrid()
@@ -27,6 +21,9 @@ def create_grid():
     if CURRENT_GRID == EIGEN:
         import mylittlenet
         return mylittlenet.EigenGrid()
+    if CURRENT_GRID == XTENSOR:
+        import mylittlenet
+        return mylittlenet.XTensorGrid()
 
 
 def create_layer(np_array, name):
@@ -35,8 +32,21 @@ def create_layer(np_array, name):
     if CURRENT_GRID == NUMPY_AVERAGE:
         return NumpyLayer(np_array, name)
     if CURRENT_GRID == NUMBA:
-        return NumbaLayer(np_array)
+        return NumbaLayer(np_array, name)
     if CURRENT_GRID == EIGEN:
         import mylittlenet
         return mylittlenet.EigenLayer(np_array)
+    if CURRENT_GRID == XTENSOR:
+        import mylittlenet
+        return mylittlenet.XTensorLayer(np_array)
+
+
 
+def create_lazy_layer(shape, loader, name, memory_budget=None):
+    """
+    Layer that holds only the shape until the grid reads it, loader() returns the np_array
+    Backends without lazy layers load the data right away
+    """
+    if CURRENT_GRID == NUMPY or CURRENT_GRID == NUMPY_AVERAGE:
+        return NumpyLayer(None, name, shape, loader, memory_budget)
+    return create_layer(loader(), name)
@@ -0,0 +1,142 @@
+import math
+
+import numpy as np
+
+STRIP = 0
+SQUARE = 1
+ROWS = 2
+BLOCKS = 3
+
+LAYOUT_NAMES = ["Strip", "Square", "Rows", "Blocks"]
+
+
+def get_layers_shapes(grid_layers):
+    count = len(grid_layers)
+    rows_counts = np.fromiter((l.rows_count for l in grid_layers), dtype=np.int64, count=count)
+    columns_counts = np.fromiter((l.columns_count for l in grid_layers), dtype=np.int64, count=count)
+    return rows_counts, columns_counts
+
+
+def exclusive_cumsum(values):
+    result = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(values[:-1], out=result[1:])
+    return result
+
+
+def pack_shelves(rows_counts, columns_counts, shelves, gap):
+    """
+    Place layers left to right on horizontal shelves, shelf ids must be non decreasing.
+    Layers are centered vertically within their shelf, shelves are stacked bottom to top.
+
+    :return: column_offsets, row_offsets, total_width, total_height
+    """
+    starts = exclusive_cumsum(columns_counts + gap)
+    new_shelf = np.diff(shelves, prepend=-1) != 0
+    shelf_first = np.flatnonzero(new_shelf)
+    shelf_index = np.cumsum(new_shelf) - 1
+
+    column_offsets = starts - starts[shelf_first][shelf_index]
+    shelf_heights = np.maximum.reduceat(rows_counts, shelf_first)
+    shelf_rows = exclusive_cumsum(shelf_heights + gap)
+    row_offsets = shelf_rows[shelf_index] + (shelf_heights[shelf_index] - rows_counts) // 2
+
+    total_width = int(np.max(column_offsets + columns_counts + gap))
+    total_height = int(shelf_rows[-1] + shelf_heights[-1])
+    return column_offsets, row_offsets, total_width, total_height
+
+
+class StripLayout:
+    """
+    All layers in a single row from left to right, the default layout.
+    Gap between the layers equals the layers count.
+    """
+
+    def compute_offsets(self, rows_counts, columns_counts, groups=None, gap=None):
+        if gap is None:
+            gap = len(columns_counts)
+        shelves = np.zeros(len(columns_counts), dtype=np.int64)
+        column_offsets, row_offsets, total_width, _ = pack_shelves(rows_counts, columns_counts, shelves, gap)
+        return column_offsets, row_offsets, total_width, int(np.max(rows_counts))
+
+
+class SquareLayout:
+    """
+    Layers wrapped into shelves so the world is close to a square.
+    Order of the layers is kept, a shelf ends when it gets wider than the square side.
+    """
+
+    def compute_offsets(self, rows_counts, columns_counts, groups=None, gap=None):
+        if gap is None:
+            gap = default_gap(rows_counts, columns_counts)
+        area = np.sum((columns_counts + gap) * (rows_counts + gap), dtype=np.float64)
+        side = max(1, int(math.sqrt(area)))
+        starts = exclusive_cumsum(columns_counts + gap)
+        shelves = starts // side
+        return pack_shelves(rows_counts, columns_counts, shelves, gap)
+
+
+class RowsLayout:
+    """
+    One row per group of layers (for example one row per transformer block).
+    Without groups every layer gets its own row.
+    """
+
+    def compute_offsets(self, rows_counts, columns_counts, groups=None, gap=None):
+        if gap is None:
+            gap = default_gap(rows_counts, columns_counts)
+        if groups is None:
+            groups = np.arange(len(columns_counts), dtype=np.int64)
+        return pack_shelves(rows_counts, columns_counts, np.asarray(groups, dtype=np.int64), gap)
+
+
+class BlocksLayout:
+    """
+    Every group of layers (for example a transformer block) is laid out as a strip,
+    the strips are wrapped into shelves so the world is close to a square.
+    Without groups it is the same as the square layout.
+    """
+
+    def compute_offsets(self, rows_counts, columns_counts, groups=None, gap=None):
+        if gap is None:
+            gap = default_gap(rows_counts, columns_counts)
+        if groups is None:
+            groups = np.arange(len(columns_counts), dtype=np.int64)
+        groups = np.asarray(groups, dtype=np.int64)
+
+        # Strip of every group, offsets relative to the group
+        starts = exclusive_cumsum(columns_counts + gap)
+        new_group = np.diff(groups, prepend=-1) != 0
+        group_first = np.flatnonzero(new_group)
+        group_index = np.cumsum(new_group) - 1
+        column_in_group = starts - starts[group_first][group_index]
+        group_widths = np.add.reduceat(columns_counts + gap, group_first) - gap
+        group_heights = np.maximum.reduceat(rows_counts, group_first)
+
+        # Groups packed as single items
+        area = np.sum((group_widths + gap) * (group_heights + gap), dtype=np.float64)
+        side = max(1, int(math.sqrt(area)))
+        shelves = exclusive_cumsum(group_widths + gap) // side
+        group_columns, group_rows, total_width, total_height = pack_shelves(group_heights,
+                                                                            group_widths,
+                                                                            shelves,
+                                                                            gap)
+
+        column_offsets = group_columns[group_index] + column_in_group
+        row_offsets = group_rows[group_index] + (group_heights[group_index] - rows_counts) // 2
+        return column_offsets, row_offsets, total_width, total_height
+
+
+def default_gap(rows_counts, columns_counts):
+    # A tenth of the average layer side
+    mean_area = np.mean(rows_counts * columns_counts, dtype=np.float64)
+    return max(1, int(math.sqrt(mean_area) / 10))
+
+
+def create_layout(layout_type):
+    if layout_type == SQUARE:
+        return SquareLayout()
+    if layout_type == ROWS:
+        return RowsLayout()
+    if layout_type == BLOCKS:
+        return BlocksLayout()
+    return StripLayout()
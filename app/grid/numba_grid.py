@@ -1,4 +1,33 @@
-from numba import jit
+import logging
+import threading
+
+import numpy as np
+from numba import config, jit, njit, prange
+
+from app.grid.lod_pyramid import REDUCER_POINT, REDUCERS
+from app.grid.numpy_grid import NumpyLayer
+from app.grid.spatial_index import LayerSpatialIndex
+
+logger = logging.getLogger(__name__)
+
+# The fill kernel runs on the frame worker threads, a tbb parallel region started outside of the main thread
+# keeps the interpreter from exiting, OpenMP is picked first when it is available
+config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
+# Columns of the layer table
+LAYER_COLUMN_OFFSET = 0
+LAYER_ROW_OFFSET = 1
+LAYER_COLUMNS_COUNT = 2
+LAYER_ROWS_COUNT = 3
+LAYER_ARENA_OFFSET = 4
+LAYER_TABLE_COLUMNS = 5
+# Columns of the level table, one row per layer and pyramid level (log2 of the level factor)
+LEVEL_ARENA_OFFSET = 0
+LEVEL_ROWS_COUNT = 1
+LEVEL_COLUMNS_COUNT = 2
+LEVEL_TABLE_COLUMNS = 3
+# Columns of a planned copy
+COPY_TABLE_COLUMNS = 11
 
 
 @jit(nopython=True, cache=True)
@@ -77,44 +106,219 @@ def get_visible_chunk_accelerated(x1, y1, x2, y2,
     return None, None
 
 
-@jit(nopython=True, cache=True)
-def get_visible_layers_accelerated(layers_properties, x1, y1, x2, y2):
-    visible_layers_indexes = []
-    for index, props in enumerate(layers_properties):
-        column_offset, row_offset, columns_count, rows_count = props
-        grid_x1 = column_offset
-        grid_y1 = row_offset
-        grid_x2 = grid_x1 + columns_count
-        grid_y2 = grid_y1 + rows_count
-        if rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
-            visible_layers_indexes.append(index)
-    return visible_layers_indexes
+@njit(cache=True)
+def lowest_power_of_two_of_gcd(a, b):
+    while b != 0:
+        a, b = b, a % b
+    if a <= 0:
+        return 1
+    return a & -a
+
+
+@njit(cache=True)
+def plan_copies(layer_table, level_table, indexes, x1, y1, x2, y2, width_factor, height_factor):
+    """
+    Same plan as NumpyGrid._plan_layer_copy for every layer in indexes
+    :return: rows of (dy1, dx1, h, w, source, arena offset, level columns, start_y, start_x, step_y, step_x),
+     source 0 reads the layer arena, 1 the level arena
+    """
+    copies = np.empty((len(indexes), COPY_TABLE_COLUMNS), dtype=np.int64)
+    count = 0
+    gcd_factor = lowest_power_of_two_of_gcd(width_factor, height_factor)
+    for index in indexes:
+        grid_x1 = layer_table[index, LAYER_COLUMN_OFFSET]
+        grid_y1 = layer_table[index, LAYER_ROW_OFFSET]
+        grid_x2 = grid_x1 + layer_table[index, LAYER_COLUMNS_COUNT]
+        grid_y2 = grid_y1 + layer_table[index, LAYER_ROWS_COUNT]
+        if not rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
+            continue
+        overlap_x1 = max(x1, grid_x1)
+        overlap_y1 = max(y1, grid_y1)
+        overlap_x2 = min(x2, grid_x2)
+        overlap_y2 = min(y2, grid_y2)
+
+        first_y = -(-(overlap_y1 - grid_y1) // height_factor)
+        first_x = -(-(overlap_x1 - grid_x1) // width_factor)
+        h = -(-(overlap_y2 - grid_y1) // height_factor) - first_y
+        w = -(-(overlap_x2 - grid_x1) // width_factor) - first_x
+        if h <= 0 or w <= 0:
+            continue
+
+        # Same level as select_lod_level, the largest built level that divides both factors
+        level_factor = gcd_factor
+        level = 0
+        while (1 << (level + 1)) <= level_factor:
+            level += 1
+        while level > 0 and (level >= level_table.shape[1] or level_table[index, level, LEVEL_ARENA_OFFSET] < 0):
+            level -= 1
+        level_factor = 1 << level
+
+        copy = copies[count]
+        copy[0] = (grid_y1 - y1) // height_factor + first_y
+        copy[1] = (grid_x1 - x1) // width_factor + first_x
+        copy[2] = h
+        copy[3] = w
+        if level == 0:
+            copy[4] = 0
+            copy[5] = layer_table[index, LAYER_ARENA_OFFSET]
+            copy[6] = layer_table[index, LAYER_COLUMNS_COUNT]
+        else:
+            copy[4] = 1
+            copy[5] = level_table[index, level, LEVEL_ARENA_OFFSET]
+            copy[6] = level_table[index, level, LEVEL_COLUMNS_COUNT]
+        copy[7] = first_y * height_factor // level_factor
+        copy[8] = first_x * width_factor // level_factor
+        copy[9] = height_factor // level_factor
+        copy[10] = width_factor // level_factor
+        count += 1
+    return copies[:count]
+
+
+@njit(parallel=True, cache=True)
+def fill_buffer_kernel(buffer, layer_arena, level_arena, copies, rows_count):
+    # One output row per iteration, layers are copied in order so overlapping layers end the same as in NumpyGrid
+    columns_count = buffer.shape[1]
+    for row in prange(rows_count):
+        for index in range(copies.shape[0]):
+            dy1 = copies[index, 0]
+            if row < dy1 or row >= dy1 + copies[index, 2]:
+                continue
+            dx1 = copies[index, 1]
+            w = min(copies[index, 3], columns_count - dx1)
+            arena = layer_arena if copies[index, 4] == 0 else level_arena
+            level_columns = copies[index, 6]
+            step_x = copies[index, 10]
+            source = (copies[index, 5]
+                      + (copies[index, 7] + (row - dy1) * copies[index, 9]) * level_columns
+                      + copies[index, 8])
+            if step_x == 1:
+                buffer[row, dx1:dx1 + w] = arena[source:source + w]
+            else:
+                buffer[row, dx1:dx1 + w] = arena[source:source + w * step_x:step_x]
+
+
+def pack_arena(arrays):
+    """
+    Arrays copied one after the other into a single float32 array
+    :return: arena, offset of every array
+    """
+    sizes = np.array([array.size for array in arrays], dtype=np.int64)
+    offsets = np.zeros(len(arrays), dtype=np.int64)
+    if len(arrays) > 1:
+        offsets[1:] = np.cumsum(sizes)[:-1]
+    arena = np.empty(int(sizes.sum()), dtype=np.float32)
+    for array, offset, size in zip(arrays, offsets.tolist(), sizes.tolist()):
+        arena[offset:offset + size] = np.asarray(array).reshape(-1)
+    return arena, offsets
+
+
+class LevelArena:
+    def __init__(self, arena, level_table):
+        self.arena = arena
+        self.level_table = level_table
 
 
 class NumbaGrid:
+    """
+    All layers packed into one flat float32 arena with a table of offsets and shapes
+
+    A frame is planned and copied by compiled kernels, fill_buffer_kernel writes the whole region
+    with one parallel pass over the output rows. Pyramid levels of a reducer are packed into a second
+    arena when the reducer is first used, layers read their data and levels as views of the arenas.
+    Every layer is loaded when it is added, the memory budget does not apply to this backend.
+    """
+
     def __init__(self):
-        self.layers_data = []
-        self.layers_properties = []
+        self.layers = []
+        self.visible_layers = []
         self.visible_layers_indexes = []
-        print("Numba grid created")
+        self.reducer = REDUCER_POINT
+        self.spatial_index = LayerSpatialIndex()
+        self.layer_arena = np.empty(0, dtype=np.float32)
+        self.layer_table = np.empty((0, LAYER_TABLE_COLUMNS), dtype=np.int64)
+        # reducer -> LevelArena
+        self.level_arenas = {}
+        # Frame workers may build the first frame of a reducer at the same time
+        self.lock = threading.Lock()
+        logger.debug("Numba grid created")
+
+    def clear(self):
+        self.layers = []
+        self.visible_layers = []
+        self.visible_layers_indexes = []
+        self.spatial_index.clear()
+        self.layer_arena = np.empty(0, dtype=np.float32)
+        self.layer_table = np.empty((0, LAYER_TABLE_COLUMNS), dtype=np.int64)
+        self.level_arenas = {}
 
     def add_layers(self, layers):
-        for index, l in enumerate(layers):
-            self.layers_data.append(l.layer_grid)
-            self.layers_properties.append((
-                l.column_offset, l.row_offset, l.columns_count, l.rows_count
-            ))
+        self.layers += layers
+        self.spatial_index.build(self.layers)
+        with self.lock:
+            self._pack_layers()
+
+    def _pack_layers(self):
+        grids = [layer.layer_grid for layer in self.layers]
+        self.layer_arena, offsets = pack_arena(grids)
+        layer_table = np.empty((len(self.layers), LAYER_TABLE_COLUMNS), dtype=np.int64)
+        for index, (layer, offset) in enumerate(zip(self.layers, offsets.tolist())):
+            layer_table[index] = (layer.column_offset, layer.row_offset, layer.columns_count, layer.rows_count,
+                                  offset)
+            layer.attach(self.layer_arena[offset:offset + layer.size].reshape(layer.shape))
+        self.layer_table = layer_table
+        # Levels of the previous layers are packed again with the new ones
+        self.level_arenas = {}
+
+    def _pack_levels(self, reducer):
+        all_levels = [layer.build_lod_pyramid(reducer) for layer in self.layers]
+        levels_count = max((max(levels).bit_length() for levels in all_levels if len(levels) > 0), default=1)
+        level_table = np.full((len(self.layers), levels_count, LEVEL_TABLE_COLUMNS), -1, dtype=np.int64)
+        arrays = [level for levels in all_levels for level in levels.values()]
+        arena, offsets = pack_arena(arrays)
+        offsets = iter(offsets.tolist())
+        for index, (layer, levels) in enumerate(zip(self.layers, all_levels)):
+            packed_levels = {}
+            for factor, level in levels.items():
+                offset = next(offsets)
+                rows_count = level.shape[0]
+                columns_count = 1 if level.ndim == 1 else level.shape[1]
+                level_table[index, factor.bit_length() - 1] = (offset, rows_count, columns_count)
+                packed_levels[factor] = arena[offset:offset + level.size].reshape(level.shape)
+            layer.lod_levels[reducer] = packed_levels
+        return LevelArena(arena, level_table)
+
+    def get_level_arena(self, reducer):
+        level_arena = self.level_arenas.get(reducer)
+        if level_arena is None:
+            with self.lock:
+                level_arena = self.level_arenas.get(reducer)
+                if level_arena is None:
+                    level_arena = self._pack_levels(reducer)
+                    self.level_arenas[reducer] = level_arena
+        return level_arena
+
+    def build_lod_pyramids(self):
+        self.get_level_arena(self.reducer)
+
+    def set_reducer(self, reducer):
+        if reducer not in REDUCERS:
+            logger.warning("Unknown reducer %s, keeping %s", reducer, self.reducer)
+            return
+        # Levels are packed on the first frame that needs them
+        self.reducer = reducer
 
     def get_visible_layers(self, x1, y1, x2, y2):
-        self.visible_layers_indexes = get_visible_layers_accelerated(self.layers_properties, x1, y1, x2, y2)
+        self.visible_layers_indexes = self.spatial_index.query(x1, y1, x2, y2)
+        self.visible_layers = [self.layers[index] for index in self.visible_layers_indexes]
+        return self.visible_layers
 
     def get_visible_data_chunks(self, x1, y1, x2, y2, width_factor, height_factor, grid_space=False):
         result_chunks = []
         result_dimensions = []
         # Iterate over each subgrid to check for intersections
         for index in self.visible_layers_indexes:
-            sublayer_data = self.layers_data[index]
-            column_offset, row_offset, columns_count, rows_count = self.layers_properties[index]
+            sublayer_data = self.layers[index].layer_grid
+            column_offset, row_offset, columns_count, rows_count = self.layer_table[index, :LAYER_ARENA_OFFSET]
             chunk, dims = get_visible_chunk_accelerated(
                 x1, y1, x2, y2,
                 sublayer_data,
@@ -132,140 +336,53 @@ class NumbaGrid:
                 result_dimensions.append(dims)
         return result_chunks, result_dimensions
 
+    def update_texture_buffer_with_visible_data_directly(self, x1, y1, x2, y2, width_factor, height_factor, buffer,
+                                                         cancellation_signal):
+        """
+        Same result as NumpyGrid, the layers of the bounds are planned and copied by the compiled kernels
+        The kernels can't be canceled, the signal is checked before they start.
+        """
+        indexes = self.spatial_index.query(x1, y1, x2, y2)
+        if len(indexes) == 0 or cancellation_signal.is_canceled():
+            return
+        level_arena = self.get_level_arena(self.reducer)
+        copies = plan_copies(self.layer_table, level_arena.level_table, indexes, x1, y1, x2, y2,
+                             width_factor, height_factor)
+        if len(copies) == 0 or cancellation_signal.is_canceled():
+            return
+        rows_count = min(buffer.shape[0], int((copies[:, 0] + copies[:, 2]).max()))
+        if buffer.dtype == np.float32:
+            fill_buffer_kernel(buffer, self.layer_arena, level_arena.arena, copies, rows_count)
+        else:
+            # Kernel writes float32 only (float16 frame buffers), rows are converted back after the copy
+            rows = buffer[:rows_count].astype(np.float32)
+            fill_buffer_kernel(rows, self.layer_arena, level_arena.arena, copies, rows_count)
+            buffer[:rows_count] = rows
+
+    def get_point_data(self, x1, y1):
+        index = self.spatial_index.find_point(x1, y1)
+        if index < 0:
+            return None, None
+        sublayer = self.layers[index]
+        grid_index_y = y1 - sublayer.row_offset
+        grid_index_x = x1 - sublayer.column_offset
+        layer_grid = sublayer.layer_grid
+        if layer_grid.ndim == 1:
+            point_value = layer_grid[grid_index_y]
+        else:
+            point_value = layer_grid[grid_index_y, grid_index_x]
+        return point_value, sublayer.meta
+
+
+class NumbaLayer(NumpyLayer):
+    """
+    Layer of NumbaGrid, the data is replaced by a view of the grid arena when the layer is added
+    """
+
+    def __init__(self, layer_grid, name=None):
+        super().__init__(np.asarray(layer_grid), name)
 
-class NumbaLayer:
-    def __init__(self, layer_grid):
-        self.column_offset = 0
-        self.row_offset = 0
-        self.layer_grid = layer_grid
-        shape = self.layer_grid.shape
-        self.rows_count = unpack_h(shape)
-        self.columns_count = unpack_w(shape)
-        self.size = self.layer_grid.size
-        self.id = None
-
-    def define_layer_offset(self, column_offset, row_offset):
-        self.column_offset = column_offset
-        self.row_offset = row_offset
-        self.id = f"{self.column_offset}-{self.row_offset}-{self.columns_count}-{self.rows_count}-{self.size}"
-
-############### Maybe for later
-
-
-# @jit(nopython=True, cache=True)
-# def get_visible_data_chunks_accelerated_2d(
-#         layers_data_2d,
-#         layers_indexes_2d,
-#         layers_properties_2d,
-#         visible_layers_indexes_2d,
-#         x1, y1, x2, y2, width_factor, height_factor, grid_space=False):
-#     result_chunks = []
-#     result_dimensions = []
-#     # Iterate over each subgrid to check for intersections
-#     for index in visible_layers_indexes_2d:
-#         index_2d = layers_indexes_2d.index(index)
-#         layer_grid = layers_data_2d[index_2d]
-#
-#         # layer_grid = layers_data[index]
-#         column_offset, row_offset, columns_count, rows_count = layers_properties_2d[index]
-#         grid_x1 = column_offset
-#         grid_y1 = row_offset
-#         grid_x2 = grid_x1 + columns_count
-#         grid_y2 = grid_y1 + rows_count
-#
-#         if rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
-#             # Calculate the overlap area
-#             overlap_x1 = max(x1, grid_x1)
-#             overlap_y1 = max(y1, grid_y1)
-#             overlap_x2 = min(x2, grid_x2)
-#             overlap_y2 = min(y2, grid_y2)
-#             subgrid_slice = layer_grid[
-#                             overlap_y1 - grid_y1:overlap_y2 - grid_y1:height_factor,
-#                             overlap_x1 - grid_x1:overlap_x2 - grid_x1:width_factor]
-#             result_chunks.append(subgrid_slice)
-#             if grid_space:
-#                 shape = subgrid_slice.shape
-#                 h = unpack_h(shape)
-#                 w = unpack_w(shape)
-#                 dx1 = int((overlap_x1 - x1) / width_factor)
-#                 dy1 = int((overlap_y1 - y1) / height_factor)
-#                 result_dimensions.append(
-#                     (
-#                         dx1,
-#                         dy1,
-#                         dx1 + w,
-#                         dy1 + h
-#                     )
-#                 )
-#             else:
-#                 result_dimensions.append(
-#                     (overlap_x1,
-#                      overlap_y1,
-#                      overlap_x2,
-#                      overlap_y2))
-#     return result_chunks, result_dimensions
-#
-#
-# @jit(nopython=True, cache=True)
-# def get_visible_data_chunks_accelerated(
-#         layers_data_2d,
-#         layers_data_1d,
-#         layers_indexes_2d,
-#         layers_indexes_1d,
-#         layers_properties,
-#         visible_layers_indexes,
-#         x1, y1, x2, y2, width_factor, height_factor, grid_space=False):
-#     result_chunks = []
-#     result_dimensions = []
-#     # Iterate over each subgrid to check for intersections
-#     for index in visible_layers_indexes:
-#         if index in layers_indexes_2d:
-#             index_2d = layers_indexes_2d.index(index)
-#             layer_grid = layers_data_2d[index_2d]
-#         else:
-#             index_1d = layers_indexes_1d.index(index)
-#             layer_grid = layers_data_1d[index_1d]
-#
-#         # layer_grid = layers_data[index]
-#         column_offset, row_offset, columns_count, rows_count = layers_properties[index]
-#         grid_x1 = column_offset
-#         grid_y1 = row_offset
-#         grid_x2 = grid_x1 + columns_count
-#         grid_y2 = grid_y1 + rows_count
-#
-#         if rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
-#             # Calculate the overlap area
-#             overlap_x1 = max(x1, grid_x1)
-#             overlap_y1 = max(y1, grid_y1)
-#             overlap_x2 = min(x2, grid_x2)
-#             overlap_y2 = min(y2, grid_y2)
-#             if layer_grid.ndim == 1:
-#                 # Direct slicing and subsampling in one step
-#                 subgrid_slice = layer_grid[overlap_y1 - grid_y1:overlap_y2 - grid_y1:height_factor]
-#             else:
-#                 # For 2D arrays, perform slicing and subsampling for both dimensions in one step
-#                 subgrid_slice = layer_grid[
-#                                 overlap_y1 - grid_y1:overlap_y2 - grid_y1:height_factor,
-#                                 overlap_x1 - grid_x1:overlap_x2 - grid_x1:width_factor]
-#             result_chunks.append(subgrid_slice)
-#             if grid_space:
-#                 shape = subgrid_slice.shape
-#                 h = unpack_h(shape)
-#                 w = unpack_w(shape)
-#                 dx1 = int((overlap_x1 - x1) / width_factor)
-#                 dy1 = int((overlap_y1 - y1) / height_factor)
-#                 result_dimensions.append(
-#                     (
-#                         dx1,
-#                         dy1,
-#                         dx1 + w,
-#                         dy1 + h
-#                     )
-#                 )
-#             else:
-#                 result_dimensions.append(
-#                     (overlap_x1,
-#                      overlap_y1,
-#                      overlap_x2,
-#                      overlap_y2))
-#     return result_chunks, result_dimensions
+    def attach(self, layer_grid):
+        # Pyramids of the old data are packed again from the arena
+        self._layer_grid = layer_grid
+        self.lod_levels = {}
@@ -1,9 +1,14 @@
+import logging
 import math
 import time
 
 import numpy as np
 from numba import njit, jit
 
+from app.grid.spatial_index import LayerSpatialIndex
+
+logger = logging.getLogger(__name__)
+
 
 def unpack_shape(array):
     shape = array.shape
@@ -20,23 +25,24 @@ class NumpyAverageGrid:
     def __init__(self):
         self.layers = []
         self.visible_layers = []
+        self.spatial_index = LayerSpatialIndex()
 
-        # import timeit
-        #
-        # arr = np.random.rand(100000000)
-        #
-        # # np.mean
-        # print(timeit.timeit('np.mean(arr)', setup='import numpy as np; arr = np.random.rand(1000000)', number=1000))
-        #
-        # # np.sum / arr.size
-        # print(timeit.timeit('np.sum(arr) / arr.size', setup='import numpy as np; arr = np.random.rand(1000000)',
-        #                     number=1000))
-        # start_time = time.time()
-        # tmp = mean_numba(arr)
-        # print("Numba result", time.time() - start_time)
+    def clear(self):
+        self.layers = []
+        self.visible_layers = []
+        self.spatial_index.clear()
 
     def add_layers(self, layers):
         self.layers = layers
+        self.spatial_index.build(self.layers)
+
+    def build_lod_pyramids(self):
+        # Averages are computed per frame, pyramid is not used
+        pass
+
+    def set_reducer(self, reducer):
+        # Always averages the visible chunks
+        pass
 
     def rectangles_intersect(self, x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
         # Check if one rectangle is on left side of other
@@ -48,14 +54,7 @@ class NumpyAverageGrid:
         return True
 
     def get_visible_layers(self, x1, y1, x2, y2):
-        visible_layers = []
-        for sublayer in self.layers:
-            grid_x1 = sublayer.column_offset
-            grid_y1 = sublayer.row_offset
-            grid_x2 = grid_x1 + sublayer.columns_count
-            grid_y2 = grid_y1 + sublayer.rows_count
-            if self.rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
-                visible_layers.append(sublayer)
+        visible_layers = [self.layers[index] for index in self.spatial_index.query(x1, y1, x2, y2)]
         self.visible_layers = visible_layers
         return visible_layers
 
@@ -110,7 +109,7 @@ class NumpyAverageGrid:
                     w = ow / height_factor
                     if w == 0 or h == 0:
                         continue
-                    print("shape", oh, ow, h, w, "factor", width_factor, subgrid_slice.shape)
+                    logger.debug("Shape %s %s %s %s factor %s %s", oh, ow, h, w, width_factor, subgrid_slice.shape)
 
                     collapsed_grid = np.average(
                         subgrid_slice.reshape((int(h), height_factor,
@@ -137,6 +136,23 @@ class NumpyAverageGrid:
                          overlap_y2))
         return result_chunks, result_dimensions
 
+    def get_point_data(self, x1, y1):
+        index = self.spatial_index.find_point(x1, y1)
+        if index < 0:
+            # Return None if the point is not found in any layer
+            return None, None
+        sublayer = self.layers[index]
+        # Calculate the index in the sublayer's grid
+        grid_index_y = y1 - sublayer.row_offset
+        grid_index_x = x1 - sublayer.column_offset
+
+        # Retrieve the point value
+        if sublayer.layer_grid.ndim == 1:
+            point_value = sublayer.layer_grid[grid_index_y]
+        else:
+            point_value = sublayer.layer_grid[grid_index_y, grid_index_x]
+        return point_value, sublayer.meta
+
 
 class NumpyLayer:
     def __init__(self, layer_grid):
@@ -1,12 +1,24 @@
+import logging
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+from app.grid.lod_pyramid import build_lod_levels, select_lod_level, REDUCER_POINT, REDUCERS
+from app.grid.spatial_index import LayerSpatialIndex
+
+logger = logging.getLogger(__name__)
+
+# Frame buffer is assembled in bands of rows, one band per task of the tile executor
+TILE_ROWS = 256
+TILE_WORKERS_COUNT = min(8, os.cpu_count() or 1)
+
 
 def unpack_shape(array):
     if type(array) is list:
         return len(array), 1
-    shape = array.shape
+    shape = array if type(array) is tuple else array.shape
     if len(shape) == 1:
         return shape[0], 1  # or (shape[0], 1) if you prefer to treat it as a single column with many rows
     return shape[0], shape[1]
@@ -16,9 +28,47 @@ class NumpyGrid:
     def __init__(self):
         self.layers = []
         self.visible_layers = []
+        # How a block of weights is reduced to a single value when zoomed out
+        self.reducer = REDUCER_POINT
+        self.spatial_index = LayerSpatialIndex()
+        self.tile_workers_count = TILE_WORKERS_COUNT
+        self.tile_executor = None
+
+    def clear(self):
+        self.layers = []
+        self.visible_layers = []
+        self.spatial_index.clear()
 
     def add_layers(self, layers):
         self.layers += layers
+        self.spatial_index.build(self.layers)
+
+    def build_lod_pyramids(self):
+        for sublayer in self.layers:
+            # Lazy layers build their pyramid on the first frame that shows them
+            if sublayer.is_loaded():
+                sublayer.build_lod_pyramid(self.reducer)
+
+    def set_reducer(self, reducer):
+        if reducer not in REDUCERS:
+            logger.warning("Unknown reducer %s, keeping %s", reducer, self.reducer)
+            return
+        # Pyramids are cached per reducer, missing levels are built on the first frame that needs them
+        self.reducer = reducer
+
+    def set_tile_workers_count(self, count):
+        if count == self.tile_workers_count:
+            return
+        self.tile_workers_count = count
+        if self.tile_executor is not None:
+            self.tile_executor.shutdown(wait=False)
+            self.tile_executor = None
+
+    def get_tile_executor(self):
+        if self.tile_executor is None:
+            self.tile_executor = ThreadPoolExecutor(max_workers=self.tile_workers_count,
+                                                    thread_name_prefix="frame_tile")
+        return self.tile_executor
 
     def rectangles_intersect(self, x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
         # Check if one rectangle is on left side of other
@@ -30,14 +80,7 @@ class NumpyGrid:
         return True
 
     def get_visible_layers(self, x1, y1, x2, y2):
-        visible_layers = []
-        for sublayer in self.layers:
-            grid_x1 = sublayer.column_offset
-            grid_y1 = sublayer.row_offset
-            grid_x2 = grid_x1 + sublayer.columns_count
-            grid_y2 = grid_y1 + sublayer.rows_count
-            if self.rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
-                visible_layers.append(sublayer)
+        visible_layers = [self.layers[index] for index in self.spatial_index.query(x1, y1, x2, y2)]
         self.visible_layers = visible_layers
         return visible_layers
 
@@ -97,65 +140,109 @@ class NumpyGrid:
 
     def update_texture_buffer_with_visible_data_directly(self, x1, y1, x2, y2, width_factor, height_factor, buffer,
                                                          cancellation_signal):
+        """
+        The buffer is filled in bands of TILE_ROWS rows on the tile executor, bands are disjoint so they need no locks.
+        Copies of the layers are planned first (one job per layer, loads lazy layers and builds missing pyramids),
+        every band then copies its rows of every planned layer. NumPy copies release the GIL.
+        """
+        # Layers of these bounds, visible_layers may already belong to a newer viewport
+        layers = [self.layers[index] for index in self.spatial_index.query(x1, y1, x2, y2)]
+        if len(layers) == 0:
+            return
+        executor = self.get_tile_executor()
 
-        layers = self.visible_layers
-        # print("shape",output_grid.shape)
-        for index, sublayer in enumerate(layers):
+        plan_jobs = [executor.submit(self._plan_layer_copy, sublayer, x1, y1, x2, y2, width_factor, height_factor,
+                                     cancellation_signal) for sublayer in layers]
+        copies = [job.result() for job in plan_jobs]
+        if cancellation_signal.is_canceled():
+            logger.debug("Updating buffer canceled, planning %s", len(layers))
+            return
+        copies = [copy for copy in copies if copy is not None]
 
-            if cancellation_signal.is_canceled():
-                print("Updating buffer canceled! ", index, "/", len(layers))
-                return
+        rows_count = min(buffer.shape[0], max(copy[0] + copy[2] for copy in copies)) if len(copies) > 0 else 0
+        bands = [(row, min(row + TILE_ROWS, rows_count)) for row in range(0, rows_count, TILE_ROWS)]
+        band_jobs = [executor.submit(self._copy_band, buffer, copies, row_start, row_end, cancellation_signal)
+                     for row_start, row_end in bands]
+        for job in band_jobs:
+            job.result()
+        if cancellation_signal.is_canceled():
+            logger.debug("Updating buffer canceled, bands %s", len(bands))
 
-            grid_x1 = sublayer.column_offset
-            grid_y1 = sublayer.row_offset
-            grid_x2 = grid_x1 + sublayer.columns_count
-            grid_y2 = grid_y1 + sublayer.rows_count
+    def _plan_layer_copy(self, sublayer, x1, y1, x2, y2, width_factor, height_factor, cancellation_signal):
+        """
+        :return: (dy1, dx1, h, w, level, start_y, start_x, step_y, step_x) or None if the layer is not in the bounds
+        """
+        if cancellation_signal.is_canceled():
+            return None
 
-            if self.rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
-                overlap_x1 = max(x1, grid_x1)
-                overlap_y1 = max(y1, grid_y1)
-                overlap_x2 = min(x2, grid_x2)
-                overlap_y2 = min(y2, grid_y2)
+        grid_x1 = sublayer.column_offset
+        grid_y1 = sublayer.row_offset
+        grid_x2 = grid_x1 + sublayer.columns_count
+        grid_y2 = grid_y1 + sublayer.rows_count
 
-                dx1 = (overlap_x1 - x1) // width_factor
-                dy1 = (overlap_y1 - y1) // height_factor
+        if not self.rectangles_intersect(x1, y1, x2, y2, grid_x1, grid_y1, grid_x2, grid_y2):
+            return None
+        overlap_x1 = max(x1, grid_x1)
+        overlap_y1 = max(y1, grid_y1)
+        overlap_x2 = min(x2, grid_x2)
+        overlap_y2 = min(y2, grid_y2)
 
-                # Pre calculate the shape of the slice
-                h = (overlap_y2 - overlap_y1 + height_factor - 1) // height_factor
-                w = (overlap_x2 - overlap_x1 + width_factor - 1) // width_factor
+        # Layers are sampled from their first row and column, so a sample keeps its place in the buffer
+        # when the bounds move by a multiple of the factor (frames shifted by NFrameProducer)
+        first_y = -(-(overlap_y1 - grid_y1) // height_factor)
+        first_x = -(-(overlap_x1 - grid_x1) // width_factor)
 
-                # Assign slice directly
-                if sublayer.layer_grid.ndim == 1:
-                    buffer[dy1:dy1 + h, dx1:dx1 + 1] = sublayer.layer_grid[(overlap_y1 - grid_y1):(
-                            overlap_y2 - grid_y1):height_factor][:, np.newaxis]
-                else:
-                    buffer[dy1:dy1 + h, dx1:dx1 + w] = sublayer.layer_grid[
-                                                       (overlap_y1 - grid_y1):(overlap_y2 - grid_y1):height_factor,
-                                                       (overlap_x1 - grid_x1):(overlap_x2 - grid_x1):width_factor]
+        # Pre calculate the shape of the slice
+        h = -(-(overlap_y2 - grid_y1) // height_factor) - first_y
+        w = -(-(overlap_x2 - grid_x1) // width_factor) - first_x
+        if h <= 0 or w <= 0:
+            return None
 
-    def get_point_data(self, x1, y1):
-        for sublayer in self.visible_layers:
-            grid_x1 = sublayer.column_offset
-            grid_y1 = sublayer.row_offset
-            grid_x2 = grid_x1 + sublayer.columns_count
-            grid_y2 = grid_y1 + sublayer.rows_count
+        dy1 = (grid_y1 - y1) // height_factor + first_y
+        dx1 = (grid_x1 - x1) // width_factor + first_x
 
-            # Check if the point is within the bounds of the current sublayer
-            if grid_x1 <= x1 < grid_x2 and grid_y1 <= y1 < grid_y2:
-                # Calculate the index in the sublayer's grid
-                grid_index_y = y1 - grid_y1
-                grid_index_x = x1 - grid_x1
+        # Read from the pre downsampled level, the rest of the factor is covered by the step
+        level, level_factor = sublayer.get_lod_level(width_factor, height_factor, self.reducer)
+        step_y = height_factor // level_factor
+        step_x = width_factor // level_factor
+        start_y = first_y * height_factor // level_factor
+        start_x = first_x * width_factor // level_factor
+        return dy1, dx1, h, w, level, start_y, start_x, step_y, step_x
 
-                # Retrieve the point value
-                if sublayer.layer_grid.ndim == 1:
-                    point_value = sublayer.layer_grid[grid_index_y]
-                else:
-                    point_value = sublayer.layer_grid[grid_index_y, grid_index_x]
+    def _copy_band(self, buffer, copies, row_start, row_end, cancellation_signal):
+        # Layers are copied in order, same as a single pass over the whole buffer
+        for dy1, dx1, h, w, level, start_y, start_x, step_y, step_x in copies:
+            if cancellation_signal.is_canceled():
+                return
+            band_y1 = max(dy1, row_start)
+            band_y2 = min(dy1 + h, row_end)
+            if band_y1 >= band_y2:
+                continue
+            sy = start_y + (band_y1 - dy1) * step_y
+            sy2 = sy + (band_y2 - band_y1) * step_y
+            # Assign slice directly
+            if level.ndim == 1:
+                buffer[band_y1:band_y2, dx1:dx1 + 1] = level[sy:sy2:step_y][:, np.newaxis]
+            else:
+                buffer[band_y1:band_y2, dx1:dx1 + w] = level[sy:sy2:step_y, start_x:start_x + w * step_x:step_x]
 
-                return point_value, sublayer.meta
+    def get_point_data(self, x1, y1):
+        index = self.spatial_index.find_point(x1, y1)
+        if index < 0:
+            # Return None if the point is not found in any layer
+            return None, None
+        sublayer = self.layers[index]
+        # Calculate the index in the sublayer's grid
+        grid_index_y = y1 - sublayer.row_offset
+        grid_index_x = x1 - sublayer.column_offset
 
-        # Return None if the point is not found in any visible layer
-        return None, None
+        # Retrieve the point value
+        layer_grid = sublayer.layer_grid
+        if layer_grid.ndim == 1:
+            point_value = layer_grid[grid_index_y]
+        else:
+            point_value = layer_grid[grid_index_y, grid_index_x]
+        return point_value, sublayer.meta
 
 
 # A bit retarded but I don't want to pass the grid data around
@@ -171,15 +258,69 @@ class LayerMetaData:
 
 
 class NumpyLayer:
-    def __init__(self, layer_grid, name):
+    """
+    Layer data with its position in the grid
+
+    Lazy layers are created with layer_grid=None, the shape and a loader callback. The data is loaded
+    the first time the grid reads layer_grid and released again by the memory budget.
+    """
+
+    def __init__(self, layer_grid, name, shape=None, loader=None, memory_budget=None):
         self.column_offset = 0
         self.row_offset = 0
-        self.layer_grid = layer_grid
-        self.rows_count, self.columns_count = unpack_shape(self.layer_grid)
-        self.size = self.layer_grid.size
+        self._layer_grid = layer_grid
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.shape = tuple(layer_grid.shape) if layer_grid is not None else tuple(shape)
+        self.rows_count, self.columns_count = unpack_shape(self.shape)
+        self.size = math.prod(self.shape)
         self.name = name
         self.id = None
         self.meta = None
+        # Level of detail pyramids {reducer: {factor: downsampled layer_grid}}
+        self.lod_levels = {}
+
+    @property
+    def layer_grid(self):
+        layer_grid = self._layer_grid
+        if layer_grid is None and self.loader is not None:
+            layer_grid = self.loader()
+            self._layer_grid = layer_grid
+            if self.memory_budget is not None:
+                self.memory_budget.update(self)
+        elif self.memory_budget is not None:
+            self.memory_budget.touch(self)
+        return layer_grid
+
+    def is_loaded(self):
+        return self._layer_grid is not None
+
+    def release(self):
+        # Only lazy layers can be loaded again
+        if self.loader is not None:
+            self._layer_grid = None
+            self.lod_levels = {}
+
+    def get_memory_size(self):
+        layer_grid = self._layer_grid
+        size = layer_grid.nbytes if layer_grid is not None else 0
+        for levels in list(self.lod_levels.values()):
+            size += sum(level.nbytes for level in levels.values())
+        return size
+
+    def build_lod_pyramid(self, reducer=REDUCER_POINT):
+        levels = self.lod_levels.get(reducer)
+        if levels is None:
+            levels = build_lod_levels(self.layer_grid, reducer)
+            self.lod_levels[reducer] = levels
+            if self.memory_budget is not None:
+                self.memory_budget.update(self)
+        return levels
+
+    def get_lod_level(self, width_factor, height_factor, reducer=REDUCER_POINT):
+        layer_grid = self.layer_grid
+        levels = self.build_lod_pyramid(reducer)
+        return select_lod_level(layer_grid, levels, width_factor, height_factor)
 
     def define_layer_offset(self, column_offset, row_offset):
         self.column_offset = column_offset
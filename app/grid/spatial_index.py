@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class LayerSpatialIndex:
+    """
+    Sorted interval index over the layer bounds, shared by all grid backends
+
+    Layers are sorted by their first column. Running maximum of the last column makes it possible to
+    find the first layer that can reach the query with a binary search, so a query costs
+    O(log n + k) where k is the number of layers overlapping the query columns.
+    Rows are filtered with a vectorized mask, layers stacked by NNet.add_layers share the same columns.
+
+    Bounds are inclusive, same as rectangles_intersect in the grids.
+    """
+
+    def __init__(self):
+        self.order = np.empty(0, dtype=np.int64)
+        self.x1 = np.empty(0, dtype=np.int64)
+        self.y1 = np.empty(0, dtype=np.int64)
+        self.x2 = np.empty(0, dtype=np.int64)
+        self.y2 = np.empty(0, dtype=np.int64)
+        self.max_x2 = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.order)
+
+    def clear(self):
+        self.__init__()
+
+    def build(self, layers):
+        count = len(layers)
+        x1 = np.fromiter((l.column_offset for l in layers), dtype=np.int64, count=count)
+        y1 = np.fromiter((l.row_offset for l in layers), dtype=np.int64, count=count)
+        x2 = x1 + np.fromiter((l.columns_count for l in layers), dtype=np.int64, count=count)
+        y2 = y1 + np.fromiter((l.rows_count for l in layers), dtype=np.int64, count=count)
+        self.build_from_bounds(x1, y1, x2, y2)
+
+    def build_from_bounds(self, x1, y1, x2, y2):
+        self.order = np.argsort(x1, kind="stable")
+        self.x1 = np.ascontiguousarray(x1[self.order])
+        self.y1 = np.ascontiguousarray(y1[self.order])
+        self.x2 = np.ascontiguousarray(x2[self.order])
+        self.y2 = np.ascontiguousarray(y2[self.order])
+        self.max_x2 = np.maximum.accumulate(self.x2) if len(self.x2) > 0 else self.x2
+
+    def _find(self, x1, y1, x2, y2):
+        # Every layer before start ends before the query, every layer from end starts after it
+        start = np.searchsorted(self.max_x2, x1, side="left")
+        end = np.searchsorted(self.x1, x2, side="right")
+        if start >= end:
+            return start, start, None
+        mask = ((self.x2[start:end] >= x1)
+                & (self.y1[start:end] <= y2)
+                & (self.y2[start:end] >= y1))
+        return start, end, mask
+
+    def query(self, x1, y1, x2, y2):
+        """
+        :return: indexes of the layers intersecting the rectangle, in the order the layers were added
+        """
+        start, end, mask = self._find(x1, y1, x2, y2)
+        if mask is None:
+            return self.order[0:0]
+        return np.sort(self.order[start:end][mask])
+
+    def query_bounds(self, x1, y1, x2, y2):
+        """
+        Bounds of the layers intersecting the rectangle, without looking at the layers themselves
+        :return: x1, y1, x2, y2 arrays, in no particular order
+        """
+        start, end, mask = self._find(x1, y1, x2, y2)
+        if mask is None:
+            return self.x1[0:0], self.y1[0:0], self.x2[0:0], self.y2[0:0]
+        return self.x1[start:end][mask], self.y1[start:end][mask], self.x2[start:end][mask], self.y2[start:end][mask]
+
+    def find_point(self, x, y):
+        """
+        Column lookup for hover and click, binary search on the first columns plus the check of the found layer.
+        Walks back only over the layers that share the column (stacked rows).
+        Bounds are half open here, same as get_point_data in the grids.
+
+        :return: index of the layer containing the point or -1
+        """
+        index = int(np.searchsorted(self.x1, x, side="right")) - 1
+        while index >= 0 and self.max_x2[index] > x:
+            if self.x2[index] > x and self.y1[index] <= y < self.y2[index]:
+                return int(self.order[index])
+            index -= 1
+        return -1
@@ -0,0 +1,358 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Tile side in buffer cells, a tile covers TILE_SIZE * factor world rows and columns
+TILE_SIZE = 256
+DEFAULT_TILE_CACHE_BUDGET = 512 * 1024 * 1024
+DEFAULT_PREFETCH_BUDGET = 128 * 1024 * 1024
+# Bytes counted for a cached tile besides its cells, empty tiles are not free
+TILE_OVERHEAD_BYTES = 256
+# Bands of missing tiles waiting for build_pending, the oldest are dropped first
+MAX_PENDING_BANDS = 256
+
+
+class Tile:
+    """
+    Cells of a tile cropped to the bounding box of the layers in the tile, the rest of the tile is empty
+    Frame buffers are filled with the empty value first, only the crop is copied.
+    """
+    __slots__ = ("data", "row", "col", "nbytes")
+
+    def __init__(self, data, row=0, col=0):
+        self.data = data
+        self.row = row
+        self.col = col
+        self.nbytes = data.nbytes + TILE_OVERHEAD_BYTES
+
+
+def get_tile_crops(grid, factor, tx1, tx2, ty, tile_size):
+    """
+    Cells of the tiles tx1 to tx2 (excluded) of the tile row ty that layers cover, from the layer bounds
+    of the spatial index, the cells are never scanned. A cell partly covered by a layer is kept.
+    Grids without a spatial index keep whole tiles.
+
+    :return: list of (row1, col1, row2, col2) per tile, ends excluded
+    """
+    tiles_count = tx2 - tx1
+    spatial_index = getattr(grid, "spatial_index", None)
+    if spatial_index is None:
+        return [(0, 0, tile_size, tile_size)] * tiles_count
+    span = tile_size * factor
+    x1 = tx1 * span
+    y1 = ty * span
+    layers_x1, layers_y1, layers_x2, layers_y2 = spatial_index.query_bounds(x1, y1, tx2 * span, y1 + span)
+    if len(layers_x1) == 0:
+        return [(0, 0, 0, 0)] * tiles_count
+
+    # World bounds of the layers relative to every tile, (tiles, layers)
+    tiles_x1 = x1 + np.arange(tiles_count, dtype=np.int64)[:, np.newaxis] * span
+    left = np.clip(layers_x1 - tiles_x1, 0, span)
+    right = np.clip(layers_x2 - tiles_x1, 0, span)
+    bottom = np.broadcast_to(np.clip(layers_y1 - y1, 0, span), left.shape)
+    top = np.broadcast_to(np.clip(layers_y2 - y1, 0, span), left.shape)
+    covered = (right > left) & (top > bottom)
+    col1 = np.where(covered, left, span).min(axis=1) // factor
+    col2 = -(-np.where(covered, right, 0).max(axis=1) // factor)
+    row1 = np.where(covered, bottom, span).min(axis=1) // factor
+    row2 = -(-np.where(covered, top, 0).max(axis=1) // factor)
+    return [(r1, c1, r2, c2) if c2 > c1 and r2 > r1 else (0, 0, 0, 0)
+            for r1, c1, r2, c2 in zip(row1.tolist(), col1.tolist(), row2.tolist(), col2.tolist())]
+
+
+class TileCache:
+    """
+    Frame buffers assembled from fixed size tiles, computed once per factor and kept in a LRU cache
+
+    Tiles are aligned to the world origin, tile (tx, ty) at factor f covers the world columns
+    [tx * TILE_SIZE * f, (tx + 1) * TILE_SIZE * f). Frame bounds are multiples of the factor,
+    so a frame is a set of tile slices copied into the buffer. Going back to a zoom level or a region
+    that was already visited copies cached tiles instead of reading the grid again.
+
+    Keys hold the loaded data id and the reducer, the cache is cleared when the grid changes.
+
+    Prefetched tiles are counted separately until a frame uses them, the oldest unused ones are dropped
+    once they go over the prefetch budget.
+
+    With deferred builds a frame with missing tiles is read from the grid directly, as fast as without the
+    cache, and its missing tiles are built later by build_pending (NPrefetcher, while no frame is built).
+    Otherwise the missing tiles are built right away, a first visit is then several times slower.
+    """
+
+    def __init__(self, budget_bytes=DEFAULT_TILE_CACHE_BUDGET, tile_size=TILE_SIZE,
+                 prefetch_budget_bytes=DEFAULT_PREFETCH_BUDGET):
+        self.budget_bytes = budget_bytes
+        self.prefetch_budget_bytes = prefetch_budget_bytes
+        self.tile_size = tile_size
+        self.tiles = OrderedDict()
+        self.total_bytes = 0
+        # Prefetched tiles not used by any frame yet, key -> size
+        self.prefetched = OrderedDict()
+        self.prefetched_bytes = 0
+        self.hits_count = 0
+        self.misses_count = 0
+        self.prefetch_hits_count = 0
+        self.deferred = False
+        # (data_key, factor, tx1, tx2, ty) -> grid, missing tiles of the frames read directly
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_enabled(self):
+        return self.budget_bytes > 0
+
+    def clear(self):
+        with self.lock:
+            self.tiles = OrderedDict()
+            self.total_bytes = 0
+            self.prefetched = OrderedDict()
+            self.prefetched_bytes = 0
+            self.pending = OrderedDict()
+
+    def set_deferred(self, deferred):
+        self.deferred = deferred
+        if not deferred:
+            with self.lock:
+                self.pending = OrderedDict()
+
+    def set_budget(self, budget_bytes):
+        with self.lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def set_prefetch_budget(self, budget_bytes):
+        with self.lock:
+            self.prefetch_budget_bytes = budget_bytes
+            self._evict_prefetched()
+
+    def get_tile(self, key):
+        return self.get_tiles([key])[0]
+
+    def get_tiles(self, keys):
+        # One lock for a whole row of tiles, None for the missing ones
+        result = []
+        with self.lock:
+            for key in keys:
+                tile = self.tiles.get(key)
+                if tile is not None:
+                    self.tiles.move_to_end(key)
+                    self.hits_count += 1
+                    if self.prefetched and self._forget_prefetched(key):
+                        self.prefetch_hits_count += 1
+                else:
+                    self.misses_count += 1
+                result.append(tile)
+        return result
+
+    def touch_tile(self, key):
+        # Predicted again, keep the tile without counting it as a hit
+        with self.lock:
+            if key not in self.tiles:
+                return False
+            self.tiles.move_to_end(key)
+            if key in self.prefetched:
+                self.prefetched.move_to_end(key)
+            return True
+
+    def put_tile(self, key, tile, prefetched=False):
+        with self.lock:
+            previous_tile = self.tiles.pop(key, None)
+            if previous_tile is not None:
+                self.total_bytes -= previous_tile.nbytes
+                self._forget_prefetched(key)
+            self.tiles[key] = tile
+            self.total_bytes += tile.nbytes
+            if prefetched:
+                self.prefetched[key] = tile.nbytes
+                self.prefetched_bytes += tile.nbytes
+                self._evict_prefetched()
+            self._evict()
+
+    def _forget_prefetched(self, key):
+        size = self.prefetched.pop(key, None)
+        if size is None:
+            return False
+        self.prefetched_bytes -= size
+        return True
+
+    def _evict(self):
+        while self.total_bytes > self.budget_bytes and len(self.tiles) > 0:
+            key, tile = self.tiles.popitem(last=False)
+            self.total_bytes -= tile.nbytes
+            self._forget_prefetched(key)
+
+    def _evict_prefetched(self):
+        # Oldest predictions that were never used go first
+        while self.prefetched_bytes > self._get_prefetch_limit() and len(self.prefetched) > 0:
+            key, size = self.prefetched.popitem(last=False)
+            self.prefetched_bytes -= size
+            tile = self.tiles.pop(key, None)
+            if tile is not None:
+                self.total_bytes -= tile.nbytes
+
+    def _get_prefetch_limit(self):
+        # Prefetching never pushes out more than a quarter of the cache
+        return max(0, min(self.prefetch_budget_bytes, self.budget_bytes // 4))
+
+    def get_prefetch_limit(self):
+        with self.lock:
+            return self._get_prefetch_limit()
+
+    def build_tile(self, grid, factor, tx, ty, cancellation_signal):
+        return self.build_tiles(grid, factor, tx, tx + 1, ty, cancellation_signal)[0]
+
+    def build_tiles(self, grid, factor, tx1, tx2, ty, cancellation_signal):
+        """
+        Tiles tx1 to tx2 (excluded) of the tile row ty, read from the grid in a single pass over a band
+        One grid read per band instead of one per tile, the layers are looked up once for the whole band.
+        """
+        span = self.tile_size * factor
+        band = np.full((self.tile_size, (tx2 - tx1) * self.tile_size), fill_value=-1, dtype=np.float32)
+        x1 = tx1 * span
+        y1 = ty * span
+        grid.update_texture_buffer_with_visible_data_directly(x1, y1, tx2 * span, y1 + span, factor, factor, band,
+                                                              cancellation_signal)
+        tiles = []
+        crops = get_tile_crops(grid, factor, tx1, tx2, ty, self.tile_size)
+        for index, (row1, col1, row2, col2) in enumerate(crops):
+            column = index * self.tile_size
+            # Copy, the tile doesn't keep the band it was built from alive
+            tiles.append(Tile(band[row1:row2, column + col1:column + col2].copy(), row1, col1))
+        return tiles
+
+    def fill_buffer(self, grid, x1, y1, x2, y2, factor, buffer, cancellation_signal, data_key):
+        """
+        Copy the tiles covering the bounds into the buffer, missing tiles are built from the grid
+        Bounds are multiples of the factor, same as VisibleGrid. The buffer is filled with -1 beforehand,
+        like for a direct read of the grid, empty cells of the tiles are not copied.
+        Consecutive missing tiles of a tile row are built together, see build_tiles. With deferred builds
+        a frame with missing tiles is read from the grid directly and the missing tiles wait for build_pending.
+        """
+        span = self.tile_size * factor
+        # Frame part that fits into the buffer
+        x2 = min(x2, x1 + buffer.shape[1] * factor)
+        y2 = min(y2, y1 + buffer.shape[0] * factor)
+        tx_range = range(x1 // span, (x2 + span - 1) // span)
+        rows = []
+        for ty in range(y1 // span, (y2 + span - 1) // span):
+            tiles = dict(zip(tx_range, self.get_tiles([(data_key, factor, tx, ty) for tx in tx_range])))
+            rows.append((ty, tiles, get_runs([tx for tx, tile in tiles.items() if tile is None])))
+
+        if self.deferred and any(len(runs) > 0 for _, _, runs in rows):
+            with self.lock:
+                for ty, _, runs in rows:
+                    for run_start, run_end in runs:
+                        self._add_pending((data_key, factor, run_start, run_end, ty), grid)
+            grid.update_texture_buffer_with_visible_data_directly(x1, y1, x2, y2, factor, factor, buffer,
+                                                                  cancellation_signal)
+            return
+
+        for ty, tiles, runs in rows:
+            if cancellation_signal.is_canceled():
+                return
+            for run_start, run_end in runs:
+                built_tiles = self.build_tiles(grid, factor, run_start, run_end, ty, cancellation_signal)
+                if cancellation_signal.is_canceled():
+                    # Partially built tiles are never cached
+                    return
+                for tx, tile in zip(range(run_start, run_end), built_tiles):
+                    self.put_tile((data_key, factor, tx, ty), tile)
+                    tiles[tx] = tile
+
+            for tx, tile in tiles.items():
+                rows_count, cols_count = tile.data.shape
+                # World bounds of the cells with data
+                data_x1 = tx * span + tile.col * factor
+                data_y1 = ty * span + tile.row * factor
+                overlap_x1 = max(x1, data_x1)
+                overlap_y1 = max(y1, data_y1)
+                overlap_x2 = min(x2, data_x1 + cols_count * factor)
+                overlap_y2 = min(y2, data_y1 + rows_count * factor)
+                if overlap_x1 >= overlap_x2 or overlap_y1 >= overlap_y2:
+                    continue
+                buffer[(overlap_y1 - y1) // factor:(overlap_y2 - y1) // factor,
+                       (overlap_x1 - x1) // factor:(overlap_x2 - x1) // factor] = \
+                    tile.data[(overlap_y1 - data_y1) // factor:(overlap_y2 - data_y1) // factor,
+                              (overlap_x1 - data_x1) // factor:(overlap_x2 - data_x1) // factor]
+
+    def _add_pending(self, band_key, grid):
+        self.pending.pop(band_key, None)
+        self.pending[band_key] = grid
+        while len(self.pending) > MAX_PENDING_BANDS:
+            self.pending.popitem(last=False)
+
+    def get_pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def build_pending(self, cancellation_signal, wait_func=None):
+        """
+        Build the tiles missing from the frames read directly, the most recent frame first
+        Returns the bytes of the built tiles.
+        wait_func is called before every band, it blocks while frames are being built.
+        """
+        built_bytes = 0
+        while True:
+            if wait_func is not None:
+                wait_func()
+            if cancellation_signal.is_canceled():
+                return built_bytes
+            with self.lock:
+                if len(self.pending) == 0:
+                    return built_bytes
+                band_key, grid = self.pending.popitem(last=True)
+            data_key, factor, tx1, tx2, ty = band_key
+            # Tiles built by an other frame or a prediction in the meantime
+            missing = [tx for tx in range(tx1, tx2) if not self.touch_tile((data_key, factor, tx, ty))]
+            for run_start, run_end in get_runs(missing):
+                built_tiles = self.build_tiles(grid, factor, run_start, run_end, ty, cancellation_signal)
+                if cancellation_signal.is_canceled():
+                    with self.lock:
+                        self._add_pending(band_key, grid)
+                    return built_bytes
+                for tx, tile in zip(range(run_start, run_end), built_tiles):
+                    self.put_tile((data_key, factor, tx, ty), tile)
+                    built_bytes += tile.nbytes
+
+    def prefetch(self, grid, x1, y1, x2, y2, factor, cancellation_signal, data_key, max_bytes, wait_func=None):
+        """
+        Build the missing tiles covering the bounds without copying them anywhere
+        Returns the bytes of the built tiles, at most max_bytes.
+        wait_func is called before every tile, it blocks while frames are being built.
+        """
+        span = self.tile_size * factor
+        # Size of a tile without empty cells, the budget is checked before the tile is built
+        tile_bytes = self.tile_size * self.tile_size * np.dtype(np.float32).itemsize
+        built_bytes = 0
+        for ty in range(y1 // span, (y2 + span - 1) // span):
+            for tx in range(x1 // span, (x2 + span - 1) // span):
+                if built_bytes + tile_bytes > max_bytes:
+                    return built_bytes
+                if wait_func is not None:
+                    wait_func()
+                if cancellation_signal.is_canceled():
+                    return built_bytes
+                key = (data_key, factor, tx, ty)
+                if self.touch_tile(key):
+                    continue
+                tile = self.build_tile(grid, factor, tx, ty, cancellation_signal)
+                if cancellation_signal.is_canceled():
+                    return built_bytes
+                # Older predictions that were never used make room for this one
+                self.put_tile(key, tile, prefetched=True)
+                built_bytes += tile.nbytes
+        return built_bytes
+
+
+def get_runs(values):
+    """
+    Consecutive runs of sorted integers
+    :return: list of (start, end) with end excluded
+    """
+    runs = []
+    for value in values:
+        if len(runs) > 0 and runs[-1][1] == value:
+            runs[-1][1] = value + 1
+        else:
+            runs.append([value, value + 1])
+    return [(start, end) for start, end in runs]
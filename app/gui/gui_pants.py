@@ -4,6 +4,9 @@ import glfw
 import imgui
 from imgui.integrations.glfw import GlfwRenderer
 
+from app.gl.n_pixel_buffer import upload_stall_counter
+from app.gl.n_profiler import profiler
+from app.gl.n_shader import gl_call_counter
 from app.gui.view_bottom_info_bar import BottomInfoBar
 from app.gui.view_layers import LayersView
 from app.gui.view_download_manager import DownloadManagerPage
@@ -48,6 +51,11 @@ class GuiPants:
         # Load the default font with a larger size
         self.large_font = io.fonts.add_font_from_file_ttf("res/ARIAL.TTF", 24.0)  # 24.0 is the font size in pixels
 
+    def is_active(self):
+        # Widget being dragged or edited, the GUI is redrawn every frame
+        io = imgui.get_io()
+        return imgui.is_any_item_active() or io.want_text_input
+
     def wants_mouse(self):
         io = imgui.get_io()
         return io.want_capture_mouse
@@ -139,6 +147,10 @@ class GuiPants:
         imgui.push_style_color(imgui.COLOR_TEXT, r, g, b, a)  # Red color
         imgui.text(f"{self.config.model_parser.current_model_name}")
         imgui.text(f"FPS: {self.fps:.2f}")
+        imgui.text(f"GL calls: {gl_call_counter.frame_calls_count}, skipped: {gl_call_counter.frame_skipped_count}")
+        imgui.text(f"Upload stall: {upload_stall_counter.frame_stall_ms:.2f} ms, "
+                   f"max {upload_stall_counter.max_stall_ms:.2f} ms, "
+                   f"{upload_stall_counter.stalls_count}/{upload_stall_counter.uploads_count} uploads")
         imgui.text(f"Color: {self.color_theme.name}")
         imgui.text(f"Buffer: {self.config.app_config.buffer_width}x{self.config.app_config.buffer_height}")
         imgui.text(self.config.utils.get_memory_message())
@@ -146,6 +158,25 @@ class GuiPants:
 
         imgui.end()
 
+    def render_profiler_box(self):
+        '''
+        Rolling span durations, next to the Fps box
+        :return:
+        '''
+        if not profiler.enabled:
+            return
+        imgui.set_next_window_bg_alpha(0.3)
+        imgui.set_next_window_position(500, imgui.get_frame_height(), imgui.ONCE)
+        imgui.begin("Profiler",
+                    flags=imgui.WINDOW_NO_TITLE_BAR | imgui.WINDOW_NO_MOVE | imgui.WINDOW_ALWAYS_AUTO_RESIZE)
+        r, g, b, a = self.color_theme.color_high
+        imgui.push_style_color(imgui.COLOR_TEXT, r, g, b, a)
+        for name, count, (p50, p95, max_ms), values in profiler.get_summary([50, 95, 100]):
+            imgui.text(f"{name}: p50 {p50:.2f} ms, p95 {p95:.2f} ms, max {max_ms:.2f} ms, {count} spans")
+            imgui.plot_lines(f"##{name}", values, scale_min=0.0, graph_size=(400, 30))
+        imgui.pop_style_color()
+        imgui.end()
+
     def render_active_message(self):
         if self.config.active_layer is None:
             return
@@ -182,6 +213,7 @@ class GuiPants:
         self.neuron_popup.render()
         # self.render_active_message()
         self.render_config_box()
+        self.render_profiler_box()
         #self.render_scene_buttons()
         self.layers_view.render()
         self.model_settings_page.render()
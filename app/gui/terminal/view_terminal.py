@@ -170,10 +170,10 @@ class ScienceBasedTerminal(Widget):
 
     def pipeline_selector(self):
         if self.terminal_Type == TerminalType.MODEL:
-            if self.config.model_parser.model is None:
+            if not self.config.model_parser.has_model():
                 self.window_name = "No model detected"
             else:
-                self.window_name = f"Model: {self.config.model_parser.parsed_model.name}"
+                self.window_name = f"Model: {self.config.model_parser.current_model_name}"
             imgui.text(f"Pipeline:")
             imgui.same_line()
             imgui.push_item_width(250)
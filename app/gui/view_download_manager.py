@@ -58,6 +58,8 @@ class DownloadManagerPage(Widget):
             y = center[1] + math.sin(angle) * radius
             color = imgui.get_color_u32_rgba(1.0, 1.0, 1.0, 1.0 * (i / num_segments))
             draw_list.add_circle_filled(x, y, thickness, color)
+        # Keep the spinner turning while the main loop is idle
+        self.config.n_window.request_redraw()
 
     def _content(self):
 
@@ -113,6 +113,7 @@ class LayersView(Widget):
 
         self.current_weights_id = None
         self.current_model_id = None
+        self.current_layout_type = None
 
     def _load_layers(self):
         self.layers.clear()
@@ -137,8 +138,10 @@ class LayersView(Widget):
 
     def _content(self):
         self.hovering = False
-        if self.current_model_id != self.config.model_parser.current_model_name:
+        if (self.current_model_id != self.config.model_parser.current_model_name
+                or self.current_layout_type != self.n_net.layout_type):
             self.current_model_id = self.config.model_parser.current_model_name
+            self.current_layout_type = self.n_net.layout_type
             self._load_layers()
 
         for l in self.layers:
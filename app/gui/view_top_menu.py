@@ -1,5 +1,8 @@
 import imgui
 
+from app.gl.n_profiler import profiler
+from app.grid.lod_pyramid import REDUCERS
+from app.grid.n_layout import LAYOUT_NAMES
 from app.gui.file_dialog import FileDialog
 
 
@@ -14,6 +17,8 @@ class TopMenu:
         self.buffer_height = self.gui_config.app_config.buffer_height
         self.enable_blend = self.gui_config.app_config.enable_blend
         self.power_of_two = self.gui_config.app_config.power_of_two
+        self.lod_reducer = self.gui_config.app_config.lod_reducer
+        self.layout_type = self.gui_config.app_config.layout_type
         self.file_dialog = FileDialog(self.gui_config.app_config)
 
         self.selected_directory = None
@@ -67,13 +72,22 @@ class TopMenu:
                 changed, pwr_of_two = imgui.checkbox("Power of Two", self.power_of_two)
                 if changed:
                     self.power_of_two = pwr_of_two
+                reducer_index = REDUCERS.index(self.lod_reducer) if self.lod_reducer in REDUCERS else 0
+                changed, reducer_index = imgui.combo("Reducer", reducer_index, REDUCERS)
+                if changed:
+                    self.lod_reducer = REDUCERS[reducer_index]
+                changed, layout_type = imgui.combo("Layout", self.layout_type, LAYOUT_NAMES)
+                if changed:
+                    self.layout_type = layout_type
 
                 if imgui.button("Save Settings"):
                     self.gui_config.app_config.set_graphics_settings(
                         self.buffer_width,
                         self.buffer_height,
                         self.power_of_two,
-                        self.enable_blend
+                        self.enable_blend,
+                        self.lod_reducer,
+                        self.layout_type
                     )
                     self.gui_config.app.reload_graphics_settings()
                     imgui.close_current_popup()  # Close the settings menu
@@ -85,5 +99,11 @@ class TopMenu:
                     self.terminal_view.opened = not self.terminal_view.opened
                 if imgui.menu_item("Downloads manager", selected=self.model_manager_view.opened)[0]:
                     self.model_manager_view.opened = not self.model_manager_view.opened
+                imgui.separator()
+                if imgui.menu_item("Profiler", selected=profiler.enabled)[0]:
+                    profiler.set_enabled(not profiler.enabled)
+                    self.gui_config.app_config.profiler_enabled = profiler.enabled
+                if imgui.menu_item("Save Chrome Trace", enabled=profiler.enabled)[0]:
+                    print("Chrome trace saved", profiler.save_chrome_trace())
                 imgui.end_menu()
             imgui.end_main_menu_bar()
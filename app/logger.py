@@ -0,0 +1,118 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+import psutil
+
+# Parent of the loggers of all the modules, logging.getLogger(__name__)
+APP_LOGGER_NAME = "app"
+DEFAULT_LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(levelname)s %(name)s: %(message)s"
+# Seconds between two records of the same call site, errors are never dropped
+DEFAULT_RATE_LIMIT = 1.0
+DEFAULT_MEMORY_MONITOR_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    At most one record per call site (file and line) every interval seconds
+
+    Records dropped in between are counted, the next record of the call site tells how many there were.
+    """
+
+    def __init__(self, interval=DEFAULT_RATE_LIMIT):
+        super().__init__()
+        self.interval = interval
+        self.last_times = {}
+        self.dropped_counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        # Warnings are limited too, a fallback taken on every frame warns on every frame
+        if record.levelno >= logging.ERROR or self.interval <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            last_time = self.last_times.get(key)
+            if last_time is not None and now - last_time < self.interval:
+                self.dropped_counts[key] = self.dropped_counts.get(key, 0) + 1
+                return False
+            self.last_times[key] = now
+            dropped_count = self.dropped_counts.pop(key, 0)
+        if dropped_count > 0:
+            record.msg = f"{record.msg} ({dropped_count} more since the last one)"
+        return True
+
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, rate_limit=DEFAULT_RATE_LIMIT, stream=None):
+    """
+    Level and rate limit of the application loggers, called again when the settings change
+    Without this only warnings and errors are printed (benchmarks, frame processes).
+    """
+    app_logger = logging.getLogger(APP_LOGGER_NAME)
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            level = logging.INFO
+    app_logger.setLevel(level)
+    app_logger.propagate = False
+    for handler in list(app_logger.handlers):
+        app_logger.removeHandler(handler)
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter(rate_limit))
+    app_logger.addHandler(handler)
+    return app_logger
+
+
+class MemoryMonitor:
+    """
+    Resident memory of the process sampled on a background thread
+
+    The render loop only reads the last sample, a change is logged when the rounded value changes.
+    """
+
+    def __init__(self, interval=DEFAULT_MEMORY_MONITOR_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.rss_bytes = 0
+        self.memory_usage = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.sample()
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="memory_monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        self.rss_bytes = self.process.memory_info().rss
+        usage = f"{self.rss_bytes / (1024 * 1024 * 1024):.2f}"
+        if self.memory_usage != usage:
+            self.memory_usage = usage
+            logger.info(self.get_message())
+        return self.rss_bytes
+
+    def get_message(self):
+        return f"Memory usage: {self.memory_usage} GB"
@@ -4,6 +4,7 @@ from matplotlib import pyplot as plt
 from transformers import AutoModelForCausalLM
 
 from app.gl.n_opengl import OpenGLApplication
+from app.grid.layer_store import get_layer_store_path
 
 
 def from_model():
@@ -18,9 +19,10 @@ def from_model():
 
 
 
-def from_memfile():
+def from_memfile(model_name="TinyLlama-1.1B-Chat-v1.0"):
+    # Layer store written by a previous run of the model, no torch needed to browse the weights
     app = OpenGLApplication()
-    app.start(None)
+    app.start(None, layer_store_path=get_layer_store_path(model_name))
 
 
 if __name__ == "__main__":
@@ -1,26 +1,21 @@
-import os
-
 import numpy as np
-import psutil
 from PIL import Image, ImageFont, ImageDraw, ImageOps
 from matplotlib import pyplot as plt
 
+from app.logger import MemoryMonitor
+
 
 class FancyUtilsClass:
     def __init__(self):
-        self.process = psutil.Process(os.getpid())
-        self.memory_usage = 0
-        self.virtual_memory_usage = 0
+        # Sampled on a background thread once started, the render loop only reads the last sample
+        self.memory_monitor = MemoryMonitor()
 
     def print_memory_usage(self):
-        mem_info = self.process.memory_info()
-        usage = f"{mem_info.rss / (1024 * 1024 * 1024):.2f}"
-        if self.memory_usage != usage:
-            self.memory_usage = usage
-            print(self.get_memory_message())
+        # Sample right away, after a load for example
+        self.memory_monitor.sample()
 
     def get_memory_message(self):
-        return f"Memory usage: {self.memory_usage} GB"
+        return self.memory_monitor.get_message()
 
     def create_logo_message(self):
         w = 600